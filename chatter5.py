@@ -7,19 +7,34 @@ MBTI・ビッグ5理論統合・動的AIプロンプトシステム・全機能
 
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, font
-import subprocess
 import json
 import threading
 import time
 import random
 import re
 import logging
+import math
+import os
 import sys
 import unicodedata
 from datetime import datetime
 from pathlib import Path
+import heapq
 import queue
-from collections import Counter, defaultdict
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import as_completed
+
+try:
+    import numpy as np
+except ImportError:  # NumPy が無い環境では純Python実装で計算する
+    np = None
+
+from gemini_backend import (CIRCUIT_OPEN_ERROR, LAYOUT_PREFIX, POLICY_FASTEST, POLICY_QUALITY, RATE_LIMITED_ERROR,
+                            AdaptiveModelRouter, AsyncGeminiEngine, AvailabilityCache, CircuitBreakers,
+                            HedgingPolicy, PromptBudgeter, PromptSection, QuotaLedger, RequestCancelled,
+                            RequestContext, ResponseCache, TopicIndex, check_backend_available,
+                            create_backend_from_env, estimate_tokens, prefix_hash, prompt_layout_from_env,
+                            split_terms)
 
 # ログ設定
 logging.basicConfig(
@@ -382,38 +397,702 @@ class PersonaDefinitions:
             }
         }
     }
+    
+    # 定義の世代番号（変更のたびに増え、生成済みプロンプトテンプレートを無効化する）
+    revision = 0
+    
+    @classmethod
+    def update_persona(cls, persona_name, **fields):
+        """ペルソナ定義を追加・変更（PERSONAS を直接書き換えた場合は invalidate() を呼ぶこと）"""
+        cls.PERSONAS.setdefault(persona_name, {}).update(fields)
+        cls.invalidate()
+    
+    @classmethod
+    def invalidate(cls):
+        """定義変更を通知"""
+        cls.revision += 1
+
+class KeywordAutomaton:
+    """Aho–Corasick 法による複数キーワードの一括照合
+    
+    登録語数に関係なく、本文を1回走査するだけで全出現位置を列挙できる。
+    add() 後の最初の照合時に失敗遷移を構築する。照合自体は状態を書き換えないため、
+    build() 済みのインスタンスは複数スレッドから同時に照合してよい。
+    """
+    
+    def __init__(self, patterns=()):
+        self._goto = [{}]
+        self._fail = [0]
+        self._outputs = [[]]
+        # 各状態で終わる登録語そのもの（_outputs は失敗遷移先の出力を併合した結果）
+        self._terminals = [[]]
+        self._pattern_count = 0
+        self._built = True
+        for pattern, value in patterns:
+            self.add(pattern, value)
+    
+    def add(self, pattern, value):
+        """pattern を登録（一致時に value を返す。空文字列は無視）"""
+        if not pattern:
+            return
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append([])
+                self._terminals.append([])
+            state = next_state
+        self._terminals[state].append((len(pattern), self._pattern_count, value))
+        self._pattern_count += 1
+        self._built = False
+    
+    def build(self):
+        """未構築なら失敗遷移を構築して自身を返す（複数スレッドで共有する前に呼ぶ）"""
+        if not self._built:
+            self._build()
+        return self
+    
+    def _build(self):
+        """幅優先で失敗遷移を求め、接尾辞側の出力を併合（何度作り直しても同じ結果になる）"""
+        self._outputs = [list(terminals) for terminals in self._terminals]
+        queue_ = deque(self._goto[0].values())
+        for state in queue_:
+            self._fail[state] = 0
+        while queue_:
+            state = queue_.popleft()
+            for char, next_state in self._goto[state].items():
+                queue_.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._outputs[next_state] = self._outputs[next_state] + self._outputs[self._fail[next_state]]
+        self._built = True
+    
+    def iter_matches(self, text):
+        """(開始位置, 終了位置, value) を出現順に列挙（重なり・包含も含む）"""
+        if not self._built:
+            self._build()
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, _, value in outputs[state]:
+                yield index + 1 - length, index + 1, value
+    
+    def matched_values(self, text):
+        """本文に現れた登録語の value 一覧（登録語ごとに1回）"""
+        if not self._built:
+            self._build()
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        seen = set()
+        found = []
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if outputs[state] and state not in seen:
+                seen.add(state)
+                found.append(state)
+        # 状態ごとの出力には接尾辞側の語も含まれるため、語の重複を除いて返す
+        values = {}
+        for state in found:
+            for _, pattern_index, value in outputs[state]:
+                values[pattern_index] = value
+        return list(values.values())
+
+class PersonaInterestMatcher:
+    """全ペルソナの interest_topics / keywords を1つのオートマトンにまとめた興味度判定
+    
+    1回の走査で全ペルソナの一致数を求め、メッセージ単位でメモ化する。
+    照合は従来どおり大文字小文字を区別しない部分一致で、同じ語の複数回出現は1件と数える。
+    PersonaDefinitions.revision が変わると再構築する。
+    """
+    
+    def __init__(self, personas=None, cache_size=256):
+        # personas 省略時は PersonaDefinitions.PERSONAS を参照し、定義変更に追従する
+        self._personas = personas
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._automaton = None
+        self._revision = None
+    
+    def _ensure_automaton(self):
+        if self._personas is None and self._revision != PersonaDefinitions.revision:
+            self._automaton = None
+            self._cache.clear()
+        if self._automaton is None:
+            self._revision = PersonaDefinitions.revision
+            personas = self._personas if self._personas is not None else PersonaDefinitions.PERSONAS
+            # 同じ語を持つペルソナが多くても状態は1つ、一致時の持ち主一覧だけを共有する
+            owners = defaultdict(list)
+            for persona_name, persona in personas.items():
+                for topic in persona.get("interest_topics", []):
+                    owners[topic.lower()].append((persona_name, 'topics'))
+                for keyword in persona.get("keywords", []):
+                    owners[keyword.lower()].append((persona_name, 'keywords'))
+            # ロックの外で複数スレッドから照合するため、構築を済ませてから公開する
+            self._automaton = KeywordAutomaton(owners.items()).build()
+        return self._automaton
+    
+    def scan(self, message_content):
+        """{ペルソナ名: {'topics': 一致した興味分野数, 'keywords': 一致したキーワード数}}（一致無しは省略）"""
+        with self._lock:
+            automaton = self._ensure_automaton()
+            scores = self._cache.get(message_content)
+            if scores is not None:
+                self._cache.move_to_end(message_content)
+                return scores
+        
+        scores = {}
+        for owner_list in automaton.matched_values(message_content.lower()):
+            for persona_name, kind in owner_list:
+                counts = scores.setdefault(persona_name, {'topics': 0, 'keywords': 0})
+                counts[kind] += 1
+        
+        with self._lock:
+            self._cache[message_content] = scores
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return scores
+    
+    def topic_matches(self, persona_name, message_content):
+        """ペルソナの興味分野のうちメッセージに含まれる数"""
+        return self.scan(message_content).get(persona_name, {}).get('topics', 0)
+
+class KeywordTracker:
+    """時間減衰付きの頻出キーワード集計（ストリーム処理）
+    
+    分かち書き: ペルソナの興味分野・キーワードを辞書として優先的に切り出し、残りは split_terms() で
+    文字種ごとの連続（カタカナ語・英単語はそのまま、漢字は4文字までそのまま・5文字以上は2文字 n-gram）
+    に分ける。ひらがなの連続と停止語は数えない。
+    
+    集計: 容量 capacity の Space-Saving 法。減衰は前方減衰（加算する重みを exp(λ(t - t0)) 倍し、
+    読み出し時に割り戻す）で、監視中の語の加算は O(1)。上位 LEADERS 語を順序付きで保持するため
+    top(k) は O(k)。
+    """
+    
+    LEADERS = 16
+    STOP_WORDS = frozenset([
+        "こと", "もの", "ため", "よう", "これ", "それ", "あれ", "どれ", "ここ", "そこ",
+        "自分", "今日", "最近", "本当", "感じ", "時間", "一番", "場合", "意味", "部分", "全部", "今回",
+        "話題", "質問", "発言", "会話", "気持", "毎日", "一緒", "大切", "必要", "普通", "簡単", "興味", "面白",
+        "the", "and", "for", "you", "are", "this", "that", "with",
+    ])
+    
+    def __init__(self, capacity=200, half_life=600, weights=None):
+        self.capacity = capacity
+        self.decay_rate = math.log(2) / half_life
+        # 発言元ごとの重み（AI の応答はユーザー発言より軽く数える）
+        self.weights = dict({'user': 1.0, 'ai': 0.5}, **(weights or {}))
+        self._lock = threading.Lock()
+        self._dictionary = None
+        self._revision = None
+        self.clear()
+    
+    def clear(self):
+        """集計を破棄"""
+        with self._lock:
+            self._counts = {}
+            self._heap = []
+            self._leaders = []
+            self._origin = time.time()
+    
+    def _ensure_dictionary(self):
+        """ペルソナ定義から辞書語オートマトンと停止語（ペルソナ名）を作る"""
+        if self._dictionary is not None and self._revision == PersonaDefinitions.revision:
+            return
+        dictionary = KeywordAutomaton()
+        for persona in PersonaDefinitions.PERSONAS.values():
+            for term in persona.get("interest_topics", []) + persona.get("keywords", []):
+                dictionary.add(term.lower(), term)
+        self._dictionary = dictionary.build()
+        self._names = frozenset(PersonaDefinitions.PERSONAS)
+        self._revision = PersonaDefinitions.revision
+    
+    def tokenize(self, text):
+        """キーワード候補の一覧（辞書語 → 文字種ごとの連続の順で切り出し、停止語を除く）"""
+        self._ensure_dictionary()
+        lowered = text.lower()
+        covered = bytearray(len(lowered))
+        tokens = []
+        # 辞書語は最長一致で重ならないように採用
+        for start, end, term in sorted(self._dictionary.iter_matches(lowered), key=lambda m: (m[0], m[0] - m[1])):
+            if not any(covered[start:end]):
+                covered[start:end] = b'\x01' * (end - start)
+                tokens.append(term)
+        # 辞書語の部分を区切り文字に置き換え、残りを文字種ごとの連続に分ける
+        masked = ''.join(' ' if covered[index] else char for index, char in enumerate(lowered))
+        tokens.extend(split_terms(masked))
+        return [token for token in tokens
+                if len(token) >= 2 and token not in self.STOP_WORDS and token not in self._names]
+    
+    def add_text(self, text, source='user', now=None):
+        """発言を分かち書きして加算（source: 'user' / 'ai'）"""
+        tokens = self.tokenize(text)
+        weight = self.weights.get(source, 1.0)
+        with self._lock:
+            now = time.time() if now is None else now
+            for token in tokens:
+                self._add(token, weight, now)
+        return tokens
+    
+    def _add(self, token, weight, now):
+        exponent = self.decay_rate * (now - self._origin)
+        if exponent > 50:
+            # 重みの桁あふれ防止: 基準時刻を現在に移して全体を割り戻す（まれにしか起きない）
+            scale = math.exp(-exponent)
+            self._counts = {key: count * scale for key, count in self._counts.items()}
+            self._heap = [(count, key) for key, count in self._counts.items()]
+            heapq.heapify(self._heap)
+            self._origin = now
+            exponent = 0.0
+        increment = weight * math.exp(exponent)
+        
+        count = self._counts.get(token)
+        if count is None:
+            if len(self._counts) >= self.capacity:
+                # 最小の語を追い出し、その値を引き継ぐ（Space-Saving）。ヒープは遅延更新
+                while True:
+                    stored, victim = heapq.heappop(self._heap)
+                    current = self._counts.get(victim)
+                    if current == stored:
+                        break
+                    if current is not None:
+                        heapq.heappush(self._heap, (current, victim))
+                del self._counts[victim]
+                if victim in self._leaders:
+                    self._leaders.remove(victim)
+                count = stored
+            else:
+                count = 0.0
+            count += increment
+            heapq.heappush(self._heap, (count, token))
+        else:
+            count += increment
+        self._counts[token] = count
+        self._promote(token, count)
+    
+    def _promote(self, token, count):
+        """上位語の順序付き一覧を更新（長さは LEADERS で一定）"""
+        leaders = self._leaders
+        if token in leaders:
+            index = leaders.index(token)
+        elif len(leaders) < self.LEADERS:
+            leaders.append(token)
+            index = len(leaders) - 1
+        elif count > self._counts[leaders[-1]]:
+            leaders[-1] = token
+            index = len(leaders) - 1
+        else:
+            return
+        while index > 0 and self._counts[leaders[index - 1]] < count:
+            leaders[index - 1], leaders[index] = leaders[index], leaders[index - 1]
+            index -= 1
+    
+    def top(self, k=5, now=None):
+        """[(キーワード, 減衰後の重み)] を重みの大きい順に最大 k 件（k は LEADERS まで）"""
+        with self._lock:
+            now = time.time() if now is None else now
+            scale = math.exp(-self.decay_rate * (now - self._origin))
+            return [(token, self._counts[token] * scale) for token in self._leaders[:k]]
+    
+    def __len__(self):
+        return len(self._counts)
+
+class NameMentionDetector:
+    """ペルソナ名・別名（愛称）への呼びかけを1回の走査で検出する
+    
+    全ペルソナ名と別名を長い順に並べた1つの正規表現で照合し、前後の文字種で語の一部を除外する
+    （「ありなし」の「りな」、「夏海岸」の「夏海」など）。直後の敬称（さん/ちゃん/くん等）・肩書き
+    （先生/部長等）と @ 付きの呼びかけも同時に取り出す。正規表現はペルソナ定義か別名が変わった場合のみ作り直す。
+    
+    除外規則:
+    - 1〜2文字のひらがな名: 前後が両方ひらがなの場合のみ（直前が助詞・感動詞なら除外しない）
+    - 漢字・カタカナ・英字の名: 直後が同じ文字種の場合（「夏海岸」「アヤシイ」）。カタカナ・英字は直前も同様
+    - 3文字以上のひらがな名、敬称・肩書き付き、@ 付きは除外しない
+    
+    別名はペルソナ定義の "aliases" と、コンストラクタ（GEMINI_NAME_ALIASES）の {別名: ペルソナ名} から取る。
+    """
+    
+    HONORIFICS = ("ちゃん", "さん", "くん", "さま", "君", "様",
+                  "先生", "先輩", "せんぱい", "部長", "課長", "社長", "店長", "医師", "教授", "博士", "選手", "氏")
+    # 同じ文字種が続いても名前の直後として認める記号
+    FOLLOWERS = ("ー", "～", "〜")
+    # 同じ文字種でも名前の直前として認める助詞・感動詞（「みゆきとさやか」「ねえりな」）
+    PRECEDERS = frozenset("とやもねえはがにのへをよでか")
+    
+    def __init__(self, aliases=None):
+        self.aliases = dict(aliases or {})
+        self._pattern = None
+        self._targets = {}
+        self._revision = None
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_env(cls):
+        """環境変数から構築（GEMINI_NAME_ALIASES="みゆきち=みゆき,りゅう=龍之介"）"""
+        aliases = {}
+        for item in filter(None, (part.strip() for part in os.environ.get('GEMINI_NAME_ALIASES', '').split(','))):
+            alias, _, persona_name = item.partition('=')
+            aliases[alias.strip()] = persona_name.strip()
+        return cls(aliases)
+    
+    def add_alias(self, alias, persona_name):
+        """別名を追加（次回の検出時に正規表現を作り直す）"""
+        with self._lock:
+            self.aliases[alias] = persona_name
+            self._pattern = None
+    
+    @staticmethod
+    def _script(char):
+        """文字種（hiragana / katakana / kanji / word / other）"""
+        if '\u3041' <= char <= '\u309f':
+            return 'hiragana'
+        if '\u30a1' <= char <= '\u30ff':
+            return 'katakana'
+        if '\u4e00' <= char <= '\u9fff' or '\u3400' <= char <= '\u4dbf' or char == '々':
+            return 'kanji'
+        if char.isalnum() or char == '_':
+            return 'word'
+        return 'other'
+    
+    def _compile(self):
+        """名前・別名 -> ペルソナ名 の表と、長い順の選択肢による正規表現を作る"""
+        targets = {}
+        for persona_name, persona in PersonaDefinitions.PERSONAS.items():
+            targets[persona_name] = persona_name
+            for alias in persona.get("aliases", []):
+                targets.setdefault(alias, persona_name)
+        for alias, persona_name in self.aliases.items():
+            if alias and persona_name in PersonaDefinitions.PERSONAS:
+                targets.setdefault(alias, persona_name)
+        names = sorted(targets, key=len, reverse=True)
+        honorifics = '|'.join(map(re.escape, sorted(self.HONORIFICS, key=len, reverse=True)))
+        self._pattern = re.compile(
+            f"(?P<at>[@＠])?(?P<name>{'|'.join(map(re.escape, names))})(?P<honorific>{honorifics})?"
+        )
+        self._targets = targets
+        self._revision = PersonaDefinitions.revision
+    
+    def _is_boundary(self, message, match):
+        """前後の文字から、名前が別の語の一部でないか判定（除外規則はクラスの説明を参照）"""
+        if match.group('at') or match.group('honorific'):
+            return True
+        name = match.group('name')
+        start, end = match.span('name')
+        before = self._script(message[start - 1]) if start > 0 else 'other'
+        after = self._script(message[end]) if end < len(message) else 'other'
+        script = self._script(name[0])
+        
+        if script == 'hiragana':
+            if len(name) > 2:
+                return True
+            # 「ありなし」「つまりなに」のように、ひらがなの連続の途中にある短い名前のみ除外
+            return not (before == 'hiragana' and message[start - 1] not in self.PRECEDERS and after == 'hiragana')
+        if script in ('katakana', 'word') and before == script:
+            return False
+        return after != self._script(name[-1]) or message.startswith(self.FOLLOWERS, end)
+    
+    def detect(self, message, personas=None):
+        """呼びかけ一覧 [{'persona', 'alias', 'start', 'end', 'honorific', 'at'}]（出現順、personas で絞り込み）"""
+        with self._lock:
+            if self._pattern is None or self._revision != PersonaDefinitions.revision:
+                self._compile()
+            pattern, targets = self._pattern, self._targets
+        allowed = set(personas) if personas is not None else None
+        mentions = []
+        for match in pattern.finditer(message):
+            persona_name = targets[match.group('name')]
+            if allowed is not None and persona_name not in allowed:
+                continue
+            if not self._is_boundary(message, match):
+                continue
+            mentions.append({
+                'persona': persona_name,
+                'alias': match.group('name'),
+                'start': match.start(),
+                'end': match.end(),
+                'honorific': match.group('honorific') or "",
+                'at': match.group('at') is not None,
+            })
+        return mentions
+
+class PersonaAffinityModel:
+    """ペルソナ×特徴の親和度行列による発言者選択
+    
+    行 = ペルソナ、列 = ビッグ5の5次元＋語（interest_topics / keywords / traits を種別ごとに別列）。
+    行列の値は語の有無（0/1）とビッグ5の中心化スコア（(値-50)/50）で、重みはメッセージ側の
+    特徴ベクトルに載せる。各ターンの得点は行列×ベクトル1回で求め、温度付きソフトマックスで
+    参加確率に変換する。NumPy があれば密行列で、無ければ疎な行の辞書で計算する。
+    ペルソナ定義が変わった場合は、内容が変わった行（と新しい語の列）だけを更新する。
+    """
+    
+    BIG5 = ("openness", "conscientiousness", "extraversion", "agreeableness", "neuroticism")
+    TERM_FIELDS = (("topic", "interest_topics"), ("keyword", "keywords"), ("trait", "traits"))
+    DEFAULT_WEIGHTS = {
+        "topic": 2.0, "keyword": 1.0, "trait": 0.5,
+        "openness": 0.2, "conscientiousness": 0.0, "extraversion": 1.0, "agreeableness": 0.2, "neuroticism": 0.0,
+    }
+    
+    def __init__(self, personas=None, weights=None, temperature=2.0):
+        # personas 省略時は PersonaDefinitions.PERSONAS を参照し、定義変更に追従する
+        self._personas = personas
+        self.weights = dict(self.DEFAULT_WEIGHTS, **(weights or {}))
+        self.temperature = temperature
+        self._lock = threading.Lock()
+        self._revision = None
+        self._rows = {}          # ペルソナ名 -> 行番号
+        self._fingerprints = {}  # ペルソナ名 -> 行の元になった定義
+        self._columns = {}       # (種別, 語) -> 列番号
+        self._column_kinds = list(self.BIG5)
+        self._automaton = KeywordAutomaton()
+        self._term_columns = {}  # 小文字化した語 -> 列番号の一覧（オートマトンの値）
+        self._matrix = np.zeros((0, len(self.BIG5))) if np is not None else []
+        for index, dimension in enumerate(self.BIG5):
+            self._columns[("big5", dimension)] = index
+    
+    @classmethod
+    def from_env(cls):
+        """環境変数から構築
+        
+        GEMINI_AFFINITY_WEIGHTS: "topic=2,keyword=1,extraversion=0.5" 形式の重み（省略分は既定値）
+        GEMINI_AFFINITY_TEMPERATURE: ソフトマックスの温度（小さいほど得点の高いペルソナに集中）
+        """
+        weights = {}
+        for item in filter(None, (part.strip() for part in os.environ.get('GEMINI_AFFINITY_WEIGHTS', '').split(','))):
+            name, _, value = item.partition('=')
+            weights[name.strip()] = float(value)
+        return cls(weights=weights, temperature=float(os.environ.get('GEMINI_AFFINITY_TEMPERATURE', 2.0)))
+    
+    @classmethod
+    def _fingerprint(cls, persona):
+        return (tuple(tuple(persona.get(field, [])) for _, field in cls.TERM_FIELDS),
+                tuple(persona.get("big5", {}).get(dimension, 50) for dimension in cls.BIG5))
+    
+    def _column(self, kind, term):
+        """(種別, 語) の列番号（未登録なら列を追加）"""
+        key = (kind, term.lower())
+        column = self._columns.get(key)
+        if column is None:
+            column = self._columns[key] = len(self._column_kinds)
+            self._column_kinds.append(kind)
+            if np is not None:
+                self._matrix = np.hstack([self._matrix, np.zeros((self._matrix.shape[0], 1))])
+            columns = self._term_columns.get(key[1])
+            if columns is None:
+                columns = self._term_columns[key[1]] = []
+                self._automaton.add(key[1], columns)
+            columns.append(column)
+        return column
+    
+    def _set_row(self, persona_name, persona):
+        """ペルソナ1名分の行を作成・更新"""
+        values = {}
+        big5 = persona.get("big5", {})
+        for index, dimension in enumerate(self.BIG5):
+            values[index] = (big5.get(dimension, 50) - 50) / 50
+        for kind, field in self.TERM_FIELDS:
+            for term in persona.get(field, []):
+                values[self._column(kind, term)] = 1.0
+        
+        row = self._rows.get(persona_name)
+        if np is not None:
+            vector = np.zeros(len(self._column_kinds))
+            vector[list(values)] = list(values.values())
+            if row is None:
+                self._matrix = np.vstack([self._matrix, vector])
+            else:
+                self._matrix[row] = vector
+        elif row is None:
+            self._matrix.append(values)
+        else:
+            self._matrix[row] = values
+        if row is None:
+            self._rows[persona_name] = len(self._rows)
+    
+    def _remove_row(self, persona_name):
+        row = self._rows.pop(persona_name)
+        self._fingerprints.pop(persona_name, None)
+        if np is not None:
+            self._matrix = np.delete(self._matrix, row, axis=0)
+        else:
+            del self._matrix[row]
+        for name, index in self._rows.items():
+            if index > row:
+                self._rows[name] = index - 1
+    
+    def _sync(self):
+        """ペルソナ定義と行列を同期（変更のあった行のみ更新）"""
+        if self._personas is None and self._revision == PersonaDefinitions.revision:
+            return
+        personas = self._personas if self._personas is not None else PersonaDefinitions.PERSONAS
+        self._revision = PersonaDefinitions.revision
+        updated = []
+        for persona_name, persona in personas.items():
+            fingerprint = self._fingerprint(persona)
+            if self._fingerprints.get(persona_name) != fingerprint:
+                self._set_row(persona_name, persona)
+                self._fingerprints[persona_name] = fingerprint
+                updated.append(persona_name)
+        removed = [persona_name for persona_name in self._rows if persona_name not in personas]
+        for persona_name in removed:
+            self._remove_row(persona_name)
+        if updated or removed:
+            logger.debug(f"親和度行列を更新: 更新={updated} 削除={removed} 形状=({len(self._rows)}, {len(self._column_kinds)})")
+    
+    def _message_features(self, message):
+        """メッセージの特徴（列番号 -> 重み）。ビッグ5列は常に重みそのもの"""
+        features = {index: self.weights.get(dimension, 0.0) for index, dimension in enumerate(self.BIG5)}
+        for columns in self._automaton.matched_values(message.lower()):
+            for column in columns:
+                features[column] = self.weights.get(self._column_kinds[column], 0.0)
+        return features
+    
+    def scores(self, message, candidates=None):
+        """{ペルソナ名: 親和度}（candidates 省略時は全ペルソナ）"""
+        with self._lock:
+            self._sync()
+            names = list(self._rows) if candidates is None else [name for name in candidates if name in self._rows]
+            features = self._message_features(message)
+            rows = [self._rows[name] for name in names]
+            if np is not None:
+                vector = np.zeros(len(self._column_kinds))
+                vector[list(features)] = list(features.values())
+                values = (self._matrix[rows] @ vector).tolist()
+            else:
+                values = [sum(weight * self._matrix[row].get(column, 0.0) for column, weight in features.items())
+                          for row in rows]
+        return dict(zip(names, values))
+    
+    def probabilities(self, scores, expected, temperature=None):
+        """得点を温度付きソフトマックスで正規化し、期待参加人数 expected 倍した参加確率（上限1）"""
+        if not scores:
+            return {}
+        temperature = max(temperature or self.temperature, 1e-6)
+        top = max(scores.values())
+        if np is not None:
+            exp = np.exp((np.array(list(scores.values())) - top) / temperature)
+            softmax = (exp / exp.sum()).tolist()
+        else:
+            exp = [math.exp((value - top) / temperature) for value in scores.values()]
+            total = sum(exp)
+            softmax = [value / total for value in exp]
+        return {name: min(1.0, expected * p) for name, p in zip(scores, softmax)}
+    
+    def select(self, message, candidates, expected=2.0, top_k=None, minimum=0, temperature=None, rng=random):
+        """参加者を抽選（得点の高い順に最大 top_k 名、最低 minimum 名）
+        
+        各ペルソナは参加確率に従って独立に抽選され、top_k を超えた分は得点の低い順に外す。
+        """
+        scores = self.scores(message, candidates)
+        probabilities = self.probabilities(scores, expected, temperature)
+        chosen = [name for name, p in probabilities.items() if rng.random() < p]
+        if len(chosen) < minimum:
+            # 不足分は参加確率に比例して重複なく補う
+            rest = [name for name in probabilities if name not in chosen]
+            while len(chosen) < minimum and rest:
+                pick = rng.choices(rest, weights=[probabilities[name] for name in rest])[0]
+                chosen.append(pick)
+                rest.remove(pick)
+        chosen.sort(key=lambda name: scores[name], reverse=True)
+        if top_k is not None:
+            chosen = chosen[:max(0, top_k)]
+        logger.debug(f"親和度による選択: {chosen} 得点={ {name: round(scores[name], 2) for name in chosen} }")
+        return chosen
 
 class DynamicPromptGenerator:
     """動的AIプロンプト生成クラス"""
     
-    def __init__(self):
+    # 興味レベル別の詳細度設定
+    DETAIL_SETTINGS = {
+        "high_interest": {
+            "response_length": "3-5文で詳細に",
+            "examples": "具体例や経験談を2-3個含める",
+            "emotion": "情熱的で詳しく語る"
+        },
+        "medium_interest": {
+            "response_length": "2-3文で適度に",
+            "examples": "1つの具体例を含める",
+            "emotion": "普通の関心を示す"
+        },
+        "low_interest": {
+            "response_length": "1-2文で簡潔に",
+            "examples": "簡単な例のみ、または無し",
+            "emotion": "控えめで短めに"
+        }
+    }
+    
+    PSYCH_HEADER = "【心理特性による会話調整】\n"
+    
+    MULTI_PERSONA_INSTRUCTIONS = """【出力形式】
+全員分を必ず次の形式で、設定した順番どおりに出力してください。名前以外の見出しや説明は不要です。
+
+【ペルソナ名】
+発言内容
+
+必ず各ペルソナらしい個性的で人間らしい発言をしてください。
+"""
+    
+    def __init__(self, budgeter=None, model_provider=None, layout=None):
         self.conversation_context = []
         self.topic_keywords = defaultdict(int)
-        
-    def analyze_interest_level(self, persona_name, message_content):
-        """ペルソナの興味レベルを分析"""
-        persona = PersonaDefinitions.PERSONAS[persona_name]
-        interest_topics = persona["interest_topics"]
-        
-        # キーワードマッチング分析
-        matches = 0
-        for topic in interest_topics:
-            if topic.lower() in message_content.lower():
-                matches += 1
-                
-        # 興味レベル判定
-        if matches >= 2:
-            return "high_interest"
-        elif matches >= 1:
-            return "medium_interest"
+        # プロンプトをモデル別のトークン上限に収める（model_provider は送信先モデル名を返す）
+        self.budgeter = budgeter or PromptBudgeter.from_env()
+        self.model_provider = model_provider
+        # LAYOUT_PREFIX では静的区画を先頭に集め、ペルソナごとに同一の接頭辞にする
+        self.layout = layout or prompt_layout_from_env()
+        # 全ペルソナの興味分野を1回の走査で照合
+        self.interest_matcher = PersonaInterestMatcher()
+        # (ペルソナ名, 興味レベル) -> 静的部分を組み立て済みのテンプレート
+        self._templates = {}
+        self._templates_revision = PersonaDefinitions.revision
+        
+    def _template(self, persona_name, interest_level):
+        """静的なペルソナ情報から作る部分を初回のみ組み立ててメモ化"""
+        if self._templates_revision != PersonaDefinitions.revision:
+            self.invalidate_templates()
+        key = (persona_name, interest_level)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = self._compile_template(persona_name, interest_level)
+        return template
+    
+    def invalidate_templates(self, persona_name=None):
+        """テンプレートを破棄（persona_name 指定時はそのペルソナ分のみ）"""
+        if persona_name is None:
+            self._templates.clear()
+            self._templates_revision = PersonaDefinitions.revision
         else:
-            return "low_interest"
+            for key in [key for key in self._templates if key[0] == persona_name]:
+                del self._templates[key]
     
-    def generate_dynamic_prompt(self, persona_name, user_message, context, interest_level):
-        """動的プロンプト生成 - 心理学理論統合"""
+    def prefix_hash(self, persona_name):
+        """接頭辞固定配置でのペルソナ別接頭辞ハッシュ（興味レベルに依存しない。予算超過で心理特性を削った場合は変わる）"""
+        return self._template(persona_name, "medium_interest")['prefix_hash']
+    
+    def prefix_hashes(self):
+        """全ペルソナの接頭辞ハッシュ"""
+        return {persona_name: self.prefix_hash(persona_name) for persona_name in PersonaDefinitions.PERSONAS}
+    
+    def precompile_templates(self):
+        """全ペルソナ・全興味レベルのテンプレートを事前に組み立てる"""
+        for persona_name in PersonaDefinitions.PERSONAS:
+            for interest_level in self.DETAIL_SETTINGS:
+                self._template(persona_name, interest_level)
+    
+    def _compile_template(self, persona_name, interest_level):
+        """個別プロンプトの静的区画と一括生成用ブロックを組み立てる"""
         persona = PersonaDefinitions.PERSONAS[persona_name]
         mbti = persona["mbti"]
-        big5 = persona["big5"]
         conversation_pattern = persona["conversation_patterns"][interest_level]
         hidden_traits = persona.get("hidden_traits", [])
         
@@ -421,35 +1100,19 @@ class DynamicPromptGenerator:
         mbti_modifiers = self._get_mbti_modifiers(mbti)
         
         # ビッグ5による詳細調整
-        big5_modifiers = self._get_big5_modifiers(big5)
-        
-        # 興味レベル別の詳細度設定
-        detail_settings = {
-            "high_interest": {
-                "response_length": "3-5文で詳細に",
-                "examples": "具体例や経験談を2-3個含める",
-                "emotion": "情熱的で詳しく語る"
-            },
-            "medium_interest": {
-                "response_length": "2-3文で適度に",
-                "examples": "1つの具体例を含める",
-                "emotion": "普通の関心を示す"
-            },
-            "low_interest": {
-                "response_length": "1-2文で簡潔に",
-                "examples": "簡単な例のみ、または無し",
-                "emotion": "控えめで短めに"
-            }
-        }
+        big5_modifiers = self._get_big5_modifiers(persona["big5"])
         
-        detail = detail_settings[interest_level]
+        detail = self.DETAIL_SETTINGS[interest_level]
+        interest_topics = ', '.join(persona['interest_topics'])
         
         # 裏設定による調整
         hidden_modifiers = ""
         if hidden_traits:
             hidden_modifiers = f"裏設定として{', '.join(hidden_traits)}な特徴を発言に反映させてください。"
+        hidden_line = f"\n- 裏設定: {', '.join(hidden_traits)}な特徴を発言に反映" if hidden_traits else ""
         
-        prompt = f"""
+        template = {
+            'persona': f"""
 あなたは{persona_name}（{persona['age']}歳、{persona['occupation']}）として会話してください。
 
 【基本設定】
@@ -458,31 +1121,143 @@ class DynamicPromptGenerator:
 - 生い立ち: {persona['backstory']}
 - MBTI: {mbti}
 
-【心理特性による会話調整】
-{mbti_modifiers}
+""",
+            'psych': f"""{mbti_modifiers}
 {big5_modifiers}
 
-【今回の興味レベル】: {interest_level}
+""",
+            'interest': f"""【今回の興味レベル】: {interest_level}
 - 会話パターン: {conversation_pattern}
 - 返答の長さ: {detail['response_length']}
 - 具体例: {detail['examples']}
 - 感情表現: {detail['emotion']}
 
-【前の会話履歴】
-{context}
-
-【ユーザーメッセージ】
-{user_message}
-
-【特別指示】
+""",
+            'instructions': f"""【特別指示】
 {hidden_modifiers}
 
-【重要】このペルソナの興味分野（{', '.join(persona['interest_topics'])}）に関する話題かどうかで反応の熱量を調整してください。
+【重要】このペルソナの興味分野（{interest_topics}）に関する話題かどうかで反応の熱量を調整してください。
 興味のある話題なら詳しく語り、そうでなければ適度に対応してください。
 
 必ず{persona_name}らしい個性的で人間らしい発言をしてください。
-"""
+""",
+            'block': f"""【{persona_name}】{persona['age']}歳・{persona['occupation']}
+- 性格: {persona['personality']}
+- 話し方: {persona['speaking_style']}
+- MBTI: {mbti}
+{mbti_modifiers}
+{big5_modifiers}
+- 興味分野: {interest_topics}
+- 今回の興味レベル: {interest_level}（{conversation_pattern}）
+- 返答の長さ: {detail['response_length']} / 具体例: {detail['examples']} / 感情表現: {detail['emotion']}{hidden_line}""",
+        }
+        # 予算計算用のトークン概算も一度だけ行う
+        template['tokens'] = {
+            'persona': estimate_tokens(template['persona']),
+            'psych': estimate_tokens(self.PSYCH_HEADER + template['psych']),
+            'interest': estimate_tokens(template['interest']),
+            'instructions': estimate_tokens(template['instructions']),
+        }
+        # 接頭辞固定配置で先頭に並ぶ静的部分（人物設定・心理特性・特別指示）
+        template['prefix_hash'] = prefix_hash(
+            template['persona'] + self.PSYCH_HEADER + template['psych'] + template['instructions'] + "\n")
+        return template
+        
+    def _build_prompt(self, sections, label):
+        """区画を予算内に収めて連結"""
+        model = self.model_provider() if self.model_provider else None
+        prompt, _ = self.budgeter.build(sections, model, label)
         return prompt
+        
+    def analyze_interest_level(self, persona_name, message_content):
+        """ペルソナの興味レベルを分析（照合結果はメッセージ単位で全ペルソナ分を共有）"""
+        matches = self.interest_matcher.topic_matches(persona_name, message_content)
+                
+        # 興味レベル判定
+        if matches >= 2:
+            return "high_interest"
+        elif matches >= 1:
+            return "medium_interest"
+        else:
+            return "low_interest"
+    
+    def generate_dynamic_prompt(self, persona_name, user_message, context, interest_level):
+        """動的プロンプト生成 - 心理学理論統合（静的部分はテンプレートから差し込む）"""
+        template = self._template(persona_name, interest_level)
+        
+        # 上限超過時は優先度の低い区画（会話履歴 → 心理特性）から削る
+        tokens = template['tokens']
+        persona = PromptSection('persona', template['persona'], priority=90, trim=None, tokens=tokens['persona'])
+        psych = PromptSection('psych', template['psych'], priority=30, header=self.PSYCH_HEADER,
+                              tokens=tokens['psych'])
+        interest = PromptSection('interest', template['interest'], priority=70, trim=None,
+                                 tokens=tokens['interest'])
+        context = PromptSection('context', f"""{context}
+
+""", priority=10, trim='head', header="【前の会話履歴】\n")
+        message = PromptSection('user_message', f"""【ユーザーメッセージ】
+{user_message}
+
+""", priority=100, trim=None)
+        instructions = PromptSection('instructions', template['instructions'], priority=80, trim=None,
+                                     tokens=tokens['instructions'])
+        
+        if self.layout == LAYOUT_PREFIX:
+            # 指示の後に可変部分を置くため、区切りの改行を補う
+            instructions.text += "\n"
+            logger.debug(f"接頭辞固定配置 [{persona_name}] prefix={template['prefix_hash']}")
+            sections = [persona, psych, instructions, interest, context, message]
+        else:
+            sections = [persona, psych, interest, context, message, instructions]
+        return self._build_prompt(sections, persona_name)
+    
+    def generate_multi_persona_prompt(self, persona_levels, user_message, context):
+        """複数ペルソナの応答を1回の呼び出しで生成するためのプロンプト
+        
+        persona_levels: [(ペルソナ名, 興味レベル), ...]
+        """
+        blocks = [self._template(persona_name, interest_level)['block']
+                  for persona_name, interest_level in persona_levels]
+        
+        names = "、".join(name for name, _ in persona_levels)
+        persona = PromptSection('persona', f"""
+以下の{len(persona_levels)}名（{names}）がそれぞれ会話に参加します。
+各ペルソナの設定と今回の興味レベルに従い、全員分の発言を作成してください。
+
+【ペルソナ設定】
+{chr(10).join(blocks)}
+
+""", priority=90, trim=None)
+        context = PromptSection('context', f"""{context}
+
+""", priority=10, trim='head', header="【前の会話履歴】\n")
+        message = PromptSection('user_message', f"""【ユーザーメッセージ】
+{user_message}
+
+""", priority=100, trim=None)
+        instructions = PromptSection('instructions', self.MULTI_PERSONA_INSTRUCTIONS, priority=80, trim=None)
+        
+        # 参加者の組み合わせは毎回変わるため、接頭辞固定配置で共通になるのは出力形式の指示のみ
+        if self.layout == LAYOUT_PREFIX:
+            instructions.text += "\n"
+            sections = [instructions, persona, context, message]
+        else:
+            sections = [persona, context, message, instructions]
+        return self._build_prompt(sections, "一括生成")
+    
+    def parse_multi_persona_response(self, response, persona_names):
+        """一括生成の応答をペルソナ別に分解（想定外の名前は無視）"""
+        parts = re.split(r'^\s*【(.+?)】[ \t]*', response, flags=re.MULTILINE)
+        messages = {}
+        
+        for i in range(1, len(parts) - 1, 2):
+            # 「みゆき（25歳）」のような付記を除去
+            speaker = re.split(r'[（(・|]', parts[i].strip(), maxsplit=1)[0].strip()
+            message = parts[i + 1].strip()
+            if speaker in persona_names and message and speaker not in messages:
+                messages[speaker] = message
+                
+        return messages
     
     def _get_mbti_modifiers(self, mbti):
         """MBTI特性による会話修正子を生成"""
@@ -560,24 +1335,65 @@ class GeminiModelManager:
         "gemini-1.5-pro"
     ]
     
-    def __init__(self):
-        self.current_model = self.MODELS[0]
+    def __init__(self, ledger=None):
+        self.ledger = ledger
         self.error_counts = {model: 0 for model in self.MODELS}
+        self.breakers = CircuitBreakers.from_env()
+        # 品質順位は MODELS の並び順
+        self.router = AdaptiveModelRouter(
+            {model: index for index, model in enumerate(self.MODELS)},
+            breakers=self.breakers
+        )
+        if ledger:
+            for model in self.MODELS:
+                self.error_counts[model] = ledger.failures(model)
+                if self.error_counts[model]:
+                    self.router.restore_failures(model, self.error_counts[model], ledger.last_error_time(model))
+        self.current_model = self._first_usable_model()
+        self._lock = threading.Lock()
         logger.info(f"GeminiModelManager初期化: 初期モデル={self.current_model}")
-        
-    def get_next_model(self):
-        """エラー時の次のモデルを取得"""
-        current_index = self.MODELS.index(self.current_model)
-        next_index = (current_index + 1) % len(self.MODELS)
-        old_model = self.current_model
-        self.current_model = self.MODELS[next_index]
-        self.error_counts[old_model] += 1
-        logger.warning(f"モデル切り替え: {old_model} -> {self.current_model}")
-        return self.current_model
+    
+    def _first_usable_model(self):
+        """台帳上、本日クォータ枯渇していない最初のモデル"""
+        for model in self.MODELS:
+            if not self.ledger or not self.ledger.is_exhausted(model):
+                return model
+        return self.MODELS[0]
+        
+    def select_model(self, policy=POLICY_QUALITY):
+        """方針に従ってリクエストごとのモデルを選択（候補がなければ現在のモデル）"""
+        model = self.router.choose(policy)
+        with self._lock:
+            if model and model != self.current_model:
+                logger.info(f"モデル自動選択 ({policy}): {self.current_model} -> {model}")
+                self.current_model = model
+            return self.current_model
+        
+    def hedge_model(self, model):
+        """ヘッジ要求の送信先（model 以外で期待レイテンシ最小のモデル）"""
+        return self.router.choose(POLICY_FASTEST, exclude=[model])
+        
+    def get_next_model(self, failed_model=None):
+        """エラー時の次のモデルを取得（冷却中でないモデルから期待レイテンシ最小、なければ順送り）
+        
+        並列呼び出し時、failed_model が既に切り替え済みなら現在のモデルをそのまま返す
+        """
+        with self._lock:
+            if failed_model is not None and failed_model != self.current_model:
+                return self.current_model
+            old_model = self.current_model
+            next_model = self.router.choose(POLICY_FASTEST, exclude=[old_model])
+            if next_model is None:
+                next_model = self.MODELS[(self.MODELS.index(old_model) + 1) % len(self.MODELS)]
+            self.current_model = next_model
+            self.error_counts[old_model] += 1
+            logger.warning(f"モデル切り替え: {old_model} -> {self.current_model}")
+            return self.current_model
         
     def reset_model(self):
         """モデルを初期化"""
-        self.current_model = self.MODELS[0]
+        with self._lock:
+            self.current_model = self._first_usable_model()
         logger.info(f"モデルリセット: {self.current_model}")
 
 class ChatHistoryManager:
@@ -642,14 +1458,23 @@ class ChatHistoryManager:
 class BatchConversationProcessor:
     """バッチ処理制御クラス - 動的プロンプト対応"""
     
-    def __init__(self, model_manager):
+    FAILURE_MESSAGE = "申し訳ありません。現在システムに問題が発生しています。"
+    
+    def __init__(self, model_manager, engine, batch_mode=False):
         self.model_manager = model_manager
+        # 全ペルソナ応答生成で共有する非同期エンジン（並列数上限付き）
+        self.engine = engine
+        # True の場合、選ばれた全ペルソナの応答を1回の呼び出しで生成
+        self.batch_mode = batch_mode
         self.processing = False
-        self.prompt_generator = DynamicPromptGenerator()
-        logger.info("BatchConversationProcessor初期化完了")
-        
-    def generate_batch_conversation(self, context, user_message, active_personas):
-        """動的プロンプトによるバッチ会話生成"""
+        self.prompt_generator = DynamicPromptGenerator(model_provider=lambda: self.model_manager.current_model)
+        # 発言者選択（興味分野・キーワード・特性・ビッグ5の親和度）
+        self.affinity = PersonaAffinityModel.from_env()
+        self.mention_detector = NameMentionDetector.from_env()
+        logger.info(f"BatchConversationProcessor初期化完了: 並列数上限={engine.max_concurrency}")
+        
+    def generate_batch_conversation(self, context, user_message, active_personas, request_context=None):
+        """動的プロンプトによるバッチ会話生成（request_context のキャンセル・期限切れで RequestCancelled）"""
         if self.processing:
             logger.warning("既に処理中のため、バッチ会話生成をスキップ")
             return []
@@ -665,9 +1490,16 @@ class BatchConversationProcessor:
             final_personas = self._dynamic_persona_selection(
                 user_message, active_personas, mentioned_personas
             )
+            if request_context:
+                request_context.check()
             
-            # 動的プロンプトで個別応答生成
-            conversations = []
+            if self.batch_mode and len(final_personas) > 1:
+                conversations = self._generate_in_single_call(context, user_message, final_personas, request_context)
+                logger.info(f"一括会話生成完了: {len(conversations)}件の応答")
+                return conversations
+            
+            # 動的プロンプトを作成し、全員分を並列生成（表示間隔は表示側で調整）
+            requests = []
             for persona_name in final_personas:
                 try:
                     # 興味レベル分析
@@ -679,122 +1511,180 @@ class BatchConversationProcessor:
                     dynamic_prompt = self.prompt_generator.generate_dynamic_prompt(
                         persona_name, user_message, context, interest_level
                     )
-                    
-                    # AI応答生成
-                    response = self._call_gemini_cli(dynamic_prompt)
-                    
-                    conversations.append({
-                        'persona': persona_name,
-                        'message': response.strip(),
-                        'timestamp': datetime.now(),
-                        'interest_level': interest_level
-                    })
-                    
-                    logger.debug(f"動的応答生成: {persona_name} ({interest_level})")
-                    
-                    # 人間らしい間隔
-                    time.sleep(random.uniform(0.5, 1.5))
+                    requests.append((persona_name, dynamic_prompt, interest_level))
                     
                 except Exception as e:
-                    logger.error(f"個別応答生成エラー ({persona_name}): {e}")
+                    logger.error(f"個別プロンプト生成エラー ({persona_name}): {e}")
                     
+            conversations = self.generate_concurrently(requests, request_context=request_context)
             logger.info(f"動的バッチ会話生成完了: {len(conversations)}件の応答")
             return conversations
             
+        except RequestCancelled:
+            raise
         except Exception as e:
             logger.error(f"動的バッチ会話生成エラー: {e}")
             return []
         finally:
             self.processing = False
     
-    def _dynamic_persona_selection(self, user_message, all_personas, mentioned_personas):
-        """動的ペルソナ選択 - 興味度ベース"""
-        selected = set(mentioned_personas)  # 呼びかけられたペルソナは必ず参加
-        
-        # 各ペルソナの興味度を計算
-        interest_scores = {}
-        for persona_name in all_personas:
-            if persona_name not in selected:
-                interest_level = self.prompt_generator.analyze_interest_level(
-                    persona_name, user_message
-                )
-                
-                # 興味度による参加確率
-                participation_probability = {
-                    "high_interest": 0.8,   # 高い興味：80%で参加
-                    "medium_interest": 0.4,  # 普通の興味：40%で参加  
-                    "low_interest": 0.1     # 低い興味：10%で参加
-                }
+    def _generate_in_single_call(self, context, user_message, persona_names, request_context=None):
+        """選ばれた全ペルソナの応答を1回の呼び出しで生成し、解析できなかった分のみ個別に再生成"""
+        persona_levels = [
+            (persona_name, self.prompt_generator.analyze_interest_level(persona_name, user_message))
+            for persona_name in persona_names
+        ]
+        
+        prompt = self.prompt_generator.generate_multi_persona_prompt(persona_levels, user_message, context)
+        response = self._call_gemini_cli(prompt, request_context)
+        messages = self.prompt_generator.parse_multi_persona_response(response, persona_names)
+        
+        conversations = []
+        retry_requests = []
+        for persona_name, interest_level in persona_levels:
+            if persona_name in messages:
+                conversations.append({
+                    'persona': persona_name,
+                    'message': messages[persona_name],
+                    'timestamp': datetime.now(),
+                    'interest_level': interest_level
+                })
+            else:
+                retry_requests.append((
+                    persona_name,
+                    self.prompt_generator.generate_dynamic_prompt(persona_name, user_message, context, interest_level),
+                    interest_level
+                ))
                 
-                if random.random() < participation_probability[interest_level]:
-                    selected.add(persona_name)
-                    interest_scores[persona_name] = interest_level
-        
-        # 最大5名に制限
-        if len(selected) > 5:
-            # 高い興味のペルソナを優先
-            high_interest = [p for p, level in interest_scores.items() if level == "high_interest"]
-            medium_interest = [p for p, level in interest_scores.items() if level == "medium_interest"]
-            
-            final_selected = set(mentioned_personas)  # 呼びかけられたペルソナは保持
-            remaining_slots = 5 - len(final_selected)
-            
-            # 優先順位に従って追加
-            for persona_list in [high_interest, medium_interest]:
-                while remaining_slots > 0 and persona_list:
-                    final_selected.add(persona_list.pop(0))
-                    remaining_slots -= 1
-                    
-            selected = final_selected
+        if retry_requests:
+            logger.warning(f"一括応答の解析失敗、個別に再生成: {[name for name, _, _ in retry_requests]}")
+            conversations.extend(self.generate_concurrently(retry_requests, request_context=request_context))
+            order = {name: index for index, name in enumerate(persona_names)}
+            conversations.sort(key=lambda conv: order[conv['persona']])
+            
+        return conversations
+    
+    def generate_concurrently(self, requests, policy=POLICY_QUALITY, request_context=None):
+        """(ペルソナ名, プロンプト, 興味レベル) のリストを並列数上限内で同時に生成
+        
+        結果はリクエスト順で全ペルソナ分を返す（失敗したペルソナの発言は FAILURE_MESSAGE）。
+        request_context がキャンセルされると全要求を中断して RequestCancelled を送出する。
+        """
+        if request_context:
+            request_context.check()
+        self.model_manager.select_model(policy)
+        # ヘッジ（重複送信）はユーザー発言への応答のみ
+        hedge = policy == POLICY_QUALITY
+        futures = {
+            self.submit_generation(prompt, route=False, hedge=hedge, request_context=request_context):
+                (index, persona_name, interest_level)
+            for index, (persona_name, prompt, interest_level) in enumerate(requests)
+        }
         
-        return list(selected)
+        results = []
+        for future in as_completed(futures):
+            if request_context:
+                request_context.check()
+            index, persona_name, interest_level = futures[future]
+            response = self._response_text(future)
+                
+            results.append((index, {
+                'persona': persona_name,
+                'message': response.strip(),
+                'timestamp': datetime.now(),
+                'interest_level': interest_level
+            }))
+            logger.debug(f"動的応答生成: {persona_name} ({interest_level})")
+            
+        results.sort(key=lambda item: item[0])
+        return [conversation for _, conversation in results]
+    
+    # ユーザー発言に反応する人数の期待値と上限（呼びかけられたペルソナを含む）
+    USER_TURN_EXPECTED = 2.5
+    USER_TURN_MAX = 5
+    
+    def _dynamic_persona_selection(self, user_message, all_personas, mentioned_personas):
+        """動的ペルソナ選択 - 親和度ベース"""
+        selected = list(dict.fromkeys(mentioned_personas))  # 呼びかけられたペルソナは必ず参加
+        
+        # 残りは親和度に応じて抽選し、合計 USER_TURN_MAX 名までに制限（得点の高い順に優先）
+        candidates = [persona_name for persona_name in all_personas if persona_name not in selected]
+        selected += self.affinity.select(
+            user_message, candidates,
+            expected=self.USER_TURN_EXPECTED, top_k=self.USER_TURN_MAX - len(selected)
+        )
+        return selected
         
     def _check_name_mentions(self, message, personas):
-        """メッセージ内の名前呼びかけをチェック"""
+        """メッセージ内の名前呼びかけをチェック（呼ばれた順・重複なし）"""
         mentioned = []
-        for name in personas:
-            if name in message or f"@{name}" in message:
-                mentioned.append(name)
-                logger.debug(f"名前呼びかけ検出: {name}")
+        for mention in self.mention_detector.detect(message, personas):
+            if mention['persona'] not in mentioned:
+                mentioned.append(mention['persona'])
+            logger.debug(f"名前呼びかけ検出: {mention['persona']} ({mention['alias']}{mention['honorific']} "
+                         f"位置={mention['start']}-{mention['end']}{' @' if mention['at'] else ''})")
         return mentioned
         
-    def _call_gemini_cli(self, prompt):
-        """Gemini CLIを呼び出し"""
-        max_retries = len(self.model_manager.MODELS)
+    def submit_generation(self, prompt, timeout=30, use_cache=True, route=True, hedge=True, request_context=None):
+        """非同期エンジンへ生成を依頼し Future を返す（use_cache=False でキャッシュを迂回）"""
+        if route:
+            self.model_manager.select_model(POLICY_QUALITY)
+        return self.engine.submit(
+            prompt, self.model_manager.current_model, timeout=timeout,
+            next_model=self._next_fallback_model,
+            max_attempts=len(self.model_manager.MODELS),
+            use_cache=use_cache,
+            hedge=hedge,
+            context=request_context
+        )
         
-        for attempt in range(max_retries):
-            try:
-                logger.debug(f"Gemini CLI呼び出し開始: モデル={self.model_manager.current_model}, 試行={attempt+1}")
-                
-                process = subprocess.run([
-                    'gemini', '--prompt', prompt, 
-                    '--model', self.model_manager.current_model
-                ], capture_output=True, text=True, timeout=30, encoding='utf-8')
-                
-                if process.returncode == 0:
-                    logger.info(f"Gemini CLI成功: レスポンス長={len(process.stdout)}")
-                    return process.stdout.strip()
-                else:
-                    error_msg = process.stderr.strip()
-                    logger.warning(f"Gemini CLIエラー (試行{attempt+1}): {error_msg}")
-                    
-                    if "429" in error_msg or "quota" in error_msg.lower():
-                        logger.warning("API制限エラー: 次のモデルに切り替え")
-                        self.model_manager.get_next_model()
-                    else:
-                        break
-                        
-            except subprocess.TimeoutExpired:
-                logger.warning(f"Gemini CLIタイムアウト (試行{attempt+1})")
-                if attempt < max_retries - 1:
-                    self.model_manager.get_next_model()
-            except Exception as e:
-                logger.error(f"Gemini CLI例外エラー (試行{attempt+1}): {e}")
-                if attempt < max_retries - 1:
-                    self.model_manager.get_next_model()
-                    
+    def _next_fallback_model(self, model, result):
+        """失敗結果から次のモデルを決定（API制限・タイムアウト時のみ切り替え）"""
+        if result.timed_out:
+            logger.warning(f"Gemini CLIタイムアウト (モデル={model}, 試行{result.attempts})")
+            return self.model_manager.get_next_model(model)
+            
+        error_msg = result.stderr.strip()
+        if error_msg in (CIRCUIT_OPEN_ERROR, RATE_LIMITED_ERROR):
+            logger.info(f"回路遮断中・クォータ切れのモデルを省略: {model}")
+            return self.model_manager.get_next_model(model)
+        logger.warning(f"Gemini CLIエラー (モデル={model}, 試行{result.attempts}): {error_msg}")
+        if "429" in error_msg or "quota" in error_msg.lower():
+            logger.warning("API制限エラー: 次のモデルに切り替え")
+            return self.model_manager.get_next_model(model)
+        return None
+        
+    def _response_text(self, future):
+        """Future の生成結果を応答テキストに変換"""
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"Gemini CLI例外エラー: {e}")
+            return self.FAILURE_MESSAGE
+            
+        if result.ok and result.cached:
+            logger.info(f"応答キャッシュヒット: モデル={result.model}, レスポンス長={len(result.stdout)}")
+            return result.stdout.strip()
+        if result.ok and result.coalesced:
+            logger.info(f"同一要求の結果を共有: モデル={result.model}, 共有累計={self.engine.coalesce_stats['coalesced']}")
+            return result.stdout.strip()
+        if result.ok:
+            logger.info(f"Gemini CLI成功: モデル={result.model}, レスポンス長={len(result.stdout)}, {result.elapsed:.1f}秒")
+            return result.stdout.strip()
+            
         logger.error("全てのモデルで失敗")
-        return "申し訳ありません。現在システムに問題が発生しています。"
+        return self.FAILURE_MESSAGE
+        
+    def _call_gemini_cli(self, prompt, request_context=None):
+        """Gemini CLIを呼び出し（完了まで待機）"""
+        future = self.submit_generation(prompt, request_context=request_context)
+        try:
+            future.result()
+        except Exception:
+            pass
+        if request_context:
+            request_context.check()
+        return self._response_text(future)
 
 class ChatFormatter:
     """メッセージ表示フォーマットクラス"""
@@ -874,7 +1764,10 @@ class ThemeManager:
 class GeminiAutoModelChat:
     """メインアプリケーション制御クラス - 完全版"""
     
-    def __init__(self):
+    # 種別ごとの処理全体の期限（秒）: 選択・プロンプト構築・呼び出し・表示予約まで
+    REQUEST_DEADLINES = {'user': 120, 'discussion': 180, 'auto': 90}
+    
+    def __init__(self, backend=None):
         self.root = tk.Tk()
         self.root.title("Gemini CLI 多人格チャット - 完全版（18名・MBTI・ビッグ5・裏設定対応）")
         
@@ -887,9 +1780,26 @@ class GeminiAutoModelChat:
         logger.info("アプリケーション初期化開始")
         
         # 各種マネージャーの初期化
-        self.model_manager = GeminiModelManager()
+        ledger = QuotaLedger.from_env()
+        self.model_manager = GeminiModelManager(ledger)
         self.history_manager = ChatHistoryManager()
-        self.batch_processor = BatchConversationProcessor(self.model_manager)
+        self.backend = backend or create_backend_from_env()
+        self.engine = AsyncGeminiEngine(
+            self.backend,
+            max_concurrency=int(os.environ.get('GEMINI_MAX_CONCURRENCY', 4)),
+            cache=ResponseCache.from_env(),
+            ledger=ledger,
+            router=self.model_manager.router,
+            hedging=HedgingPolicy.from_env(self.model_manager.router, self.model_manager.hedge_model),
+            breakers=self.model_manager.breakers
+        )
+        self.batch_processor = BatchConversationProcessor(
+            self.model_manager, self.engine,
+            batch_mode=os.environ.get('GEMINI_BATCH_MODE', '') in ('1', 'true', 'on')
+        )
+        prompt_generator = self.batch_processor.prompt_generator
+        if prompt_generator.layout == LAYOUT_PREFIX:
+            logger.info(f"接頭辞固定配置: ペルソナ別接頭辞ハッシュ {prompt_generator.prefix_hashes()}")
         self.theme_manager = ThemeManager()
         
         # GUI状態管理
@@ -897,6 +1807,8 @@ class GeminiAutoModelChat:
         self.auto_chat_active = False
         self.processing = False
         self.conversation_queue = queue.Queue()
+        self.request_contexts = []
+        self._contexts_lock = threading.Lock()
         self.message_counter = 0
         self.typing_speed = 40
         
@@ -904,8 +1816,17 @@ class GeminiAutoModelChat:
         self.chat_history = self.history_manager.load_history()
         self.active_personas = list(PersonaDefinitions.PERSONAS.keys())
         
-        # キーワード分析用
-        self.recent_keywords = []
+        # キーワード分析用（ユーザー発言と AI 応答の時間減衰付き頻出語）
+        self.keyword_tracker = KeywordTracker()
+        
+        # 自動会話の話題選択用の会話履歴索引（保存済みスナップショット以降の発言だけを追加）
+        self.topic_index = TopicIndex.from_env(self.keyword_tracker.tokenize)
+        self.recent_topics = deque(maxlen=3)
+        if self.topic_index:
+            self.topic_index.sync(
+                (msg['message'], msg.get('persona'), self._history_key(msg))
+                for msg in self.chat_history if msg.get('type') in ('user', 'ai')
+            )
         
         # GUI構築
         self.setup_gui()
@@ -916,8 +1837,39 @@ class GeminiAutoModelChat:
         self.start_auto_chat_thread()
         self.check_conversation_queue()
         
+        # バックエンドの存在確認はウィンドウ表示後にバックグラウンドで行う
+        self.backend_available = None
+        self.root.after(100, self.start_availability_check)
+        
         logger.info("アプリケーション初期化完了")
     
+    def start_availability_check(self):
+        """バックエンド存在確認をバックグラウンドで開始（結果はディスクにキャッシュ）"""
+        def worker():
+            try:
+                result = check_backend_available(self.backend, AvailabilityCache.from_env())
+            except Exception as e:
+                result = (False, str(e), False)
+            self.root.after(0, lambda: self.on_availability_checked(*result))
+        
+        threading.Thread(target=worker, daemon=True).start()
+    
+    def on_availability_checked(self, available, info, cached):
+        """存在確認の結果をステータスバーへ反映"""
+        self.backend_available = available
+        if available:
+            source = "キャッシュ" if cached else "確認"
+            logger.info(f"バックエンド確認成功 ({self.backend.name}, {source}): {info}")
+            return
+        error_msg = f"❌ バックエンド({self.backend.name})が利用できません: {info}"
+        if self.backend.name == "cli" and not self.backend.is_installed():
+            error_msg = "❌ Gemini CLIがインストールされていません（npm install -g @google/gemini-cli）"
+        elif self.backend.name == "cli":
+            # 実行ファイルはあるが確認に失敗（応答なし・異常終了など）
+            error_msg = f"❌ Gemini CLIの確認に失敗しました: {info}"
+        logger.error(f"{error_msg} - {info}")
+        self.update_status(error_msg)
+    
     def setup_dpi_awareness(self):
         """DPI認識設定"""
         try:
@@ -1081,6 +2033,14 @@ class GeminiAutoModelChat:
         )
         self.send_button.pack()
         
+        self.cancel_button = tk.Button(
+            button_frame, text="⏹ キャンセル", command=self.cancel_generation,
+            font=('Courier New', self.font_size - 2),
+            bg='#004000', fg='#00FF00', activebackground='#006000',
+            activeforeground='#00FF00'
+        )
+        self.cancel_button.pack(fill=tk.X, pady=(3, 0))
+        
     def setup_status_bar(self):
         """ステータスバーの設定"""
         self.status_bar = ttk.Label(
@@ -1104,10 +2064,11 @@ class GeminiAutoModelChat:
         self.message_entry.configure(
             bg=theme['entry_bg'], fg=theme['entry_fg'], insertbackground=theme['entry_fg']
         )
-        self.send_button.configure(
-            bg=theme['button_bg'], fg=theme['button_fg'],
-            activebackground=theme['select_bg'], activeforeground=theme['select_fg']
-        )
+        for button in (self.send_button, self.cancel_button):
+            button.configure(
+                bg=theme['button_bg'], fg=theme['button_fg'],
+                activebackground=theme['select_bg'], activeforeground=theme['select_fg']
+            )
         
     def on_theme_change(self, event=None):
         """テーマ変更時の処理"""
@@ -1125,6 +2086,7 @@ class GeminiAutoModelChat:
             self.persona_listbox.configure(font=('Courier New', self.font_size - 1))
             self.message_entry.configure(font=('Courier New', self.font_size))
             self.send_button.configure(font=('Courier New', self.font_size - 2))
+            self.cancel_button.configure(font=('Courier New', self.font_size - 2))
             logger.info(f"フォントサイズ変更: {new_size}")
         except ValueError:
             pass
@@ -1147,6 +2109,9 @@ class GeminiAutoModelChat:
             
         logger.info(f"ユーザーメッセージ送信: '{message[:50]}...'")
         
+        # 進行中の自動会話は破棄し、サブプロセスも停止
+        self.cancel_requests('auto')
+        
         # ユーザーメッセージを表示
         self.add_message_to_display(ChatFormatter.format_user_message(message))
         
@@ -1154,23 +2119,73 @@ class GeminiAutoModelChat:
         self.message_entry.delete('1.0', tk.END)
         
         # 履歴に追加
+        timestamp = datetime.now()
         self.chat_history.append({
-            'type': 'user', 'message': message, 'timestamp': datetime.now()
+            'type': 'user', 'message': message, 'timestamp': timestamp
         })
         
         # キーワード分析
-        self._analyze_keywords(message)
+        self._analyze_keywords(message, timestamp=timestamp)
         
         # 動的バッチ処理でAI応答生成
         self.process_ai_responses(message)
         
-    def _analyze_keywords(self, message):
-        """キーワード分析"""
-        words = re.findall(r'[一-龠ぁ-んァ-ンa-zA-Z]{2,}', message)
-        self.recent_keywords.extend(words)
-        if len(self.recent_keywords) > 50:
-            self.recent_keywords = self.recent_keywords[-50:]
-        logger.debug(f"キーワード更新: {words}")
+    def begin_request(self, kind):
+        """種別（'user' / 'discussion' / 'auto'）の RequestContext を作成し登録
+        
+        生成完了後も時間差表示が残るため、登録は期限切れまで保持する。
+        """
+        request_context = RequestContext(self.REQUEST_DEADLINES[kind], label=kind)
+        with self._contexts_lock:
+            self.request_contexts = [
+                (registered_kind, registered) for registered_kind, registered in self.request_contexts
+                if not registered.expired
+            ]
+            self.request_contexts.append((kind, request_context))
+        return request_context
+                
+    def cancel_requests(self, *kinds):
+        """指定種別（省略時は全種別）の処理と表示予約をキャンセル"""
+        with self._contexts_lock:
+            targets = [
+                request_context for kind, request_context in self.request_contexts
+                if not kinds or kind in kinds
+            ]
+            self.request_contexts = [
+                (kind, request_context) for kind, request_context in self.request_contexts
+                if request_context not in targets
+            ]
+        for request_context in targets:
+            request_context.cancel()
+        return len(targets)
+        
+    def cancel_generation(self):
+        """キャンセルボタン: 進行中の生成と表示予約をすべて中止"""
+        count = self.cancel_requests()
+        self.update_status("⏹ 生成をキャンセルしました" if count else "⏹ キャンセル対象の処理はありません")
+        logger.info(f"ユーザー操作によるキャンセル: {count}件")
+        
+    def schedule_display(self, conversation, delay_ms, request_context=None):
+        """時間差表示を予約（表示時点でキャンセル済みなら破棄）"""
+        def enqueue():
+            if request_context is None or not request_context.cancelled:
+                self.conversation_queue.put(conversation)
+        self.root.after(int(delay_ms), enqueue)
+        
+    def _analyze_keywords(self, message, source='user', persona=None, timestamp=None):
+        """キーワード分析と話題索引の更新（source: 'user' / 'ai'）"""
+        words = self.keyword_tracker.add_text(message, source)
+        logger.debug(f"キーワード更新 ({source}): {words}")
+        if self.topic_index:
+            self.topic_index.add(message, persona, self._history_key({'timestamp': timestamp}))
+    
+    @staticmethod
+    def _history_key(msg):
+        """履歴項目の時刻を索引の再開位置用の文字列に"""
+        timestamp = msg.get('timestamp')
+        if isinstance(timestamp, datetime):
+            return timestamp.isoformat()
+        return timestamp
         
     def start_discussion(self):
         """議論モード開始"""
@@ -1189,17 +2204,19 @@ class GeminiAutoModelChat:
             'color': '#FFFF00', 'timestamp': datetime.now(), 'persona': 'system'
         })
         
-        # 動的議論開始
-        threading.Thread(target=self._dynamic_discussion_thread, args=(message,), daemon=True).start()
+        # 動的議論開始（進行中の自動会話は破棄）
+        self.cancel_requests('auto')
+        request_context = self.begin_request('discussion')
+        threading.Thread(target=self._dynamic_discussion_thread, args=(message, request_context), daemon=True).start()
         
-    def _dynamic_discussion_thread(self, topic):
+    def _dynamic_discussion_thread(self, topic, request_context):
         """動的議論スレッド処理"""
         try:
             logger.info(f"動的議論スレッド開始: {topic}")
             context = self.create_context()
             
             # 全ペルソナの議論参加を動的決定
-            discussions = []
+            requests = []
             for persona_name in self.active_personas:
                 try:
                     # 興味レベル分析
@@ -1221,30 +2238,23 @@ class GeminiAutoModelChat:
 興味レベル（{interest_level}）に応じて発言の詳しさを調整してください。
 """
                     
-                    response = self.batch_processor._call_gemini_cli(discussion_prompt)
-                    
-                    discussions.append({
-                        'persona': persona_name,
-                        'message': response.strip(),
-                        'timestamp': datetime.now(),
-                        'interest_level': interest_level
-                    })
-                    
-                    logger.debug(f"動的議論応答生成: {persona_name} ({interest_level})")
-                    time.sleep(random.uniform(0.5, 1.5))
+                    requests.append((persona_name, discussion_prompt, interest_level))
                     
                 except Exception as e:
-                    logger.error(f"動的議論応答生成エラー ({persona_name}): {e}")
+                    logger.error(f"動的議論プロンプト生成エラー ({persona_name}): {e}")
                     
+            discussions = self.batch_processor.generate_concurrently(requests, request_context=request_context)
+            
             # 興味度順でソート（高い興味のペルソナから発言）
             discussions.sort(key=lambda x: {"high_interest": 3, "medium_interest": 2, "low_interest": 1}[x['interest_level']], reverse=True)
             
             # 応答を時間差で表示
             for i, discussion in enumerate(discussions):
                 delay = random.uniform(1.0, 3.0) * (i + 1)
-                self.root.after(int(delay * 1000), 
-                               lambda d=discussion: self.conversation_queue.put(d))
+                self.schedule_display(discussion, delay * 1000, request_context)
                                
+        except RequestCancelled as e:
+            logger.info(f"動的議論を中断: {e}")
         except Exception as e:
             logger.error(f"動的議論スレッドエラー: {e}")
             
@@ -1255,12 +2265,13 @@ class GeminiAutoModelChat:
             
         self.processing = True
         self.update_status("🧠 AI応答を動的生成中...")
+        request_context = self.begin_request('user')
         
         def generate_responses():
             try:
                 context = self.create_context()
                 conversations = self.batch_processor.generate_batch_conversation(
-                    context, user_message, self.active_personas
+                    context, user_message, self.active_personas, request_context
                 )
                 
                 # 興味度に応じた時間差表示
@@ -1275,9 +2286,10 @@ class GeminiAutoModelChat:
                     interest_level = conv.get('interest_level', 'medium_interest')
                     delay = base_delay[interest_level] + random.uniform(0.5, 1.5) * i
                     
-                    self.root.after(int(delay * 1000), 
-                                   lambda c=conv: self.conversation_queue.put(c))
+                    self.schedule_display(conv, delay * 1000, request_context)
                     
+            except RequestCancelled as e:
+                logger.info(f"AI応答生成を中断: {e}")
             except Exception as e:
                 logger.error(f"動的AI応答生成エラー: {e}")
                 self.root.after(0, lambda: self.update_status("❌ エラーが発生しました"))
@@ -1340,6 +2352,8 @@ class GeminiAutoModelChat:
             'message': conversation['message'], 'timestamp': conversation['timestamp'],
             'interest_level': interest_level
         })
+        self._analyze_keywords(conversation['message'], source='ai', persona=conversation['persona'],
+                               timestamp=conversation['timestamp'])
         
         self.history_manager.save_history(self.chat_history)
         self.update_status("✅ 準備完了")
@@ -1492,16 +2506,14 @@ class GeminiAutoModelChat:
         
     def generate_dynamic_keyword_drill(self):
         """動的キーワード深掘り会話を生成"""
-        if not self.recent_keywords:
+        top_keywords = self.keyword_tracker.top(1)
+        if not top_keywords:
             return
             
+        request_context = self.begin_request('auto')
         try:
             # 頻出キーワードを選択
-            keyword_counts = Counter(self.recent_keywords)
-            if not keyword_counts:
-                return
-                
-            keyword = keyword_counts.most_common(1)[0][0]
+            keyword = top_keywords[0][0]
             
             # キーワードに最も興味を持ちそうなペルソナを選択
             interested_personas = []
@@ -1527,14 +2539,14 @@ class GeminiAutoModelChat:
             
             question_prompt += f"\n\n【特別指示】「{keyword}」について、{responder}さんに質問してください。自然な会話として。"
             
-            question_response = self.batch_processor._call_gemini_cli(question_prompt)
+            question_response = self.batch_processor._call_gemini_cli(question_prompt, request_context)
             
             # 回答者の動的プロンプト
             answer_prompt = self.batch_processor.prompt_generator.generate_dynamic_prompt(
                 responder, f"{asker}からの質問: {question_response}", context, "high_interest"
             )
             
-            answer_response = self.batch_processor._call_gemini_cli(answer_prompt)
+            answer_response = self.batch_processor._call_gemini_cli(answer_prompt, request_context)
             
             # 時間差で表示
             conversations = [
@@ -1554,15 +2566,18 @@ class GeminiAutoModelChat:
             
             for i, conv in enumerate(conversations):
                 delay = (i + 1) * 3000  # 3秒間隔
-                self.root.after(delay, lambda c=conv: self.conversation_queue.put(c))
+                self.schedule_display(conv, delay, request_context)
             
             logger.info(f"動的キーワード深掘り生成: {keyword} ({asker} -> {responder})")
             
+        except RequestCancelled as e:
+            logger.info(f"キーワード深掘りを中断: {e}")
         except Exception as e:
             logger.error(f"動的キーワード深掘りエラー: {e}")
             
     def generate_dynamic_auto_conversation(self):
         """動的自動会話を生成"""
+        request_context = self.begin_request('auto')
         try:
             topics = [
                 "最近の天気について", "今日のニュース", "おすすめの映画",
@@ -1570,33 +2585,28 @@ class GeminiAutoModelChat:
                 "料理のレシピ", "旅行の思い出", "将来の夢", "テクノロジーの進歩",
                 "音楽の話", "スポーツ", "アニメ・漫画"
             ]
-            topic = random.choice(topics)
+            # 会話履歴の話題索引から最近の話題を選び、その語を多く使ったペルソナを先頭に据える
+            term = self.topic_index.pick(exclude=self.recent_topics) if self.topic_index else None
+            if term:
+                self.recent_topics.append(term)
+                topic = f"{term}について"
+                leads = self.topic_index.interested(term, k=1, candidates=self.active_personas)
+            else:
+                topic = random.choice(topics)
+                leads = []
             
-            # 興味度に基づく参加者選択
-            participants = []
-            for persona_name in self.active_personas:
-                interest_level = self.batch_processor.prompt_generator.analyze_interest_level(
-                    persona_name, topic
+            # 残りは親和度に基づいて選択（合計で最低1名、最大3名）
+            prompt_generator = self.batch_processor.prompt_generator
+            participants = [
+                (persona_name, prompt_generator.analyze_interest_level(persona_name, topic))
+                for persona_name in leads + self.batch_processor.affinity.select(
+                    topic, [name for name in self.active_personas if name not in leads],
+                    expected=1.5, top_k=3 - len(leads), minimum=0 if leads else 1
                 )
+            ]
                 
-                participation_probability = {
-                    "high_interest": 0.6,
-                    "medium_interest": 0.3,
-                    "low_interest": 0.1
-                }
-                
-                if random.random() < participation_probability[interest_level]:
-                    participants.append((persona_name, interest_level))
-            
-            # 最低1名、最大3名に調整
-            if not participants:
-                random_persona = random.choice(self.active_personas)
-                participants = [(random_persona, "medium_interest")]
-            elif len(participants) > 3:
-                participants = participants[:3]
-                
-            # 各参加者の発言生成
-            conversations = []
+            # 各参加者の発言を並列生成
+            requests = []
             context = self.create_context()
             
             for persona_name, interest_level in participants:
@@ -1606,29 +2616,26 @@ class GeminiAutoModelChat:
                     )
                     
                     prompt += f"\n\n【特別指示】「{topic}」について自発的に発言してください。自然な会話として。"
-                    
-                    response = self.batch_processor._call_gemini_cli(prompt)
-                    
-                    conversations.append({
-                        'persona': persona_name,
-                        'message': response.strip(),
-                        'timestamp': datetime.now(),
-                        'interest_level': interest_level
-                    })
+                    requests.append((persona_name, prompt, interest_level))
                     
                 except Exception as e:
                     logger.error(f"動的自動会話生成エラー ({persona_name}): {e}")
                     
+            conversations = self.batch_processor.generate_concurrently(
+                requests, policy=POLICY_FASTEST, request_context=request_context
+            )
+            
             # 興味度順で時間差表示
             conversations.sort(key=lambda x: {"high_interest": 3, "medium_interest": 2, "low_interest": 1}[x['interest_level']], reverse=True)
             
             for i, conv in enumerate(conversations):
                 delay = random.uniform(2.0, 5.0) * (i + 1)
-                self.root.after(int(delay * 1000), 
-                               lambda c=conv: self.conversation_queue.put(c))
+                self.schedule_display(conv, delay * 1000, request_context)
                                
             logger.info(f"動的自動会話生成: {topic} ({[c['persona'] for c in conversations]})")
             
+        except RequestCancelled as e:
+            logger.info(f"自動会話を中断: {e}")
         except Exception as e:
             logger.error(f"動的自動会話生成エラー: {e}")
             
@@ -1637,7 +2644,10 @@ class GeminiAutoModelChat:
         if messagebox.askyesno("確認", "会話履歴をクリアしますか？"):
             self.chat_history.clear()
             self.history_manager.clear_history()
-            self.recent_keywords.clear()
+            self.keyword_tracker.clear()
+            if self.topic_index:
+                self.topic_index.clear()
+                self.topic_index.save()
             
             self.chat_display.configure(state=tk.NORMAL)
             self.chat_display.delete('1.0', tk.END)
@@ -1660,25 +2670,83 @@ class GeminiAutoModelChat:
             logger.info("アプリケーション中断")
         finally:
             self.history_manager.save_history(self.chat_history)
+            if self.topic_index:
+                self.topic_index.save()
+            self.engine.shutdown()
             logger.info("アプリケーション終了")
 
+def benchmark_prompt_generation(repeats=200):
+    """全ペルソナ×全興味レベルのプロンプト生成時間を、テンプレート未作成時とメモ化後で比較
+    
+    戻り値: (未作成時の1回あたり秒数, メモ化後の1回あたり秒数)
+    """
+    generator = DynamicPromptGenerator(budgeter=PromptBudgeter())
+    combos = [(name, level) for name in PersonaDefinitions.PERSONAS for level in DynamicPromptGenerator.DETAIL_SETTINGS]
+    context = "みゆき: 最近のAIってすごいよね\nさやか: マーケティングにも使えそう"
+    message = "週末に何をして過ごしますか？"
+    
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for name, level in combos:
+            generator.invalidate_templates()
+            generator.generate_dynamic_prompt(name, message, context, level)
+    cold = (time.perf_counter() - start) / (repeats * len(combos))
+    
+    generator.precompile_templates()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for name, level in combos:
+            generator.generate_dynamic_prompt(name, message, context, level)
+    warm = (time.perf_counter() - start) / (repeats * len(combos))
+    return cold, warm
+
+def benchmark_interest_scoring(persona_count=2000, topics_per_persona=10, messages=50, seed=0):
+    """興味度判定を、従来の二重ループとオートマトン（メモ化無し）で比較
+    
+    合成した persona_count 名分の興味分野で、各メッセージの全ペルソナの一致数を求める。
+    戻り値: (二重ループの1メッセージあたり秒数, オートマトンの1メッセージあたり秒数)
+    """
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice("アイウエオカキクケコサシスセソタチツテト") for _ in range(rng.randint(2, 4)))
+                  for _ in range(persona_count * 3)]
+    personas = {f"p{i}": {"interest_topics": rng.sample(vocabulary, topics_per_persona), "keywords": []}
+                for i in range(persona_count)}
+    texts = [''.join(rng.choice(vocabulary) + "、" for _ in range(30)) for _ in range(messages)]
+    
+    start = time.perf_counter()
+    expected = []
+    for text in texts:
+        expected.append({name: sum(1 for topic in persona["interest_topics"] if topic.lower() in text.lower())
+                         for name, persona in personas.items()})
+    nested = (time.perf_counter() - start) / messages
+    
+    matcher = PersonaInterestMatcher(personas, cache_size=0)
+    matcher.scan("")  # オートマトン構築は計測外
+    start = time.perf_counter()
+    actual = []
+    for text in texts:
+        scores = matcher.scan(text)
+        actual.append({name: scores.get(name, {}).get('topics', 0) for name in personas})
+    automaton = (time.perf_counter() - start) / messages
+    
+    assert actual == expected, "オートマトンと二重ループの結果が一致しません"
+    return nested, automaton
+
 def main():
     """メイン関数"""
-    try:
-        # Gemini CLIの存在確認
-        result = subprocess.run(['gemini', '--version'], 
-                              capture_output=True, check=True)
-        logger.info(f"Gemini CLI確認成功: {result.stdout.decode().strip()}")
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        error_msg = "エラー: Gemini CLIがインストールされていません。\n" \
-                   "インストール方法: npm install -g @google/gemini-cli"
-        logger.error(error_msg)
-        print(error_msg)
-        sys.exit(1)
-        
-    # アプリケーション実行
-    app = GeminiAutoModelChat()
+    # バックエンド（Gemini CLI / 常駐ワーカー / スタブ）の存在確認は起動後に非同期で行う
+    app = GeminiAutoModelChat(create_backend_from_env())
     app.run()
 
 if __name__ == "__main__":
-    main()
+    if '--bench-prompts' in sys.argv:
+        cold, warm = benchmark_prompt_generation()
+        print(f"プロンプト生成（{len(PersonaDefinitions.PERSONAS)}名×3レベル）: "
+              f"テンプレート無し {cold * 1e6:.1f}µs / メモ化後 {warm * 1e6:.1f}µs（{cold / warm:.1f}倍）")
+    elif '--bench-interest' in sys.argv:
+        for persona_count in (18, 200, 2000):
+            nested, automaton = benchmark_interest_scoring(persona_count)
+            print(f"興味度判定（{persona_count}名×10分野）: 二重ループ {nested * 1e3:.2f}ms / "
+                  f"オートマトン {automaton * 1e3:.2f}ms（{nested / automaton:.1f}倍）")
+    else:
+        main()
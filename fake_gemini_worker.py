@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+オフライン検証用の疑似Geminiワーカー
+GeminiWorkerPool と同じ JSON Lines プロトコルで応答する（実際の gemini CLI を使う場合は gemini_cli_worker.py）
+
+使用例:
+    GEMINI_WORKER_CMD="python fake_gemini_worker.py --latency 0.2 --quota-model gemini-2.5-flash" python chatter5.py
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+
+
+def build_reply(model, prompt):
+    """プロンプト先頭からペルソナ名を拾って擬似応答を作る"""
+    speaker = "ペルソナ"
+    marker = "あなたは"
+    if marker in prompt:
+        rest = prompt.split(marker, 1)[1]
+        speaker = rest.split("（", 1)[0].strip("「」 \n") or speaker
+    return f"（{model}）{speaker}です。なるほど、その話題は面白いですね！"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="疑似Geminiワーカー")
+    parser.add_argument('--latency', type=float, default=0.0, help="1応答あたりの待ち時間（秒）")
+    parser.add_argument('--jitter', type=float, default=0.0, help="待ち時間の揺らぎ（秒）")
+    parser.add_argument('--startup-delay', type=float, default=0.0, help="起動時の待ち時間（秒）")
+    parser.add_argument('--quota-model', action='append', default=[],
+                        help="429エラーを返すモデル（複数指定可）")
+    parser.add_argument('--exit-after', type=int, default=0, help="指定件数処理後に異常終了")
+    args = parser.parse_args()
+
+    time.sleep(args.startup_delay)
+
+    handled = 0
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        request = json.loads(line)
+        request_id = request.get('id')
+
+        if request.get('type') == 'ping':
+            response = {'id': request_id, 'returncode': 0, 'stdout': 'pong', 'stderr': ''}
+        else:
+            model = request.get('model', '')
+            time.sleep(max(0.0, args.latency + random.uniform(-args.jitter, args.jitter)))
+            if model in args.quota_model:
+                response = {'id': request_id, 'returncode': 1, 'stdout': '',
+                            'stderr': '429 Too Many Requests: Quota exceeded'}
+            else:
+                response = {'id': request_id, 'returncode': 0,
+                            'stdout': build_reply(model, request.get('prompt', '')), 'stderr': ''}
+
+        sys.stdout.write(json.dumps(response, ensure_ascii=False) + '\n')
+        sys.stdout.flush()
+
+        handled += 1
+        if args.exit_after and handled >= args.exit_after:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
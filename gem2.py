@@ -1,7 +1,5 @@
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, ttk
-import subprocess
-import threading
 import queue
 import time
 import json
@@ -9,7 +7,12 @@ import os
 import random
 import re
 from datetime import datetime
-from collections import Counter
+from collections import Counter, deque
+
+from gemini_backend import (LAYOUT_PREFIX, POLICY_FASTEST, POLICY_QUALITY, AdaptiveModelRouter, AsyncGeminiEngine,
+                            CircuitBreakers, HedgingPolicy, PromptBudgeter, PromptSection, QuotaLedger,
+                            QuotaRateLimiter, RequestContext, ResponseCache, TopicIndex, create_backend_from_env,
+                            prefix_hash, prompt_layout_from_env)
 
 class GeminiModelManager:
     """Geminiモデル管理クラス"""
@@ -21,6 +24,7 @@ class GeminiModelManager:
                 "description": "最高性能（制限：25回/日）",
                 "daily_limit": 25,
                 "minute_limit": 5,
+                "prompt_budget": 4000,
                 "priority": 1,
                 "fallback_chain": ["gemini-2.5-flash", "gemini-1.5-flash"]
             },
@@ -29,6 +33,7 @@ class GeminiModelManager:
                 "description": "高速・高制限（1500回/日）",
                 "daily_limit": 1500,
                 "minute_limit": 15,
+                "prompt_budget": 6000,
                 "priority": 2,
                 "fallback_chain": ["gemini-1.5-flash"]
             },
@@ -37,6 +42,7 @@ class GeminiModelManager:
                 "description": "安定・高制限（1500回/日）",
                 "daily_limit": 1500,
                 "minute_limit": 15,
+                "prompt_budget": 6000,
                 "priority": 3,
                 "fallback_chain": ["gemini-1.5-pro"]
             },
@@ -45,14 +51,29 @@ class GeminiModelManager:
                 "description": "バランス型（50回/日）",
                 "daily_limit": 50,
                 "minute_limit": 5,
+                "prompt_budget": 4000,
                 "priority": 4,
                 "fallback_chain": ["gemini-2.5-flash", "gemini-1.5-flash"]
             }
         }
         
-        self.current_model = "gemini-2.5-pro"
         self.error_history = {}
         self.last_error_time = {}
+        # 送信前に参照する分間・日次の上限
+        self.rate_limiter = QuotaRateLimiter(self.models)
+        # 障害中のモデルを呼び出さずに飛ばすサーキットブレーカー
+        self.breakers = CircuitBreakers.from_env()
+        # 実測レイテンシ・成功率に基づくリクエストごとのモデル選択
+        self.router = AdaptiveModelRouter(
+            {model_id: info["priority"] for model_id, info in self.models.items()},
+            rate_limiter=self.rate_limiter,
+            breakers=self.breakers
+        )
+        # 再起動をまたいで本日の呼び出し・エラーを引き継ぐ台帳
+        self.ledger = QuotaLedger.from_env()
+        if self.ledger:
+            self._restore_from_ledger()
+        self.current_model = self.get_recommended_model()
         
     def get_model_info(self, model_id):
         """モデル情報を取得"""
@@ -72,7 +93,9 @@ class GeminiModelManager:
             "RESOURCE_EXHAUSTED",
             "404",
             "not found",
-            "NOT_FOUND"
+            "NOT_FOUND",
+            "CIRCUIT_OPEN",
+            "RATE_LIMITED"
         ]
         return any(indicator in str(error_message) for indicator in fallback_indicators)
     
@@ -88,29 +111,60 @@ class GeminiModelManager:
         return None
     
     def _is_model_available(self, model_id):
-        """モデルが利用可能かチェック"""
-        last_error = self.last_error_time.get(model_id, 0)
-        return (time.time() - last_error) > 300
+        """モデルが利用可能かチェック（冷却中・サーキットブレーカーが閉じていなければ不可）"""
+        return self.router.is_available(model_id)
+    
+    def _restore_from_ledger(self):
+        """台帳から本日のエラー状況と利用回数を復元"""
+        for model_id in self.models:
+            errors = self.ledger.failures(model_id)
+            if errors:
+                self.error_history[model_id] = errors
+                self.last_error_time[model_id] = self.ledger.last_error_time(model_id)
+                self.router.restore_failures(model_id, errors, self.last_error_time[model_id])
+        self.rate_limiter.restore(self.ledger)
+    
+    def _is_exhausted_today(self, model_id):
+        """台帳上、本日のクォータを使い切っているか"""
+        if not self.ledger:
+            return False
+        return self.ledger.is_exhausted(model_id, self.models[model_id]["daily_limit"])
+    
+    def get_breaker_state(self, model_id):
+        """サーキットブレーカーの表示用状態（無効時は None）"""
+        return self.breakers.describe(model_id) if self.breakers else None
+    
+    def get_remaining_budget(self, model_id):
+        """モデルの残り回数 {'minute': n, 'daily': n} を取得"""
+        return self.rate_limiter.remaining(model_id)
     
     def record_error(self, model_id, error_message):
         """エラーを記録"""
         self.error_history[model_id] = self.error_history.get(model_id, 0) + 1
         self.last_error_time[model_id] = time.time()
     
-    def get_recommended_model(self):
-        """推奨モデルを取得"""
-        available_models = [
-            (model_id, info) for model_id, info in self.models.items()
-            if self._is_model_available(model_id)
-        ]
-        
-        if not available_models:
-            return "gemini-1.5-flash"
-        
-        best_model = min(available_models, 
-                        key=lambda x: (x[1]["priority"], 
-                                     self.error_history.get(x[0], 0)))
-        return best_model[0]
+    def switch_to_fallback(self, failed_model, error_message):
+        """失敗したモデルのエラーを記録し、その fallback_chain の次のモデルへ切り替える
+        
+        failed_model はエンジンが実際に呼び出したモデル（レート制限の振り替え・ヘッジ・遮断中の省略で
+        current_model と異なることがある）。冷却中・遮断中のモデルは飛ばす。切り替え先がなければ None。
+        エンジンのイベントループから呼ばれるため、GUI には触れない。
+        """
+        self.record_error(failed_model, error_message)
+        next_model = self.get_next_model(failed_model)
+        if next_model:
+            self.current_model = next_model
+        return next_model
+    
+    def get_recommended_model(self, policy=POLICY_QUALITY):
+        """推奨モデルを取得
+        
+        POLICY_QUALITY: 直近 p95 が10秒以内のモデルから最高品質（ユーザー発言向け）
+        POLICY_FASTEST: クォータ内で期待レイテンシ最小（自動会話向け）
+        """
+        exhausted = [model_id for model_id in self.models if self._is_exhausted_today(model_id)]
+        model_id = self.router.choose(policy, exclude=exhausted)
+        return model_id or "gemini-1.5-flash"
 
 class PersonaDefinitions:
     """AIペルソナの定義クラス"""
@@ -452,31 +506,7 @@ class ChatHistoryManager:
 class BatchConversationProcessor:
     """バッチ会話処理クラス"""
     
-    def __init__(self, personas):
-        self.personas = personas
-        
-    def create_batch_prompt(self, user_message, history_text):
-        """バッチ処理用プロンプトを作成"""
-        prompt = f"""以下の8人のキャラクターが会話に参加します。
-ユーザーの発言に対して、各キャラクターの性格に基づいて自然に応答してください。
-
-キャラクター設定:
-"""
-        
-        for name, persona in self.personas.items():
-            prompt += f"""
-【{persona['name']}】{persona['age']}歳・{persona['gender']}・{persona['occupation']}
-性格: {persona['personality']}
-話し方: {persona['speaking_style']}
-"""
-        
-        prompt += f"""
-これまでの会話履歴:
-{history_text}
-
-新しいユーザーの発言: "{user_message}"
-
-指示:
+    INSTRUCTIONS = """指示:
 1. 各キャラクターの性格を維持してください
 2. 全員が必ず反応する必要はありません（興味を持った人だけ）
 3. 自然な会話の流れを作ってください
@@ -491,39 +521,121 @@ class BatchConversationProcessor:
 
 （発言しないキャラクターは出力しないでください）
 """
-        
-        return prompt
+    
+    def __init__(self, personas, budgeter=None, layout=None):
+        self.personas = personas
+        self.budgeter = budgeter or PromptBudgeter.from_env()
+        # LAYOUT_PREFIX では人物一覧と指示を先頭に集め、毎回同一の接頭辞にする
+        self.layout = layout or prompt_layout_from_env()
+        self._roster = None
+        
+    @property
+    def roster(self):
+        """キャラクター設定一覧（ペルソナは固定のため初回のみ組み立てる）"""
+        if self._roster is None:
+            roster = f"""以下の8人のキャラクターが会話に参加します。
+ユーザーの発言に対して、各キャラクターの性格に基づいて自然に応答してください。
+
+キャラクター設定:
+"""
+            for name, persona in self.personas.items():
+                roster += f"""
+【{persona['name']}】{persona['age']}歳・{persona['gender']}・{persona['occupation']}
+性格: {persona['personality']}
+話し方: {persona['speaking_style']}
+"""
+            self._roster = roster
+        return self._roster
+    
+    def prefix_hash(self):
+        """接頭辞固定配置での静的接頭辞（人物一覧＋指示）のハッシュ"""
+        return prefix_hash(self.roster + "\n" + self.INSTRUCTIONS + "\n")
+        
+    def create_batch_prompt(self, user_message, history_text, model=None):
+        """バッチ処理用プロンプトと削減報告を作成（model のトークン上限を超える場合は古い履歴から削る）"""
+        persona = PromptSection('persona', self.roster + "\n", priority=90, trim=None)
+        context = PromptSection('context', f"{history_text}\n\n", priority=10, trim='head',
+                                header="これまでの会話履歴:\n")
+        message = PromptSection('user_message', f'新しいユーザーの発言: "{user_message}"\n\n', priority=100, trim=None)
+        
+        if self.layout == LAYOUT_PREFIX:
+            # 指示の後に可変部分を置くため、区切りの改行を補う
+            instructions = PromptSection('instructions', self.INSTRUCTIONS + "\n", priority=80, trim=None)
+            sections = [persona, instructions, context, message]
+        else:
+            instructions = PromptSection('instructions', self.INSTRUCTIONS, priority=80, trim=None)
+            sections = [persona, context, message, instructions]
+        return self.budgeter.build(sections, model, "バッチ")
     
     def parse_batch_response(self, response):
         """バッチレスポンスを解析"""
         conversations = []
-        lines = response.split('\n')
-        
-        current_speaker = None
-        current_message = []
-        
-        for line in lines:
-            line = line.strip()
-            if line.startswith('【') and line.endswith('】'):
-                if current_speaker and current_message:
-                    conversations.append({
-                        'speaker': current_speaker,
-                        'message': '\n'.join(current_message).strip()
-                    })
-                
-                current_speaker = line[1:-1]
-                current_message = []
-            elif line and current_speaker:
-                current_message.append(line)
-        
-        if current_speaker and current_message:
-            conversations.append({
-                'speaker': current_speaker,
-                'message': '\n'.join(current_message).strip()
-            })
-        
+        parser = IncrementalBatchParser(conversations.append)
+        parser.feed(response)
+        parser.close()
         return conversations
 
+class IncrementalBatchParser:
+    """【キャラクター名】ブロック形式の逐次解析クラス
+    
+    受信したテキストを feed() で渡すと、次の見出しが現れてブロックが閉じた時点で
+    on_message({'speaker': ..., 'message': ...}) を呼び出す。
+    フォールバックで別モデルの出力が始まる際は restart() を呼ぶ。前の試行で発言済みの
+    キャラクターのブロックは以降通知しない（同じキャラクターが二度話さないように）。
+    """
+    
+    def __init__(self, on_message):
+        self.on_message = on_message
+        self.buffer = ""
+        self.current_speaker = None
+        self.current_message = []
+        self.message_count = 0
+        self.spoken = set()
+        self.suppressed = set()
+    
+    def feed(self, text):
+        """受信テキストを追加（改行までたまった行から処理）"""
+        self.buffer += text
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self._handle_line(line)
+    
+    def close(self):
+        """ストリーム終端：残りの行と最後のブロックを確定"""
+        if self.buffer:
+            self._handle_line(self.buffer)
+            self.buffer = ""
+        self._emit()
+        self.current_speaker = None
+        self.current_message = []
+    
+    def restart(self):
+        """新しい試行の開始：途中の行とブロックを捨て、発言済みのキャラクターを以降抑止"""
+        self.buffer = ""
+        self.current_speaker = None
+        self.current_message = []
+        self.suppressed = set(self.spoken)
+    
+    def _handle_line(self, line):
+        line = line.strip()
+        if line.startswith('【') and line.endswith('】'):
+            self._emit()
+            self.current_speaker = line[1:-1]
+            self.current_message = []
+        elif line and self.current_speaker:
+            self.current_message.append(line)
+    
+    def _emit(self):
+        if self.current_speaker and self.current_message:
+            if self.current_speaker in self.suppressed:
+                return
+            self.spoken.add(self.current_speaker)
+            self.message_count += 1
+            self.on_message({
+                'speaker': self.current_speaker,
+                'message': '\n'.join(self.current_message).strip()
+            })
+
 class ThemeManager:
     """テーマ管理クラス"""
     
@@ -572,6 +684,10 @@ class ThemeManager:
         return self.themes[self.current_theme]
 
 class GeminiAutoModelChat:
+    BATCH_TIMEOUT = 120  # バッチ生成1回あたりの上限（秒）
+    BATCH_DEADLINE = 180  # フォールバックを含めたバッチ生成全体の上限（秒）
+    MAX_ATTEMPTS = 4
+    
     def __init__(self, root):
         self.root = root
         self.root.title("Gemini CLI 自動モデル切り替えチャット（女性ペルソナ対応版）")
@@ -580,10 +696,29 @@ class GeminiAutoModelChat:
         # 基本設定
         self.personas = PersonaDefinitions.PERSONAS
         self.history_manager = ChatHistoryManager()
-        self.batch_processor = BatchConversationProcessor(self.personas)
+        self.model_manager = GeminiModelManager()
+        self.batch_processor = BatchConversationProcessor(
+            self.personas,
+            PromptBudgeter.from_env({
+                model_id: info["prompt_budget"] for model_id, info in self.model_manager.models.items()
+            })
+        )
         self.theme_manager = ThemeManager()
         self.chat_formatter = ChatFormatter()
-        self.model_manager = GeminiModelManager()
+        self.engine = AsyncGeminiEngine(
+            create_backend_from_env(),
+            cache=ResponseCache.from_env(),
+            rate_limiter=self.model_manager.rate_limiter,
+            ledger=self.model_manager.ledger,
+            router=self.model_manager.router,
+            # GEMINI_HEDGE=1 のとき、遅い応答を fallback_chain の次のモデルへ重複送信
+            hedging=HedgingPolicy.from_env(self.model_manager.router, self.model_manager.get_next_model),
+            breakers=self.model_manager.breakers
+        )
+        self.current_future = None
+        # 進行中のバッチの期限・キャンセル（自動会話中はユーザー発言で中断できる）
+        self.current_context = None
+        self.processing_auto = False
         
         # キューとフラグ
         self.output_queue = queue.Queue()
@@ -592,6 +727,9 @@ class GeminiAutoModelChat:
         self.is_processing = False
         self.auto_chat_enabled = True
         self.auto_chat_timer = None
+        # 自動会話の話題選択用の会話履歴索引（ペルソナ名は話題にしない）
+        self.topic_index = TopicIndex.from_env(stop_words=self.personas)
+        self.recent_topics = deque(maxlen=3)
         
         # GUI要素の作成
         self.create_widgets()
@@ -603,6 +741,7 @@ class GeminiAutoModelChat:
         # 定期的な出力チェック
         self.check_queues()
         self.check_display_queue()
+        self.refresh_quota_display()
         
         # 自動会話開始
         self.start_auto_chat()
@@ -654,7 +793,7 @@ class GeminiAutoModelChat:
         # モデル情報表示
         self.model_info_text = tk.Text(
             self.model_frame,
-            height=4,
+            height=6,
             width=30,
             font=('Helvetica', 9),
             wrap=tk.WORD
@@ -843,46 +982,49 @@ class GeminiAutoModelChat:
     
     def update_model_info_display(self):
         """モデル情報表示を更新"""
-        model_info = self.model_manager.get_model_info(self.model_manager.current_model)
+        model_id = self.model_manager.current_model
+        model_info = self.model_manager.get_model_info(model_id)
         info_text = f"説明: {model_info.get('description', 'N/A')}\n"
         info_text += f"制限: {model_info.get('daily_limit', 'N/A')}回/日\n"
+        budget = self.model_manager.get_remaining_budget(model_id)
+        if budget:
+            info_text += f"残り: {budget['minute']}/{model_info['minute_limit']}回/分・{budget['daily']}/{model_info['daily_limit']}回/日\n"
+        stats = self.model_manager.router.snapshot(model_id)
+        if stats and stats['calls']:
+            info_text += f"実測: 平均{stats['latency_ewma'] or 0:.1f}秒・成功率{stats['success_rate']:.0%}\n"
+        breaker_state = self.model_manager.get_breaker_state(model_id)
+        if breaker_state:
+            info_text += f"回路: {breaker_state}\n"
         info_text += f"優先度: {model_info.get('priority', 'N/A')}"
         
+        self.model_info_text.config(state=tk.NORMAL)
         self.model_info_text.delete(1.0, tk.END)
         self.model_info_text.insert(1.0, info_text)
         self.model_info_text.config(state=tk.DISABLED)
     
-    def handle_model_fallback(self, error_message):
-        """モデルフォールバックを処理"""
-        if not self.auto_fallback_var.get():
-            return False
-        
-        if not self.model_manager.should_fallback(error_message):
-            return False
-        
-        current_model = self.model_manager.current_model
-        next_model = self.model_manager.get_next_model(current_model)
-        
+    def refresh_quota_display(self):
+        """残りクォータ表示を定期更新"""
+        self.update_model_info_display()
+        self.root.after(5000, self.refresh_quota_display)
+    
+    def handle_model_fallback(self, failed_model, next_model, attempts):
+        """モデルフォールバックの結果を表示（check_queues から Tk スレッドで呼ばれる）"""
         if next_model:
-            self.model_manager.record_error(current_model, error_message)
-            
-            self.model_manager.current_model = next_model
             self.model_var.set(next_model)
             self.update_model_display()
             self.update_model_info_display()
             
             model_info = self.model_manager.get_model_info(next_model)
-            self.add_progress_log("WARN", f"モデル自動切り替え: {current_model} → {next_model}")
+            self.add_progress_log("WARN", f"モデル自動切り替え: {failed_model} → {next_model}")
+            self.add_progress_log("INFO", f"フォールバック試行 {attempts}/{self.MAX_ATTEMPTS}")
             self.add_message("システム", 
                            f"API制限のため、AIモデルを {model_info['name']} に自動切り替えしました", 
                            "system")
-            return True
         else:
             self.add_progress_log("ERROR", "利用可能なフォールバックモデルがありません")
             self.add_message("システム", 
                            "すべてのモデルで制限に達しています。しばらく時間をおいてから再試行してください", 
                            "system")
-            return False
     
     def apply_theme(self):
         """現在のテーマを適用"""
@@ -982,20 +1124,31 @@ class GeminiAutoModelChat:
                 "おすすめのお店やカフェはありますか？"
             ]
             
-            topic = random.choice(topics)
-            starter = random.choice(list(self.personas.keys()))
+            # 会話履歴の話題索引に最近の話題があれば、その語を多く使ったペルソナから振る
+            term = self.topic_index.pick(exclude=self.recent_topics) if self.topic_index else None
+            if term:
+                self.recent_topics.append(term)
+                topic = f"さっき話に出た「{term}」について、みなさんはどう思いますか？"
+                leads = self.topic_index.interested(term, k=1)
+                starter = leads[0] if leads else random.choice(list(self.personas.keys()))
+            else:
+                topic = random.choice(topics)
+                starter = random.choice(list(self.personas.keys()))
             
             self.add_message(starter, topic, "ai")
             self.add_progress_log("INFO", f"{starter}が自動会話を開始しました")
             
-            self.start_batch_processing(topic)
+            self.start_batch_processing(topic, auto=True)
         
         self.start_auto_chat()
     
-    def start_batch_processing(self, user_message):
-        """バッチ処理を開始"""
+    def start_batch_processing(self, user_message, auto=False):
+        """バッチ処理を開始（auto=True は自動会話: 最速モデルを選び、ユーザー発言で中断可能）"""
+        policy = POLICY_FASTEST if auto else POLICY_QUALITY
         self.is_processing = True
-        self.send_button.config(state=tk.DISABLED)
+        self.processing_auto = auto
+        if not auto:
+            self.send_button.config(state=tk.DISABLED)
         self.cancel_button.config(state=tk.NORMAL)
         self.status_label.config(text="AIが会話を生成中...")
         
@@ -1004,109 +1157,112 @@ class GeminiAutoModelChat:
         
         self.start_time = time.time()
         
-        self.processing_thread = threading.Thread(
-            target=self.execute_batch_processing_with_fallback, 
-            args=(user_message,),
-            daemon=True
-        )
-        self.processing_thread.start()
+        if self.auto_fallback_var.get():
+            self.route_model(policy)
+        # ヘッジ（重複送信）はユーザー発言への応答のみ
+        self.execute_batch_processing_with_fallback(user_message, hedge=not auto)
         
         self.update_processing_time()
     
-    def execute_batch_processing_with_fallback(self, user_message):
-        """フォールバック機能付きバッチ処理を実行"""
-        max_attempts = 4
-        attempt = 0
-        
-        while attempt < max_attempts:
-            try:
-                current_model = self.model_manager.current_model
-                batch_prompt = self.batch_processor.create_batch_prompt(
-                    user_message, 
-                    self.history_manager.get_history_text()
-                )
-                
-                self.add_progress_log("INFO", f"バッチ会話生成を開始 (モデル: {current_model})")
-                
-                # Gemini CLIプロセスを開始（モデル指定付き）
-                process = subprocess.Popen(
-                    ['gemini', '--model', current_model, '--prompt', batch_prompt],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                    bufsize=1,
-                    universal_newlines=True
-                )
-                
-                self.current_process = process
-                self.add_progress_log("INFO", f"プロセスID: {process.pid}")
-                
-                # 標準出力を監視
-                output_lines = []
-                while True:
-                    if process.poll() is not None:
-                        break
-                    
-                    line = process.stdout.readline()
-                    if line:
-                        line = line.rstrip()
-                        output_lines.append(line)
-                    
-                    time.sleep(0.1)
-                
-                # 残りの出力を取得
-                remaining_output, error_output = process.communicate()
-                if remaining_output:
-                    for line in remaining_output.split('\n'):
-                        if line.strip():
-                            output_lines.append(line.strip())
-                
-                # 結果を処理
-                if process.returncode == 0:
-                    if output_lines:
-                        full_response = '\n'.join(output_lines)
-                        conversations = self.batch_processor.parse_batch_response(full_response)
-                        self.output_queue.put(("BATCH_SUCCESS", conversations))
-                        self.add_progress_log("INFO", f"バッチ処理完了 ({len(conversations)}件の応答)")
-                        return
-                    else:
-                        self.output_queue.put(("BATCH_EMPTY", []))
-                        self.add_progress_log("WARN", "バッチ処理の応答が空でした")
-                        return
-                else:
-                    error_msg = error_output if error_output else f"エラー終了 (戻り値: {process.returncode})"
-                    
-                    # フォールバック処理
-                    if self.handle_model_fallback(error_msg):
-                        attempt += 1
-                        self.add_progress_log("INFO", f"フォールバック試行 {attempt}/{max_attempts}")
-                        continue
-                    else:
-                        self.error_queue.put(error_msg)
-                        self.add_progress_log("ERROR", f"バッチ処理エラー: {error_msg}")
-                        return
-                        
-            except FileNotFoundError:
-                self.error_queue.put("ジェミニCLIが見つかりません")
-                self.add_progress_log("ERROR", "ジェミニCLIが見つかりません")
-                return
-            except Exception as e:
-                self.error_queue.put(f"予期しないエラー: {str(e)}")
-                self.add_progress_log("ERROR", f"予期しないエラー: {str(e)}")
-                return
-            finally:
-                self.current_process = None
-        
-        # 最大試行回数に達した場合
-        self.error_queue.put("すべてのフォールバックモデルで処理に失敗しました")
-        self.add_progress_log("ERROR", "すべてのフォールバックモデルで処理に失敗")
+    def route_model(self, policy):
+        """方針に従ってこのリクエストで使うモデルを選び、表示を更新"""
+        model_id = self.model_manager.get_recommended_model(policy)
+        if model_id != self.model_manager.current_model:
+            self.add_progress_log("INFO", f"モデル自動選択: {self.model_manager.current_model} → {model_id}")
+            self.model_manager.current_model = model_id
+            self.model_var.set(model_id)
+            self.update_model_display()
+            self.update_model_info_display()
+    
+    def execute_batch_processing_with_fallback(self, user_message, hedge=False):
+        """フォールバック機能付きバッチ処理を非同期エンジンへ投入"""
+        current_model = self.model_manager.current_model
+        batch_prompt, report = self.batch_processor.create_batch_prompt(
+            user_message, 
+            self.history_manager.get_history_text(),
+            current_model
+        )
+        if report['trimmed']:
+            self.add_progress_log(
+                "INFO",
+                f"プロンプト削減: {report['before']}→{report['after']}トークン (上限{report['budget']}, 削減: {', '.join(report['trimmed'])})"
+            )
+        
+        self.add_progress_log("INFO", f"バッチ会話生成を開始 (モデル: {current_model})")
+        
+        request_context = RequestContext(self.BATCH_DEADLINE, label="batch")
+        # Tk の変数はイベントループから読めないため、投入時点の設定を渡す
+        auto_fallback = self.auto_fallback_var.get()
+        
+        def enqueue_display(conv):
+            if not request_context.cancelled:
+                self.display_queue.put(conv)
+        
+        # ブロックが閉じた発言から順に表示キューへ流す（キャンセル後の発言は破棄）
+        parser = IncrementalBatchParser(enqueue_display)
+        
+        def next_model(model, result):
+            # フォールバック先の出力は新しい試行として解析し、表示済みの発言は繰り返さない
+            fallback = self.select_fallback_model(model, result, auto_fallback)
+            if fallback:
+                parser.restart()
+            return fallback
+        
+        future = self.engine.submit(
+            batch_prompt, current_model,
+            timeout=self.BATCH_TIMEOUT,
+            next_model=next_model,
+            max_attempts=self.MAX_ATTEMPTS,
+            on_output=parser.feed,
+            hedge=hedge,
+            context=request_context
+        )
+        future.add_done_callback(lambda f: self.on_batch_complete(f, parser, request_context))
+        self.current_future = future
+        self.current_context = request_context
+        return future
     
-    def schedule_conversation_display(self, conversations):
-        """会話の時間差表示をスケジュール"""
-        base_delay = 2000
-        for i, conv in enumerate(conversations):
-            delay = base_delay + (i * random.randint(1500, 3000))
-            self.root.after(delay, lambda c=conv: self.display_queue.put(c))
+    def select_fallback_model(self, model, result, auto_fallback=True):
+        """失敗時に次のモデルを決定（エンジンのイベントループから呼ばれる）
+        
+        GUI の更新・履歴の保存はせず、表示は output_queue 経由で Tk スレッドへ渡す。
+        """
+        if result.timed_out or not auto_fallback:
+            return None
+        
+        error_msg = result.stderr.strip() or f"エラー終了 (戻り値: {result.returncode})"
+        if not self.model_manager.should_fallback(error_msg):
+            return None
+        next_model = self.model_manager.switch_to_fallback(model, error_msg)
+        self.output_queue.put(("MODEL_FALLBACK", (model, next_model, result.attempts)))
+        return next_model
+    
+    def on_batch_complete(self, future, parser, request_context):
+        """バッチ処理完了時の結果振り分け（GUI更新は check_queues で実施）"""
+        if future.cancelled() or request_context.cancelled:
+            return
+        
+        try:
+            result = future.result()
+        except FileNotFoundError:
+            self.error_queue.put("ジェミニCLIが見つかりません")
+            return
+        except Exception as e:
+            self.error_queue.put(f"予期しないエラー: {str(e)}")
+            return
+        
+        if result.ok:
+            parser.close()
+            if parser.message_count:
+                self.output_queue.put(("BATCH_STREAMED", (parser.message_count, result)))
+            else:
+                self.output_queue.put(("BATCH_EMPTY", result))
+        elif result.timed_out:
+            self.error_queue.put(f"タイムアウトしました（{result.stderr}）")
+        elif result.attempts >= self.MAX_ATTEMPTS:
+            self.error_queue.put("すべてのフォールバックモデルで処理に失敗しました")
+        else:
+            self.error_queue.put(result.stderr.strip() or f"エラー終了 (戻り値: {result.returncode})")
     
     def check_display_queue(self):
         """時間差表示キューをチェック"""
@@ -1127,11 +1283,11 @@ class GeminiAutoModelChat:
         except queue.Empty:
             pass
         
-        self.root.after(1000, self.check_display_queue)
+        self.root.after(100, self.check_display_queue)
     
     def send_message(self, event=None):
-        """メッセージを送信"""
-        if self.is_processing:
+        """メッセージを送信（自動会話の生成中なら中断してユーザー発言を優先）"""
+        if self.is_processing and not self.processing_auto:
             self.add_progress_log("WARN", "既に処理中です")
             return
             
@@ -1139,6 +1295,10 @@ class GeminiAutoModelChat:
         if not message:
             return
         
+        if self.is_processing:
+            self.abort_current_batch()
+            self.add_progress_log("INFO", "ユーザー発言のため自動会話を中断しました")
+        
         self.message_entry.delete(0, tk.END)
         
         formatted_message = self.chat_formatter.format_message(message)
@@ -1147,9 +1307,14 @@ class GeminiAutoModelChat:
         self.start_batch_processing(message)
     
     def load_chat_history(self):
-        """チャット履歴を読み込み"""
+        """チャット履歴を読み込み（話題索引には前回の保存以降の発言だけを追加）"""
         if self.history_manager.load_history():
             self.add_progress_log("INFO", "履歴を読み込みました")
+            if self.topic_index:
+                self.topic_index.sync(
+                    (msg['message'], msg['sender'] if msg['sender_type'] == 'ai' else None, msg['timestamp'])
+                    for msg in self.history_manager.history if msg['sender_type'] in ('user', 'ai')
+                )
             for msg in self.history_manager.history:
                 formatted_message = self.chat_formatter.format_message(msg['message'])
                 self.display_message_in_chat(msg['sender'], formatted_message, msg['sender_type'])
@@ -1161,6 +1326,9 @@ class GeminiAutoModelChat:
         result = messagebox.askyesno("確認", "チャット履歴をクリアしますか？")
         if result:
             self.history_manager.clear_history()
+            if self.topic_index:
+                self.topic_index.clear()
+                self.topic_index.save()
             self.chat_display.config(state=tk.NORMAL)
             self.chat_display.delete(1.0, tk.END)
             self.chat_display.config(state=tk.DISABLED)
@@ -1188,21 +1356,26 @@ class GeminiAutoModelChat:
         self.progress_display.config(state=tk.DISABLED)
         self.progress_display.see(tk.END)
     
+    def abort_current_batch(self):
+        """進行中のバッチを中断（実行中のCLIプロセスはエンジン側で kill される）"""
+        aborted = self.current_future is not None and not self.current_future.done()
+        if self.current_context:
+            self.current_context.cancel()
+        self.current_future = None
+        self.current_context = None
+        self.finish_processing()
+        return aborted
+    
     def cancel_processing(self):
         """処理をキャンセル"""
-        if hasattr(self, 'current_process') and self.current_process:
-            try:
-                self.current_process.terminate()
-                self.add_progress_log("WARN", "処理をキャンセルしました")
-            except:
-                pass
-        
-        self.finish_processing()
+        if self.abort_current_batch():
+            self.add_progress_log("WARN", "処理をキャンセルしました")
         self.add_message("システム", "処理がキャンセルされました", "system")
     
     def finish_processing(self):
         """処理終了時の後処理"""
         self.is_processing = False
+        self.processing_auto = False
         self.send_button.config(state=tk.NORMAL)
         self.cancel_button.config(state=tk.DISABLED)
         
@@ -1226,9 +1399,17 @@ class GeminiAutoModelChat:
         try:
             while True:
                 result_type, data = self.output_queue.get_nowait()
-                if result_type == "BATCH_SUCCESS":
-                    self.schedule_conversation_display(data)
+                if result_type == "MODEL_FALLBACK":
+                    # 処理は継続中のため finish_processing しない
+                    self.handle_model_fallback(*data)
+                    continue
+                if result_type == "BATCH_STREAMED":
+                    message_count, result = data
+                    self.add_progress_log("INFO", f"バッチ処理完了 ({message_count}件の応答)")
+                    self.log_transfer_metrics(result)
                 elif result_type == "BATCH_EMPTY":
+                    self.add_progress_log("WARN", "バッチ処理の応答が空でした")
+                    self.log_transfer_metrics(data)
                     self.add_message("システム", "応答が生成されませんでした", "system")
                 self.finish_processing()
         except queue.Empty:
@@ -1237,6 +1418,7 @@ class GeminiAutoModelChat:
         try:
             while True:
                 error_msg = self.error_queue.get_nowait()
+                self.add_progress_log("ERROR", f"バッチ処理エラー: {error_msg}")
                 self.add_message("システム", f"エラー: {error_msg}", "system")
                 self.finish_processing()
         except queue.Empty:
@@ -1244,11 +1426,32 @@ class GeminiAutoModelChat:
         
         self.root.after(100, self.check_queues)
     
+    def log_transfer_metrics(self, result):
+        """初回受信までの時間と受信レートをログに出力"""
+        if result.cached:
+            self.add_progress_log("INFO", f"キャッシュから応答 (モデル: {result.model})")
+            return
+        if result.coalesced:
+            self.add_progress_log(
+                "INFO",
+                f"実行中の同一要求と結果を共有 (モデル: {result.model} / 共有累計 {self.engine.coalesce_stats['coalesced']}件)"
+            )
+            return
+        first_byte = f"{result.first_byte_time:.2f}秒" if result.first_byte_time is not None else "なし"
+        self.add_progress_log(
+            "INFO",
+            f"転送: 初回受信 {first_byte} / 合計 {result.elapsed:.2f}秒 / "
+            f"{result.bytes_received}B ({result.bytes_per_second:.0f}B/秒) / モデル: {result.model}"
+        )
+    
     def add_message(self, sender, message, sender_type):
         """チャット履歴にメッセージを追加"""
         original_message = message.replace('\n', ' ')
         self.history_manager.add_message(sender, original_message, sender_type)
         self.history_manager.save_history()
+        if self.topic_index and sender_type in ('user', 'ai'):
+            self.topic_index.add(original_message, sender if sender_type == 'ai' else None,
+                                 self.history_manager.history[-1]['timestamp'])
         
         self.display_message_in_chat(sender, message, sender_type)
     
@@ -1274,6 +1477,9 @@ def main():
     root = tk.Tk()
     app = GeminiAutoModelChat(root)
     root.mainloop()
+    if app.topic_index:
+        app.topic_index.save()
+    app.engine.shutdown()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,2494 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Gemini バックエンド呼び出し基盤
+chatter5.py / gem2.py から共通で利用するバックエンド抽象・常駐ワーカープール・非同期エンジン等を提供
+"""
+
+import asyncio
+import codecs
+import copy
+import subprocess
+import hashlib
+import json
+import threading
+import time
+import itertools
+import logging
+import math
+import os
+import random
+import shlex
+import shutil
+import tempfile
+import queue
+import re
+from collections import OrderedDict, deque
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class GeminiWorker:
+    """常駐ワーカープロセス1本の管理クラス（JSON Lines プロトコル）
+
+    リクエスト: {"id": 1, "type": "generate", "model": "...", "prompt": "..."}
+                {"id": 2, "type": "ping"}
+    レスポンス: {"id": 1, "returncode": 0, "stdout": "...", "stderr": ""}
+    """
+
+    # cancel（threading.Event）を監視する間隔（秒）
+    CANCEL_POLL_INTERVAL = 0.05
+
+    def __init__(self, command):
+        self.command = command
+        self.request_count = 0
+        self.started_at = time.time()
+        self._ids = itertools.count(1)
+        self._responses = queue.Queue()
+        self._io_lock = threading.Lock()
+
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding='utf-8',
+            bufsize=1
+        )
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+        logger.info(f"ワーカー起動: PID={self.process.pid}")
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def _read_loop(self):
+        """標準出力からレスポンスを読み取りキューへ積む"""
+        try:
+            for line in self.process.stdout:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self._responses.put(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning(f"ワーカー応答の解析失敗 (PID={self.pid}): {line[:100]}")
+        except (OSError, ValueError):
+            pass
+        finally:
+            # EOF通知
+            self._responses.put(None)
+
+    def is_alive(self):
+        """プロセスが生存しているか"""
+        return self.process.poll() is None
+
+    def request(self, payload, timeout, cancel=None):
+        """1リクエストを送信し対応するレスポンスを待つ（cancel がセットされたら RequestCancelled）"""
+        with self._io_lock:
+            request_id = next(self._ids)
+            payload = dict(payload, id=request_id)
+            self.process.stdin.write(json.dumps(payload, ensure_ascii=False) + '\n')
+            self.process.stdin.flush()
+
+            deadline = time.monotonic() + timeout
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise RequestCancelled(f"ワーカーへの要求をキャンセル (PID={self.pid})")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(self.command, timeout)
+                wait = remaining if cancel is None else min(remaining, self.CANCEL_POLL_INTERVAL)
+                try:
+                    response = self._responses.get(timeout=wait)
+                except queue.Empty:
+                    continue
+                if response is None:
+                    raise BrokenPipeError(f"ワーカープロセスが終了しました (PID={self.pid})")
+                if response.get('id') == request_id:
+                    return response
+                # タイムアウト済みリクエストの遅延応答は破棄
+
+    def generate(self, prompt, model, timeout, cancel=None):
+        """プロンプトを送信し subprocess.run 互換の結果を返す"""
+        self.request_count += 1
+        response = self.request({'type': 'generate', 'model': model, 'prompt': prompt}, timeout, cancel)
+        return subprocess.CompletedProcess(
+            self.command,
+            response.get('returncode', 1),
+            response.get('stdout', ''),
+            response.get('stderr', '')
+        )
+
+    def ping(self, timeout=5):
+        """ヘルスチェック"""
+        if not self.is_alive():
+            return False
+        try:
+            response = self.request({'type': 'ping'}, timeout)
+            return response.get('returncode') == 0
+        except (subprocess.TimeoutExpired, OSError, ValueError):
+            return False
+
+    def close(self):
+        """プロセスを終了"""
+        try:
+            self.process.stdin.close()
+        except (OSError, ValueError):
+            pass
+        try:
+            self.process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        logger.info(f"ワーカー終了: PID={self.pid}, 処理件数={self.request_count}")
+
+
+class GeminiWorkerPool:
+    """常駐Geminiワーカープール - 応答ごとのCLI起動・認証コストを削減
+
+    command は GeminiWorker の JSON Lines プロトコルで応答するプログラムでなければならない。
+    gemini CLI 自体はこのプロトコルを話さないため、gemini_cli_worker.py（CLI を包むアダプタ）か、
+    同じプロトコルを実装した独自ワーカーを指定する。fake_gemini_worker.py はオフライン検証専用。
+    """
+
+    def __init__(self, command, pool_size=3, max_requests_per_worker=50,
+                 health_check_interval=60.0):
+        self.command = command
+        self.pool_size = pool_size
+        self.max_requests_per_worker = max_requests_per_worker
+        self.health_check_interval = health_check_interval
+
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = set()
+        self._closed = False
+        self.stats = {'requests': 0, 'recycled': 0, 'replaced': 0, 'timeouts': 0, 'cancelled': 0}
+
+        for _ in range(pool_size):
+            self._idle.put(self._spawn())
+
+        if health_check_interval:
+            threading.Thread(target=self._health_check_loop, daemon=True).start()
+
+        logger.info(f"ワーカープール初期化: サイズ={pool_size}, 再起動間隔={max_requests_per_worker}件")
+
+    @classmethod
+    def from_env(cls):
+        """環境変数からプールを構築（GEMINI_WORKER_CMD 未設定時は None）
+
+        GEMINI_WORKER_CMD: ワーカーの起動コマンド（例: "python gemini_cli_worker.py"）
+        GEMINI_POOL_SIZE / GEMINI_POOL_MAX_REQUESTS / GEMINI_POOL_HEALTH_INTERVAL: プール設定
+        """
+        command = os.environ.get('GEMINI_WORKER_CMD')
+        if not command:
+            return None
+        return cls(
+            shlex.split(command),
+            pool_size=int(os.environ.get('GEMINI_POOL_SIZE', 3)),
+            max_requests_per_worker=int(os.environ.get('GEMINI_POOL_MAX_REQUESTS', 50)),
+            health_check_interval=float(os.environ.get('GEMINI_POOL_HEALTH_INTERVAL', 60))
+        )
+
+    def _count(self, key):
+        """統計を加算（複数スレッドから呼ばれる）"""
+        with self._lock:
+            self.stats[key] += 1
+
+    def _spawn(self):
+        """ワーカーを1本起動"""
+        worker = GeminiWorker(self.command)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _retire(self, worker, replace=True):
+        """ワーカーを破棄し、必要なら補充"""
+        with self._lock:
+            self._workers.discard(worker)
+        threading.Thread(target=worker.close, daemon=True).start()
+        if replace and not self._closed:
+            self._idle.put(self._spawn())
+
+    def _acquire(self, timeout):
+        """アイドルワーカーを取得"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                worker = self._idle.get(timeout=max(remaining, 0.001))
+            except queue.Empty:
+                raise subprocess.TimeoutExpired(self.command, timeout)
+            if worker.is_alive():
+                return worker
+            logger.warning(f"停止済みワーカーを検出、補充します (PID={worker.pid})")
+            self._count('replaced')
+            self._retire(worker)
+
+    def _release(self, worker):
+        """ワーカーを返却（上限到達時は再起動）"""
+        if not worker.is_alive():
+            self._count('replaced')
+            self._retire(worker)
+        elif worker.request_count >= self.max_requests_per_worker:
+            logger.info(f"ワーカー再起動: PID={worker.pid}, 処理件数={worker.request_count}")
+            self._count('recycled')
+            self._retire(worker)
+        else:
+            self._idle.put(worker)
+
+    def generate(self, prompt, model, timeout=30, cancel=None):
+        """プール経由でプロンプトを処理（subprocess.run 互換の結果を返す）
+
+        cancel（threading.Event）がセットされると応答を待たずに RequestCancelled を送出し、
+        生成途中のワーカーは破棄して補充する。
+        """
+        if self._closed:
+            raise RuntimeError("ワーカープールは終了済みです")
+
+        self._count('requests')
+        start_time = time.monotonic()
+        worker = self._acquire(timeout)
+        if cancel is not None and cancel.is_set():
+            self._release(worker)
+            raise RequestCancelled("ワーカー割り当て前にキャンセルされました")
+        remaining = max(timeout - (time.monotonic() - start_time), 0.001)
+
+        try:
+            result = worker.generate(prompt, model, remaining, cancel)
+        except subprocess.TimeoutExpired:
+            # 応答途中のワーカーは再利用しない
+            self._count('timeouts')
+            self._retire(worker)
+            raise
+        except RequestCancelled:
+            self._count('cancelled')
+            self._retire(worker)
+            raise
+        except (OSError, ValueError) as e:
+            logger.warning(f"ワーカー異常終了 (PID={worker.pid}): {e}")
+            self._count('replaced')
+            self._retire(worker)
+            return subprocess.CompletedProcess(self.command, -1, '', str(e))
+
+        self._release(worker)
+        return result
+
+    def health_check(self):
+        """アイドル中のワーカーを1本ずつ検査し、応答しないものを入れ替える
+
+        検査中のワーカー以外はプールに残したままにし、ヘルスチェック中も要求を処理できるようにする。
+        """
+        checked = set()
+        healthy = 0
+        for _ in range(self._idle.qsize()):
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker in checked:
+                # 一巡した（検査済みのワーカーが先頭に戻ってきた）
+                self._idle.put(worker)
+                break
+            checked.add(worker)
+            if worker.ping():
+                healthy += 1
+                self._idle.put(worker)
+            else:
+                logger.warning(f"ヘルスチェック失敗、ワーカー入れ替え (PID={worker.pid})")
+                self._count('replaced')
+                self._retire(worker)
+        return healthy
+
+    def _health_check_loop(self):
+        while not self._closed:
+            time.sleep(self.health_check_interval)
+            if self._closed:
+                break
+            try:
+                self.health_check()
+            except Exception as e:
+                logger.error(f"ヘルスチェックエラー: {e}")
+
+    def close(self):
+        """全ワーカーを終了"""
+        self._closed = True
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+        for worker in workers:
+            worker.close()
+        logger.info(f"ワーカープール終了: {self.stats}")
+
+
+class GenerationResult:
+    """1回の生成結果"""
+
+    def __init__(self, model, returncode, stdout, stderr, elapsed, timed_out=False, attempts=1,
+                 cached=False, first_byte_time=None, bytes_received=None, coalesced=False):
+        self.model = model
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+        self.attempts = attempts
+        self.cached = cached
+        # 実行中の同一要求の結果を共有した（自身はバックエンドを呼んでいない）
+        self.coalesced = coalesced
+        # 最初の標準出力を受信するまでの秒数（未受信なら None）
+        self.first_byte_time = first_byte_time
+        self.bytes_received = len(stdout.encode('utf-8')) if bytes_received is None else bytes_received
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    @property
+    def bytes_per_second(self):
+        """標準出力の受信レート"""
+        return self.bytes_received / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return (f"GenerationResult(model={self.model!r}, returncode={self.returncode}, "
+                f"elapsed={self.elapsed:.2f}, timed_out={self.timed_out}, attempts={self.attempts}, "
+                f"cached={self.cached}, coalesced={self.coalesced})")
+
+
+class ResponseCache:
+    """(モデル, プロンプト) のハッシュをキーとする応答キャッシュ
+
+    メモリ上のLRU層と、TTL・容量上限付きのディスク層（1エントリ1 JSON ファイル）の2段構成。
+    """
+
+    def __init__(self, directory=".gemini_cache", memory_entries=256, ttl=24 * 3600,
+                 max_disk_bytes=50 * 1024 * 1024):
+        self.directory = Path(directory) if directory else None
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+
+        self._memory = OrderedDict()
+        self._disk_index = {}  # key -> (size, mtime)
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            for path in self.directory.glob("*.json"):
+                stat = path.stat()
+                self._disk_index[path.stem] = (stat.st_size, stat.st_mtime)
+            logger.info(f"応答キャッシュ初期化: {self.directory} ({len(self._disk_index)}件)")
+
+    @classmethod
+    def from_env(cls):
+        """環境変数からキャッシュを構築（GEMINI_CACHE 未設定時は None）"""
+        if os.environ.get('GEMINI_CACHE', '') not in ('1', 'true', 'on'):
+            return None
+        return cls(
+            directory=os.environ.get('GEMINI_CACHE_DIR', '.gemini_cache'),
+            memory_entries=int(os.environ.get('GEMINI_CACHE_ENTRIES', 256)),
+            ttl=float(os.environ.get('GEMINI_CACHE_TTL', 24 * 3600)),
+            max_disk_bytes=int(float(os.environ.get('GEMINI_CACHE_MAX_MB', 50)) * 1024 * 1024)
+        )
+
+    @staticmethod
+    def make_key(model, prompt):
+        """キャッシュキー（SHA-256）"""
+        return hashlib.sha256(f"{model}\0{prompt}".encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return self.directory / f"{key}.json"
+
+    def get(self, model, prompt):
+        """キャッシュ済み応答を取得（なければ None）"""
+        key = self.make_key(model, prompt)
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, text = entry
+                if now - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.stats['hits'] += 1
+                    self.stats['memory_hits'] += 1
+                    return text
+                del self._memory[key]
+
+            if self.directory and key in self._disk_index:
+                try:
+                    with open(self._path(key), 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    if now - data['created'] <= self.ttl:
+                        self._remember(key, data['created'], data['text'])
+                        self.stats['hits'] += 1
+                        self.stats['disk_hits'] += 1
+                        return data['text']
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(f"キャッシュ読み込み失敗: {key[:12]} ({e})")
+                self._remove_disk(key)
+
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, model, prompt, text):
+        """応答を保存"""
+        key = self.make_key(model, prompt)
+        created = time.time()
+
+        with self._lock:
+            self._remember(key, created, text)
+            self.stats['stores'] += 1
+            if not self.directory:
+                return
+            try:
+                path = self._path(key)
+                with open(path, 'w', encoding='utf-8') as f:
+                    json.dump({'model': model, 'created': created, 'text': text}, f, ensure_ascii=False)
+                self._disk_index[key] = (path.stat().st_size, created)
+                self._evict_disk()
+            except OSError as e:
+                logger.warning(f"キャッシュ書き込み失敗: {e}")
+
+    def _remember(self, key, created, text):
+        self._memory[key] = (created, text)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _remove_disk(self, key):
+        self._disk_index.pop(key, None)
+        try:
+            self._path(key).unlink()
+        except OSError:
+            pass
+
+    def _evict_disk(self):
+        """期限切れと容量超過分を古い順に削除"""
+        now = time.time()
+        for key, (_, mtime) in list(self._disk_index.items()):
+            if now - mtime > self.ttl:
+                self._remove_disk(key)
+                self.stats['evictions'] += 1
+
+        total = sum(size for size, _ in self._disk_index.values())
+        if total <= self.max_disk_bytes:
+            return
+        for key, (size, _) in sorted(self._disk_index.items(), key=lambda item: item[1][1]):
+            if total <= self.max_disk_bytes:
+                break
+            self._remove_disk(key)
+            total -= size
+            self.stats['evictions'] += 1
+
+    def clear(self):
+        """全エントリを削除"""
+        with self._lock:
+            self._memory.clear()
+            for key in list(self._disk_index):
+                self._remove_disk(key)
+
+
+class LLMBackend:
+    """LLMバックエンドの基底クラス
+
+    generate() はコルーチンで GenerationResult を返す。タイムアウト時は timed_out=True の結果を返し、
+    キャンセル時は実行中の処理を後始末して CancelledError を送出すること。
+    on_output(text) が渡された場合、標準出力を受信した順に逐次通知する。
+    """
+
+    name = "base"
+
+    async def generate(self, prompt, model, timeout, on_output=None):
+        raise NotImplementedError
+
+    def check_available(self):
+        """利用可否とバージョン等の情報を (bool, str) で返す"""
+        return True, self.name
+
+    def availability_key(self):
+        """確認結果を再利用してよい条件を表す値（None なら毎回確認する）"""
+        return None
+
+    def close(self):
+        """保持しているリソースを解放"""
+        pass
+
+
+class GeminiCLIBackend(LLMBackend):
+    """gemini CLI を1リクエスト1プロセスで起動するバックエンド
+
+    プロンプトの渡し方（transport）:
+    'argv' = --prompt 引数、'stdin' = パイプで標準入力へ書き込み、
+    'file' = memfd（非対応環境では一時ファイル）に書いて標準入力として渡す、
+    'auto' = サイズで自動選択（ARGV_LIMIT 以下は argv、それを超えたら file）。
+    argv は Linux の MAX_ARG_STRLEN（1引数128KiB）に制限され、プロセス一覧からも見えてしまう。
+    bench_prompt_transports の実測では file は全サイズで stdin と同等以上だったため、auto では stdin を使わない。
+    """
+
+    name = "cli"
+
+    TRANSPORTS = ('auto', 'argv', 'stdin', 'file')
+    ARGV_LIMIT = 16 * 1024
+    # gemini --version の応答待ち上限（秒）。応答しない CLI で確認スレッドが止まらないように
+    VERSION_TIMEOUT = 15
+
+    def __init__(self, command=('gemini',), transport='auto'):
+        if transport not in self.TRANSPORTS:
+            raise ValueError(f"不明なプロンプト転送方式: {transport}")
+        self.command = list(command)
+        self.transport = transport
+
+    def choose_transport(self, size):
+        """プロンプトのバイト数から転送方式を決定"""
+        if self.transport != 'auto':
+            return self.transport
+        return 'argv' if size <= self.ARGV_LIMIT else 'file'
+
+    def build_command(self, prompt, model, transport='argv'):
+        """CLI引数を構築（argv 以外ではプロンプトを標準入力から読ませる）"""
+        if transport == 'argv':
+            return self.command + ['--model', model, '--prompt', prompt]
+        return self.command + ['--model', model]
+
+    @staticmethod
+    def _prompt_file(data):
+        """プロンプトを書き込んだ先頭位置のファイル（memfd 優先）"""
+        if hasattr(os, 'memfd_create'):
+            prompt_file = os.fdopen(os.memfd_create('gemini-prompt'), 'w+b')
+        else:
+            prompt_file = tempfile.TemporaryFile()
+        prompt_file.write(data)
+        prompt_file.flush()
+        prompt_file.seek(0)
+        return prompt_file
+
+    def is_installed(self):
+        """実行ファイルが PATH 上にあるか"""
+        return shutil.which(self.command[0]) is not None
+
+    def check_available(self):
+        """gemini --version で存在確認（実行ファイルが無ければ起動せず即座に失敗）"""
+        if not self.is_installed():
+            return False, f"{self.command[0]} が見つかりません"
+        try:
+            result = subprocess.run(self.command + ['--version'], capture_output=True, check=True,
+                                    timeout=self.VERSION_TIMEOUT)
+            return True, result.stdout.decode('utf-8', errors='replace').strip()
+        except subprocess.TimeoutExpired:
+            return False, f"{self.command[0]} --version が{self.VERSION_TIMEOUT}秒以内に応答しません"
+        except (subprocess.CalledProcessError, OSError) as e:
+            return False, str(e)
+
+    def availability_key(self):
+        """実行ファイルの実体パス・更新時刻・サイズ（更新・再インストールで変わる）"""
+        executable = shutil.which(self.command[0])
+        if executable is None:
+            return None
+        try:
+            real_path = os.path.realpath(executable)
+            stat = os.stat(real_path)
+        except OSError:
+            return None
+        return [self.command, real_path, stat.st_mtime_ns, stat.st_size]
+
+    async def generate(self, prompt, model, timeout, on_output=None):
+        start_time = time.monotonic()
+        data = prompt.encode('utf-8')
+        transport = self.choose_transport(len(data))
+        stdin = asyncio.subprocess.DEVNULL
+        prompt_file = None
+        if transport == 'stdin':
+            stdin = asyncio.subprocess.PIPE
+        elif transport == 'file':
+            prompt_file = self._prompt_file(data)
+            stdin = prompt_file
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *self.build_command(prompt, model, transport),
+                stdin=stdin,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+        finally:
+            # 子プロセスは複製済みの記述子から読むため、こちらは即座に閉じてよい
+            if prompt_file is not None:
+                prompt_file.close()
+        stdout_chunks = []
+        stderr_chunks = []
+        transfer = {'first_byte_time': None, 'bytes_received': 0}
+        tasks = [
+            self._read_stream(process.stdout, stdout_chunks, on_output, transfer, start_time),
+            self._read_stream(process.stderr, stderr_chunks),
+            process.wait()
+        ]
+        if transport == 'stdin':
+            tasks.append(self._write_stdin(process.stdin, data))
+        try:
+            # stdout / stderr を同時に読み進め（片側のパイプ詰まりで停止しない）、
+            # データ到着かプロセス終了時のみ起床する
+            await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+        except asyncio.TimeoutError:
+            await self._kill(process)
+            logger.warning(f"タイムアウト: モデル={model}, {timeout}秒")
+            return GenerationResult(model, None, ''.join(stdout_chunks), 'タイムアウト',
+                                    time.monotonic() - start_time, timed_out=True, **transfer)
+        except asyncio.CancelledError:
+            await self._kill(process)
+            logger.info(f"生成キャンセル: モデル={model}, PID={process.pid}")
+            raise
+
+        return GenerationResult(
+            model, process.returncode, ''.join(stdout_chunks), ''.join(stderr_chunks),
+            time.monotonic() - start_time, **transfer
+        )
+
+    @staticmethod
+    async def _read_stream(stream, chunks, on_output=None, transfer=None, start_time=None):
+        """ストリームをEOFまで読み、UTF-8 として逐次デコード（transfer に受信量と初回受信時刻を記録）"""
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            data = await stream.read(4096)
+            if data and transfer is not None:
+                transfer['bytes_received'] += len(data)
+                if transfer['first_byte_time'] is None:
+                    transfer['first_byte_time'] = time.monotonic() - start_time
+            text = decoder.decode(data, final=not data)
+            if text:
+                chunks.append(text)
+                if on_output:
+                    on_output(text)
+            if not data:
+                break
+
+    @staticmethod
+    async def _write_stdin(stream, data):
+        """プロンプトを標準入力へ書き込んで閉じる（子プロセスが先に終了した場合は無視）"""
+        try:
+            stream.write(data)
+            await stream.drain()
+            stream.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    @staticmethod
+    async def _kill(process):
+        """サブプロセスを強制終了"""
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            await process.wait()
+
+
+class WorkerPoolBackend(LLMBackend):
+    """常駐ワーカープール経由のバックエンド"""
+
+    name = "pool"
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def check_available(self):
+        healthy = self.pool.health_check()
+        if not healthy:
+            # gemini CLI を直接指定した場合など、プロトコルを話さないワーカーはここで検出する
+            return False, (f"ワーカーが ping に応答しません（GEMINI_WORKER_CMD={shlex.join(self.pool.command)}）。"
+                           "JSON Lines プロトコルで応答するワーカー（例: python gemini_cli_worker.py）を指定してください")
+        return True, f"ワーカー {healthy}/{self.pool.pool_size} 稼働中"
+
+    async def generate(self, prompt, model, timeout, on_output=None):
+        start_time = time.monotonic()
+        loop = asyncio.get_running_loop()
+        # キャンセル時は待機をやめるだけでなく、実行スレッド側のワーカーも中断・破棄させる
+        cancel = threading.Event()
+        try:
+            process = await loop.run_in_executor(None, self.pool.generate, prompt, model, timeout or 30, cancel)
+        except asyncio.CancelledError:
+            cancel.set()
+            raise
+        except subprocess.TimeoutExpired:
+            return GenerationResult(model, None, '', 'タイムアウト',
+                                    time.monotonic() - start_time, timed_out=True)
+        # ワーカープロトコルは一括応答のため、完了時にまとめて通知
+        if on_output and process.stdout:
+            on_output(process.stdout)
+        elapsed = time.monotonic() - start_time
+        return GenerationResult(model, process.returncode, process.stdout, process.stderr, elapsed,
+                                first_byte_time=elapsed if process.stdout else None)
+
+    def close(self):
+        self.pool.close()
+
+
+class StubBackend(LLMBackend):
+    """ネットワーク不要の決定的スタブバックエンド（負荷試験・フォールバック検証用）
+
+    error_rates: {"429": 0.1, "timeout": 0.05, "empty": 0.05} のような発生確率
+    model_error_rates: モデル別の上書き（例: {"gemini-2.5-pro": {"429": 1.0}}）
+    同じ (seed, model, prompt, 呼び出し回数) に対しては常に同じ結果を返す。
+    """
+
+    name = "stub"
+    QUOTA_ERROR = "429 Too Many Requests: Quota exceeded (RESOURCE_EXHAUSTED)"
+
+    def __init__(self, latency=0.5, jitter=0.0, error_rates=None, model_error_rates=None,
+                 seed=0, hang_time=60.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rates = error_rates or {}
+        self.model_error_rates = model_error_rates or {}
+        self.seed = seed
+        self.hang_time = hang_time
+        self._call_counts = {}
+        self._lock = threading.Lock()
+        self.stats = {'calls': 0, '429': 0, 'timeout': 0, 'empty': 0, 'ok': 0}
+
+    def _draw(self, prompt, model):
+        """(seed, model, prompt, 回数) から決定的な [0, 1) の乱数を2つ得る"""
+        key = (model, prompt)
+        with self._lock:
+            count = self._call_counts.get(key, 0)
+            self._call_counts[key] = count + 1
+        digest = hashlib.sha256(f"{self.seed}\0{model}\0{count}\0{prompt}".encode('utf-8')).digest()
+        return (int.from_bytes(digest[:8], 'big') / 2 ** 64,
+                int.from_bytes(digest[8:16], 'big') / 2 ** 64)
+
+    def _outcome(self, model, draw):
+        rates = dict(self.error_rates)
+        rates.update(self.model_error_rates.get(model, {}))
+        threshold = 0.0
+        for kind in ('429', 'timeout', 'empty'):
+            threshold += rates.get(kind, 0.0)
+            if draw < threshold:
+                return kind
+        return 'ok'
+
+    @staticmethod
+    def build_reply(prompt, model):
+        """プロンプトの形式に合わせたペルソナ風の応答を作る"""
+        # gem2 形式のバッチプロンプト（【名前】年齢… の一覧）
+        roster = re.findall(r'^【(.+?)】\d+歳', prompt, re.MULTILINE)
+        if roster:
+            blocks = [f"【{name}】\n{name}です。その話題、私も気になっていました！" for name in roster[:3]]
+            return '\n\n'.join(blocks)
+
+        # chatter5 形式の個別プロンプト
+        match = re.search(r'あなたは「?(.+?)」?（', prompt)
+        speaker = match.group(1) if match else "ペルソナ"
+        return f"{speaker}です。なるほど、その話題は面白いですね！（{model}）"
+
+    async def generate(self, prompt, model, timeout, on_output=None):
+        start_time = time.monotonic()
+        outcome_draw, latency_draw = self._draw(prompt, model)
+        outcome = self._outcome(model, outcome_draw)
+        latency = max(0.0, self.latency + self.jitter * (2 * latency_draw - 1))
+
+        self.stats['calls'] += 1
+        self.stats[outcome] += 1
+
+        if outcome == 'timeout':
+            hang = self.hang_time if timeout is None else min(timeout, self.hang_time)
+            await asyncio.sleep(hang)
+            return GenerationResult(model, None, '', 'タイムアウト',
+                                    time.monotonic() - start_time, timed_out=True)
+
+        if timeout is not None and latency > timeout:
+            await asyncio.sleep(timeout)
+            return GenerationResult(model, None, '', 'タイムアウト',
+                                    time.monotonic() - start_time, timed_out=True)
+
+        if outcome == '429':
+            await asyncio.sleep(latency)
+            return GenerationResult(model, 1, '', self.QUOTA_ERROR, time.monotonic() - start_time)
+        if outcome == 'empty':
+            await asyncio.sleep(latency)
+            return GenerationResult(model, 0, '', '', time.monotonic() - start_time)
+
+        # 応答を行単位で待ち時間に分散して送出（ストリーミングの再現）
+        reply = self.build_reply(prompt, model)
+        lines = reply.splitlines(keepends=True)
+        first_byte_time = None
+        for line in lines:
+            await asyncio.sleep(latency / len(lines))
+            if first_byte_time is None:
+                first_byte_time = time.monotonic() - start_time
+            if on_output:
+                on_output(line)
+        return GenerationResult(model, 0, reply, '', time.monotonic() - start_time,
+                                first_byte_time=first_byte_time)
+
+
+def _parse_rates(text):
+    """"429=0.1,timeout=0.05" 形式を辞書に変換"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        kind, _, value = item.partition('=')
+        rates[kind.strip()] = float(value)
+    return rates
+
+
+_WIDE_CHAR = re.compile(r'[\u3000-\u30ff\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    """トークン数の概算（日本語など全角1文字≒1トークン、その他4文字≒1トークン）"""
+    wide = len(_WIDE_CHAR.findall(text))
+    return wide + (len(text) - wide + 3) // 4
+
+
+# プロンプトの並べ方: classic = 従来の順序、prefix = 静的部分（人物設定・指示）を先頭に集め、
+# 可変部分（興味レベル・履歴・発言）を後ろに置く。先頭が毎回同一バイト列になるため、
+# プロバイダ側のコンテキストキャッシュ（暗黙・明示）で再利用できる
+LAYOUT_CLASSIC = 'classic'
+LAYOUT_PREFIX = 'prefix'
+PROMPT_LAYOUTS = (LAYOUT_CLASSIC, LAYOUT_PREFIX)
+
+
+def prompt_layout_from_env(default=LAYOUT_CLASSIC):
+    """GEMINI_PROMPT_LAYOUT=classic|prefix からプロンプトの並べ方を決定"""
+    layout = os.environ.get('GEMINI_PROMPT_LAYOUT', default)
+    if layout not in PROMPT_LAYOUTS:
+        logger.warning(f"不明なプロンプト配置: {layout}（{default} を使用）")
+        return default
+    return layout
+
+
+def prefix_hash(text):
+    """静的接頭辞の識別用ハッシュ（キャッシュ再利用の診断用）"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+class PromptSection:
+    """プロンプトの1区画
+
+    priority が小さい区画から削る。trim は削り方:
+    'head' = 先頭（古い行）から削る、'tail' = 末尾から削る、None = 削らない。
+    header（見出し）は削らず、本文 text を削り切った場合のみ区画ごと省く。
+    tokens は header + text の概算トークン数（静的な区画で事前計算済みなら渡す）。
+    """
+
+    def __init__(self, name, text, priority, trim='tail', header='', tokens=None):
+        self.name = name
+        self.text = text
+        self.priority = priority
+        self.trim = trim
+        self.header = header
+        self.tokens = estimate_tokens(header + text) if tokens is None else tokens
+
+
+class PromptBudgeter:
+    """区画ごとのトークン概算に基づき、モデル別の上限に収まるようプロンプトを組み立てる"""
+
+    OMITTED = "（…省略…）"
+
+    def __init__(self, budgets=None, default_budget=6000):
+        self.budgets = dict(budgets or {})
+        self.default_budget = default_budget
+
+    @classmethod
+    def from_env(cls, budgets=None):
+        """環境変数から構築
+
+        GEMINI_PROMPT_BUDGET: 既定の上限トークン数
+        GEMINI_PROMPT_BUDGETS: "gemini-2.5-pro=4000,gemini-2.5-flash=8000" 形式のモデル別上限（budgets より優先）
+        """
+        merged = dict(budgets or {})
+        merged.update({model: int(value) for model, value in
+                       _parse_rates(os.environ.get('GEMINI_PROMPT_BUDGETS', '')).items()})
+        return cls(merged, int(os.environ.get('GEMINI_PROMPT_BUDGET', 6000)))
+
+    def budget_for(self, model):
+        return self.budgets.get(model, self.default_budget)
+
+    def build(self, sections, model=None, label="prompt"):
+        """区画を順に連結し (プロンプト, 報告) を返す（上限超過時は優先度の低い区画から削る）
+
+        報告は {'label', 'budget', 'before', 'after', 'trimmed'}。複数スレッドから共有されるため
+        インスタンスには保持せず、呼び出しごとに返す。
+        """
+        budget = self.budget_for(model)
+        sizes = {section.name: section.tokens for section in sections}
+        total = sum(sizes.values())
+        report = {'label': label, 'budget': budget, 'before': total, 'after': total, 'trimmed': []}
+        if total <= budget:
+            logger.debug(f"プロンプト予算内 [{label}] {total}/{budget}: {sizes}")
+            return ''.join(section.header + section.text for section in sections), report
+
+        texts = {section.name: section.text for section in sections}
+        trimmed = []
+        for section in sorted(sections, key=lambda section: section.priority):
+            if total <= budget:
+                break
+            if section.trim is None or not texts[section.name]:
+                continue
+            before = estimate_tokens(texts[section.name])
+            texts[section.name] = self._trim(texts[section.name], before - (total - budget), section.trim)
+            after = estimate_tokens(texts[section.name])
+            if not texts[section.name]:
+                after -= estimate_tokens(section.header)
+            total -= before - after
+            trimmed.append(section.name)
+
+        pieces = {
+            section.name: section.header + texts[section.name]
+            if texts[section.name] or section.name not in trimmed else ''
+            for section in sections
+        }
+        after_sizes = {name: estimate_tokens(piece) for name, piece in pieces.items()}
+        report.update(after=total, trimmed=trimmed)
+        logger.info(
+            f"プロンプト削減 [{label}] モデル={model} {sum(sizes.values())}→{total}/{budget}トークン "
+            f"削減区画={trimmed} 区画別={ {name: (sizes[name], after_sizes[name]) for name in sizes} }"
+        )
+        if total > budget:
+            logger.warning(f"プロンプトが予算を超過したまま [{label}] {total}/{budget}トークン")
+        return ''.join(pieces[section.name] for section in sections), report
+
+    def _trim(self, text, keep_tokens, trim):
+        """text を keep_tokens 程度に削る（0以下なら区画ごと削除）"""
+        if keep_tokens <= estimate_tokens(self.OMITTED) + 1:
+            return ''
+        lines = text.splitlines(keepends=True)
+        if trim == 'head':
+            # 新しい行（末尾）から残せるだけ残す
+            kept = []
+            used = estimate_tokens(self.OMITTED) + 1
+            for line in reversed(lines):
+                cost = estimate_tokens(line)
+                if used + cost > keep_tokens:
+                    break
+                kept.append(line)
+                used += cost
+            if not kept and lines:
+                # 最新の1行だけでも収まらない場合は行の末尾側を文字単位で残す
+                kept.append(lines[-1][-(keep_tokens - used):])
+            return self.OMITTED + '\n' + ''.join(reversed(kept))
+
+        kept = []
+        used = estimate_tokens(self.OMITTED) + 1
+        for line in lines:
+            cost = estimate_tokens(line)
+            if used + cost > keep_tokens:
+                break
+            kept.append(line)
+            used += cost
+        if not kept and lines:
+            kept.append(lines[0][:keep_tokens - used])
+        return ''.join(kept) + self.OMITTED + '\n'
+
+
+_TERM_RUN = re.compile(r'[一-龠々]+|[ァ-ヴー]{2,}|[a-zA-Z][a-zA-Z0-9]+')
+
+
+def split_terms(text):
+    """文字種ごとの連続から語候補を切り出す（カタカナ語・英単語はそのまま、漢字は4文字まで
+    そのまま・5文字以上は2文字 n-gram。ひらがなは助詞・語尾が大半のため対象外）"""
+    terms = []
+    for match in _TERM_RUN.finditer(text):
+        run = match.group()
+        if run[0].isascii():
+            terms.append(run.lower())
+        elif '\u30a1' <= run[0] <= '\u30ff' or len(run) <= 4:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return [term for term in terms if len(term) >= 2]
+
+
+class TopicIndex:
+    """会話履歴の増分 TF-IDF 索引（自動会話の話題と話し手の選択用）
+
+    発言を1件追加するたびに文書頻度 df と、発言数単位で指数減衰させた語の出現量 tf を更新する
+    （前方減衰で O(語数)）。話題の得点は tf × idf。得点上位 LEADERS 語を追加時に保持しておくため、
+    pick() は履歴の長さに関係なく一定時間で済む。語と話し手の共起数から、その話題に最も関心を
+    示したペルソナも引ける。索引はスナップショットとして保存し、再起動時は未索引の発言だけを追加する。
+    """
+
+    LEADERS = 32
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, path=".gemini_topic_index.json", tokenize=None, half_life=30, stop_words=(),
+                 save_every=20):
+        self.path = Path(path) if path else None
+        self.tokenize = tokenize or split_terms
+        self.decay_rate = math.log(2) / half_life
+        self.stop_words = frozenset(stop_words)
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        self._dirty = 0
+        self.clear()
+        self._load()
+
+    @classmethod
+    def from_env(cls, tokenize=None, stop_words=()):
+        """環境変数から構築（GEMINI_TOPIC_INDEX=0 で無効、保存先は GEMINI_TOPIC_INDEX_FILE）"""
+        if os.environ.get('GEMINI_TOPIC_INDEX', '1') in ('0', 'false', 'off'):
+            return None
+        return cls(os.environ.get('GEMINI_TOPIC_INDEX_FILE', '.gemini_topic_index.json'), tokenize, stop_words=stop_words)
+
+    def clear(self):
+        """索引を破棄（スナップショットは次回保存時に上書き）"""
+        with self._lock:
+            self.documents = 0
+            self.last_key = None
+            self._df = {}
+            self._tf = {}
+            self._cooccurrence = {}
+            self._leaders = []
+            # 前方減衰の基準（発言番号）
+            self._origin = 0
+            self._dirty += 1
+
+    def _idf(self, term):
+        return math.log((1 + self.documents) / (1 + self._df.get(term, 0))) + 1
+
+    def _score(self, term):
+        """現時点の話題得点（減衰を割り戻した tf × idf）"""
+        return self._tf.get(term, 0.0) * math.exp(-self.decay_rate * (self.documents - self._origin)) * self._idf(term)
+
+    def add(self, text, speaker=None, key=None):
+        """発言を索引に追加（speaker: 発言したペルソナ名、key: 再開位置の判定用の時刻文字列）"""
+        terms = [term for term in self.tokenize(text) if term not in self.stop_words]
+        with self._lock:
+            self.documents += 1
+            if key is not None:
+                # 表示時に索引する AI 発言は生成時刻がユーザー発言より前になり得るため、後退させない
+                self.last_key = key if self.last_key is None else max(self.last_key, key)
+            exponent = self.decay_rate * (self.documents - self._origin)
+            if exponent > 50:
+                scale = math.exp(-exponent)
+                self._tf = {term: value * scale for term, value in self._tf.items()}
+                self._origin = self.documents
+                exponent = 0.0
+            increment = math.exp(exponent)
+            for term in set(terms):
+                self._df[term] = self._df.get(term, 0) + 1
+            for term in terms:
+                self._tf[term] = self._tf.get(term, 0.0) + increment
+                if speaker:
+                    speakers = self._cooccurrence.setdefault(term, {})
+                    speakers[speaker] = speakers.get(speaker, 0) + 1
+            for term in set(terms):
+                self._promote(term)
+            self._dirty += 1
+            should_save = self.save_every and self._dirty >= self.save_every
+        if should_save:
+            self.save()
+        return terms
+
+    def _promote(self, term):
+        """得点上位の語一覧（長さ LEADERS）を更新。順序は pick() 時に付け直す"""
+        if term in self._leaders:
+            return
+        if len(self._leaders) < self.LEADERS:
+            self._leaders.append(term)
+            return
+        weakest = min(self._leaders, key=self._score)
+        if self._score(term) > self._score(weakest):
+            self._leaders[self._leaders.index(weakest)] = term
+
+    def sync(self, messages):
+        """(本文, 話し手, 時刻文字列) の列のうち、前回索引した時刻より新しいものだけを追加"""
+        added = 0
+        for text, speaker, key in messages:
+            if self.last_key is not None and key is not None and key <= self.last_key:
+                continue
+            self.add(text, speaker, key)
+            added += 1
+        if added:
+            logger.info(f"話題索引に未索引の発言を追加: {added}件（累計 {self.documents}件）")
+        return added
+
+    def top(self, k=5):
+        """[(語, 得点)] を得点の高い順に最大 k 件"""
+        with self._lock:
+            scored = [(term, self._score(term)) for term in self._leaders]
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored[:k]
+
+    def pick(self, exclude=(), rng=random, pool=8):
+        """上位 pool 語から得点に比例して話題を1つ選ぶ（候補が無ければ None）"""
+        candidates = [(term, score) for term, score in self.top(pool + len(exclude))
+                      if term not in exclude and score > 0][:pool]
+        if not candidates:
+            return None
+        return rng.choices([term for term, _ in candidates], weights=[score for _, score in candidates])[0]
+
+    def interested(self, term, k=3, candidates=None):
+        """その語を多く使ったペルソナを多い順に最大 k 名"""
+        with self._lock:
+            speakers = dict(self._cooccurrence.get(term, {}))
+        ranked = sorted((name for name in speakers if candidates is None or name in candidates),
+                        key=lambda name: speakers[name], reverse=True)
+        return ranked[:k]
+
+    def _load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            if snapshot.get('version') != self.SNAPSHOT_VERSION:
+                return
+            self.documents = snapshot['documents']
+            self.last_key = snapshot.get('last_key')
+            self._df = snapshot['df']
+            self._tf = snapshot['tf']
+            self._cooccurrence = snapshot['cooccurrence']
+            self._leaders = snapshot['leaders']
+            self._origin = snapshot['origin']
+            self._dirty = 0
+            logger.info(f"話題索引を読み込み: {self.documents}件 語彙{len(self._df)}語")
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"話題索引読み込みエラー: {e}")
+            self.clear()
+
+    def save(self):
+        """スナップショットを保存（一時ファイル経由で置き換え）"""
+        if self.path is None:
+            return
+        with self._lock:
+            snapshot = {
+                'version': self.SNAPSHOT_VERSION, 'documents': self.documents, 'last_key': self.last_key,
+                'df': self._df, 'tf': self._tf, 'cooccurrence': self._cooccurrence,
+                'leaders': self._leaders, 'origin': self._origin,
+            }
+            data = json.dumps(snapshot, ensure_ascii=False)
+            self._dirty = 0
+        try:
+            tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"話題索引保存エラー: {e}")
+
+
+class AvailabilityCache:
+    """バックエンド存在確認の結果をディスクに保存し、次回起動時の確認を省略する
+
+    CLI は実行ファイルの更新時刻等をキーとするため、更新・再インストール後は自動で再確認する。
+    失敗結果は保存しない（インストール直後の再起動で即座に使えるように）。
+    """
+
+    def __init__(self, path=".gemini_availability.json", max_age=7 * 24 * 3600):
+        self.path = Path(path)
+        self.max_age = max_age
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """環境変数からキャッシュを構築（GEMINI_AVAILABILITY_CACHE=0 で無効）"""
+        if os.environ.get('GEMINI_AVAILABILITY_CACHE', '1') in ('0', 'false', 'off'):
+            return None
+        return cls(os.environ.get('GEMINI_AVAILABILITY_FILE', '.gemini_availability.json'))
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def lookup(self, backend):
+        """保存済みの成功結果（情報文字列）を返す。無効・期限切れなら None"""
+        key = backend.availability_key()
+        if key is None:
+            return None
+        entry = self._load().get(backend.name)
+        if not entry or entry.get('key') != key:
+            return None
+        if time.time() - entry.get('checked_at', 0) > self.max_age:
+            return None
+        return entry.get('info', '')
+
+    def store(self, backend, info):
+        """成功結果を保存"""
+        key = backend.availability_key()
+        if key is None:
+            return
+        with self._lock:
+            entries = self._load()
+            entries[backend.name] = {'key': key, 'info': info, 'checked_at': time.time()}
+            try:
+                tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(entries, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.warning(f"存在確認キャッシュ保存エラー: {e}")
+
+    def check(self, backend):
+        """キャッシュを優先して存在確認。戻り値: (利用可否, 情報, キャッシュ利用か)"""
+        info = self.lookup(backend)
+        if info is not None:
+            return True, info, True
+        available, info = backend.check_available()
+        if available:
+            self.store(backend, info)
+        return available, info, False
+
+
+def check_backend_available(backend, cache=None):
+    """存在確認（cache が None なら毎回実行）。戻り値: (利用可否, 情報, キャッシュ利用か)"""
+    if cache is None:
+        available, info = backend.check_available()
+        return available, info, False
+    return cache.check(backend)
+
+
+# 設定されていればプール利用の意図があるとみなす環境変数
+_POOL_SETTINGS = ('GEMINI_POOL_SIZE', 'GEMINI_POOL_MAX_REQUESTS', 'GEMINI_POOL_HEALTH_INTERVAL')
+_WORKER_CMD_HINT = ("gemini CLI はワーカープロトコルを話さないため、"
+                   'GEMINI_WORKER_CMD="python gemini_cli_worker.py" のようにアダプタを指定してください')
+
+
+def create_backend_from_env():
+    """環境変数からバックエンドを構築
+
+    GEMINI_BACKEND=cli|stub|pool（既定: GEMINI_WORKER_CMD があれば pool、なければ cli）
+    cli 用: GEMINI_PROMPT_TRANSPORT=auto|argv|stdin|file
+    pool 用: GEMINI_WORKER_CMD（必須。gemini CLI ではなく "python gemini_cli_worker.py" 等のワーカー）,
+             GEMINI_POOL_SIZE, GEMINI_POOL_MAX_REQUESTS, GEMINI_POOL_HEALTH_INTERVAL
+    stub 用: GEMINI_STUB_LATENCY, GEMINI_STUB_JITTER, GEMINI_STUB_ERRORS, GEMINI_STUB_SEED
+    """
+    kind = os.environ.get('GEMINI_BACKEND')
+    if not kind:
+        # プール設定だけ残っている場合に黙って cli へ切り替えない
+        pool_settings = [key for key in _POOL_SETTINGS if os.environ.get(key)]
+        if pool_settings and not os.environ.get('GEMINI_WORKER_CMD'):
+            raise ValueError(f"{', '.join(pool_settings)} が指定されていますが GEMINI_WORKER_CMD が未設定です。"
+                             f"{_WORKER_CMD_HINT}")
+        kind = 'pool' if os.environ.get('GEMINI_WORKER_CMD') else 'cli'
+
+    if kind == 'stub':
+        backend = StubBackend(
+            latency=float(os.environ.get('GEMINI_STUB_LATENCY', 0.5)),
+            jitter=float(os.environ.get('GEMINI_STUB_JITTER', 0.0)),
+            error_rates=_parse_rates(os.environ.get('GEMINI_STUB_ERRORS', '')),
+            seed=int(os.environ.get('GEMINI_STUB_SEED', 0))
+        )
+    elif kind == 'pool':
+        pool = GeminiWorkerPool.from_env()
+        if pool is None:
+            raise ValueError(f"GEMINI_BACKEND=pool には GEMINI_WORKER_CMD の指定が必要です。{_WORKER_CMD_HINT}")
+        backend = WorkerPoolBackend(pool)
+    elif kind == 'cli':
+        backend = GeminiCLIBackend(transport=os.environ.get('GEMINI_PROMPT_TRANSPORT', 'auto'))
+    else:
+        raise ValueError(f"不明なバックエンド: {kind}")
+
+    logger.info(f"バックエンド選択: {backend.name}")
+    return backend
+
+
+class TokenBucket:
+    """トークンバケット（capacity 個まで、refill_period 秒で空から満タンに回復）"""
+
+    def __init__(self, capacity, refill_period):
+        self.capacity = capacity
+        self.rate = capacity / refill_period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        self._refill()
+        return int(self.tokens)
+
+    def wait_time(self, count=1):
+        """count 個取得できるまでの秒数"""
+        self._refill()
+        if self.tokens >= count:
+            return 0.0
+        return (count - self.tokens) / self.rate
+
+    def consume(self, count=1):
+        self._refill()
+        if self.tokens >= count:
+            self.tokens -= count
+            return True
+        return False
+
+
+class DailyQuota:
+    """日次上限（日付が変わると回復）"""
+
+    def __init__(self, limit, used=0):
+        self.limit = limit
+        self.used = used
+        self.day = date.today()
+
+    def _rollover(self):
+        today = date.today()
+        if today != self.day:
+            self.day = today
+            self.used = 0
+
+    def remaining(self):
+        self._rollover()
+        return max(0, self.limit - self.used)
+
+    def wait_time(self):
+        """残りがなければ翌日0時までの秒数"""
+        if self.remaining() > 0:
+            return 0.0
+        tomorrow = datetime.combine(self.day + timedelta(days=1), datetime.min.time())
+        return (tomorrow - datetime.now()).total_seconds()
+
+    def consume(self):
+        if self.remaining() > 0:
+            self.used += 1
+            return True
+        return False
+
+
+class QuotaRateLimiter:
+    """モデル別の分間・日次トークンバケットによるレート制限
+
+    models は gem2 の GeminiModelManager.models 形式
+    （minute_limit / daily_limit / fallback_chain を持つ辞書）。未登録モデルは無制限扱い。
+    """
+
+    def __init__(self, models, max_queue_wait=15.0):
+        self.max_queue_wait = max_queue_wait
+        self.minute = {model: TokenBucket(info['minute_limit'], 60.0) for model, info in models.items()}
+        self.daily = {model: DailyQuota(info['daily_limit']) for model, info in models.items()}
+        self.chains = {model: list(info.get('fallback_chain', [])) for model, info in models.items()}
+        self._lock = threading.Lock()
+        self.stats = {'granted': 0, 'routed': 0, 'queued': 0, 'rejected': 0}
+
+    def try_acquire(self, model):
+        """分間・日次の両方に余裕があれば1回分を消費して True"""
+        with self._lock:
+            if model not in self.minute:
+                return True
+            if self.minute[model].wait_time() > 0 or self.daily[model].remaining() <= 0:
+                return False
+            self.minute[model].consume()
+            self.daily[model].consume()
+            self.stats['granted'] += 1
+            return True
+
+    def wait_time(self, model):
+        """次に利用可能になるまでの秒数"""
+        with self._lock:
+            if model not in self.minute:
+                return 0.0
+            return max(self.minute[model].wait_time(), self.daily[model].wait_time())
+
+    def remaining(self, model):
+        """残り回数 {'minute': n, 'daily': n}（未登録モデルは None）"""
+        with self._lock:
+            if model not in self.minute:
+                return None
+            return {'minute': self.minute[model].available(), 'daily': self.daily[model].remaining()}
+
+    def candidates(self, model):
+        """model と、その fallback_chain をたどって到達できるモデル（重複なし・近い順）"""
+        order = [model]
+        for current in order:
+            for next_model in self.chains.get(current, []):
+                if next_model not in order:
+                    order.append(next_model)
+        return order
+
+    def reserve(self, model):
+        """model か代替モデルで1回分を確保する
+
+        戻り値: (確保したモデル, 0.0) または 全滅時 (None, 最短の待ち秒数)
+        """
+        candidates = self.candidates(model)
+        for candidate in candidates:
+            if self.try_acquire(candidate):
+                if candidate != model:
+                    self.stats['routed'] += 1
+                return candidate, 0.0
+        return None, min(self.wait_time(candidate) for candidate in candidates)
+
+    def record_quota_error(self, model, daily=False):
+        """429 を受けたモデルの残りを0にする（分間なら補充までの冷却、日次なら翌日まで）"""
+        with self._lock:
+            if model not in self.minute:
+                return
+            if daily:
+                self.daily[model].used = max(self.daily[model].used, self.daily[model].limit)
+            else:
+                self.minute[model].tokens = 0.0
+                self.minute[model].updated = time.monotonic()
+
+    def restore(self, ledger):
+        """台帳から本日の利用回数を引き継ぐ（本日クォータ枯渇済みのモデルは残り0とする）"""
+        with self._lock:
+            for model, quota in self.daily.items():
+                quota.used = ledger.counts(model)['call']
+                if ledger.is_exhausted(model, quota.limit):
+                    quota.used = max(quota.used, quota.limit)
+
+
+def is_quota_error(text):
+    """429 / クォータ超過のエラー文字列か（分間・日次を問わない）"""
+    return any(marker in str(text) for marker in ('429', 'Quota exceeded', 'RESOURCE_EXHAUSTED', 'rateLimitExceeded'))
+
+
+_DAILY_QUOTA_MARKERS = re.compile(r'PerDay|per[ _-]?day|daily', re.IGNORECASE)
+
+
+def is_daily_quota_error(text):
+    """日次クォータの超過か（quotaId の ...PerDay... や "requests per day" を含む 429 のみ）
+
+    分間の流量制限による 429 は数十秒で回復するため、日次の枯渇とはみなさない。
+    """
+    return is_quota_error(text) and bool(_DAILY_QUOTA_MARKERS.search(str(text)))
+
+
+def failure_kind(text):
+    """失敗の種別（'daily_quota' / 'quota' / 'error'）"""
+    if is_daily_quota_error(text):
+        return 'daily_quota'
+    return 'quota' if is_quota_error(text) else 'error'
+
+
+class QuotaLedger:
+    """モデル別の呼び出し・エラー・429 を日単位で記録する追記型台帳（JSON Lines）
+
+    再起動後も本日の利用状況を引き継ぐためのもの。日付が変わると前日以前の行を捨てて圧縮する。
+    1回の呼び出しは {'event': 'call', 'outcome': ...} の1行で記録する
+    （outcome は 'error' / 'quota'（分間の 429）/ 'daily_quota'（日次の 429）、成功時は省略）。
+    """
+
+    EVENTS = ('call', 'error', 'quota', 'daily_quota')
+    FAILURES = ('error', 'quota', 'daily_quota')
+    # 本日この回数以上「日次」クォータ超過を受けたモデルは枯渇とみなす（分間の 429 は数えない）
+    QUOTA_EXHAUSTED_THRESHOLD = 1
+
+    def __init__(self, path=".gemini_ledger.jsonl"):
+        self.path = Path(path)
+        self.day = date.today().isoformat()
+        self._counts = {}
+        self._last_time = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def from_env(cls):
+        """環境変数から台帳を構築（GEMINI_LEDGER=0 で無効）"""
+        if os.environ.get('GEMINI_LEDGER', '1') in ('0', 'false', 'off'):
+            return None
+        return cls(os.environ.get('GEMINI_LEDGER_FILE', '.gemini_ledger.jsonl'))
+
+    def _load(self):
+        """本日分の記録を読み込み、前日以前の行があれば圧縮"""
+        if not self.path.exists():
+            return
+        stale = 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        stale += 1
+                        continue
+                    if entry.get('day') != self.day:
+                        stale += 1
+                        continue
+                    self._apply(entry)
+        except OSError as e:
+            logger.warning(f"台帳読み込みエラー: {e}")
+            return
+        if stale:
+            self._compact()
+        logger.info(f"クォータ台帳読み込み: {self.path} (本日{sum(c['call'] for c in self._counts.values())}件)")
+
+    def _apply(self, entry):
+        counts = self._counts.setdefault(entry['model'], dict.fromkeys(self.EVENTS, 0))
+        for event in (entry['event'], entry.get('outcome')):
+            if event in counts:
+                counts[event] += entry.get('count', 1)
+                self._last_time[(entry['model'], event)] = entry['time']
+
+    def _compact(self):
+        """本日分だけを (モデル, イベント) ごとの集計行に書き直す"""
+        temp_path = self.path.with_suffix('.tmp')
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for model, counts in self._counts.items():
+                    for event, count in counts.items():
+                        if count:
+                            entry = {'day': self.day, 'time': self._last_time.get((model, event), 0),
+                                     'model': model, 'event': event, 'count': count}
+                            f.write(json.dumps(entry) + '\n')
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.warning(f"台帳圧縮エラー: {e}")
+
+    def _rollover(self):
+        today = date.today().isoformat()
+        if today != self.day:
+            self.day = today
+            self._counts.clear()
+            self._last_time.clear()
+            self._compact()
+            logger.info(f"クォータ台帳を日付変更で圧縮: {self.day}")
+
+    def record(self, model, event, outcome=None):
+        """イベント（'call' など）を1行で追記（outcome は呼び出しの失敗種別）"""
+        with self._lock:
+            self._rollover()
+            entry = {'day': self.day, 'time': time.time(), 'model': model, 'event': event}
+            if outcome:
+                entry['outcome'] = outcome
+            self._apply(entry)
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry) + '\n')
+            except OSError as e:
+                logger.warning(f"台帳書き込みエラー: {e}")
+
+    def record_result(self, result):
+        """1回の実行結果を呼び出しと失敗種別をまとめた1行で記録"""
+        self.record(result.model, 'call', None if result.ok else failure_kind(result.stderr))
+
+    def counts(self, model):
+        """本日の件数 {'call': n, 'error': n, 'quota': n, 'daily_quota': n}"""
+        with self._lock:
+            self._rollover()
+            return dict(self._counts.get(model, dict.fromkeys(self.EVENTS, 0)))
+
+    def failures(self, model):
+        """本日の失敗件数（429 を含む）"""
+        counts = self.counts(model)
+        return sum(counts[event] for event in self.FAILURES)
+
+    def last_error_time(self, model):
+        """本日最後のエラー（429含む）の時刻（time.time() 基準、なければ 0）"""
+        with self._lock:
+            self._rollover()
+            return max(self._last_time.get((model, event), 0) for event in self.FAILURES)
+
+    def is_exhausted(self, model, daily_limit=None):
+        """本日のクォータを使い切ったとみなせるか（分間の 429 だけでは枯渇としない）"""
+        counts = self.counts(model)
+        if daily_limit is not None and counts['call'] >= daily_limit:
+            return True
+        return counts['daily_quota'] >= self.QUOTA_EXHAUSTED_THRESHOLD
+
+
+CIRCUIT_OPEN_ERROR = "CIRCUIT_OPEN: 回路遮断中のため呼び出しを省略しました"
+RATE_LIMITED_ERROR = "RATE_LIMITED: 利用可能なクォータがないため呼び出しを省略しました"
+
+
+class CircuitBreaker:
+    """1モデル分のサーキットブレーカー（closed → open → half_open → closed / open）"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self):
+        """通常の要求を通してよいか（half_open 中はプローブのみ）"""
+        return self.state == self.CLOSED
+
+    def probe_due(self):
+        return self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def retry_in(self):
+        """open 中ならプローブまでの残り秒数"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self, quota=False):
+        """失敗を記録（429 は即座に、その他は連続 failure_threshold 回で open）"""
+        self.failures += 1
+        if self.state == self.HALF_OPEN or quota or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class CircuitBreakers:
+    """モデル別サーキットブレーカーの集合"""
+
+    STATE_LABELS = {CircuitBreaker.CLOSED: '正常', CircuitBreaker.OPEN: '遮断中', CircuitBreaker.HALF_OPEN: '試験中'}
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0, probe_timeout=15.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = probe_timeout
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """環境変数から構築（GEMINI_BREAKER=0 で無効）"""
+        if os.environ.get('GEMINI_BREAKER', '1') in ('0', 'false', 'off'):
+            return None
+        return cls(
+            failure_threshold=int(os.environ.get('GEMINI_BREAKER_THRESHOLD', 3)),
+            reset_timeout=float(os.environ.get('GEMINI_BREAKER_RESET', 30)),
+            probe_timeout=float(os.environ.get('GEMINI_BREAKER_PROBE_TIMEOUT', 15))
+        )
+
+    def _get(self, model):
+        if model not in self._breakers:
+            self._breakers[model] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return self._breakers[model]
+
+    def allow(self, model):
+        with self._lock:
+            return self._get(model).allow()
+
+    def state(self, model):
+        with self._lock:
+            return self._get(model).state
+
+    def describe(self, model):
+        """表示用の状態文字列"""
+        with self._lock:
+            breaker = self._get(model)
+            label = self.STATE_LABELS[breaker.state]
+            if breaker.state == CircuitBreaker.OPEN:
+                label += f"（{breaker.retry_in():.0f}秒後に試験）"
+            return label
+
+    def record(self, result):
+        """通常要求の結果を反映（キャッシュヒットは対象外）"""
+        if result.cached:
+            return
+        with self._lock:
+            breaker = self._get(result.model)
+            previous = breaker.state
+            if result.ok:
+                breaker.record_success()
+            else:
+                breaker.record_failure(quota=is_quota_error(result.stderr))
+            if breaker.state != previous:
+                logger.warning(f"サーキットブレーカー: {result.model} {previous} -> {breaker.state}")
+
+    def take_due_probes(self):
+        """プローブ時期を迎えたモデルを half_open にして返す"""
+        with self._lock:
+            due = [model for model, breaker in self._breakers.items() if breaker.probe_due()]
+            for model in due:
+                self._breakers[model].state = CircuitBreaker.HALF_OPEN
+            return due
+
+    def record_probe(self, model, ok):
+        with self._lock:
+            breaker = self._get(model)
+            if ok:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+        logger.info(f"サーキットブレーカー試験: {model} {'成功 -> closed' if ok else '失敗 -> open'}")
+
+
+POLICY_FASTEST = 'fastest_under_quota'
+POLICY_QUALITY = 'best_quality_under_latency'
+
+
+class ModelStats:
+    """1モデル分の実測値（レイテンシEWMA・p95・成功率・連続失敗による冷却期間）"""
+
+    def __init__(self, window=50):
+        self.latency_ewma = None
+        self.success_rate = 1.0
+        self.latencies = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.calls = 0
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+    def p95(self):
+        return self.percentile(0.95)
+
+
+class AdaptiveModelRouter:
+    """実測のレイテンシ・成功率・残りクォータに基づいてリクエストごとにモデルを選ぶ
+
+    quality はモデル → 品質順位（小さいほど高品質）。失敗が続いたモデルは
+    base_cooldown * 2^(連続失敗数-1) 秒（最大 max_cooldown 秒）選択対象から外す。
+    """
+
+    ALPHA = 0.3
+    # 実測前のモデルに仮定するレイテンシ（秒）
+    PRIOR_LATENCY = 5.0
+    # p95 を信用するのに必要なサンプル数
+    MIN_SAMPLES = 5
+
+    def __init__(self, quality, rate_limiter=None, base_cooldown=15.0, max_cooldown=1800.0,
+                 max_latency=10.0, breakers=None):
+        self.quality = dict(quality)
+        self.rate_limiter = rate_limiter
+        self.breakers = breakers
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.max_latency = max_latency
+        self.stats = {model: ModelStats() for model in self.quality}
+        self._lock = threading.Lock()
+
+    def record(self, result):
+        """実行結果を反映（キャッシュヒットは対象外）"""
+        if result.cached or result.model not in self.stats:
+            return
+        with self._lock:
+            stats = self.stats[result.model]
+            stats.calls += 1
+            success = 1.0 if result.ok else 0.0
+            stats.success_rate += self.ALPHA * (success - stats.success_rate)
+            if result.ok or result.timed_out:
+                if stats.latency_ewma is None:
+                    stats.latency_ewma = result.elapsed
+                else:
+                    stats.latency_ewma += self.ALPHA * (result.elapsed - stats.latency_ewma)
+                stats.latencies.append(result.elapsed)
+
+            if result.ok:
+                stats.consecutive_failures = 0
+                stats.cooldown_until = 0.0
+            else:
+                stats.consecutive_failures += 1
+                cooldown = self._cooldown(stats.consecutive_failures)
+                stats.cooldown_until = time.time() + cooldown
+                logger.info(f"モデル冷却: {result.model} {cooldown:.0f}秒 (連続失敗{stats.consecutive_failures}回)")
+
+    def record_latency(self, model, elapsed):
+        """打ち切られた呼び出しの経過時間を下限値としてレイテンシ分布に加える（成功率には影響しない）"""
+        with self._lock:
+            stats = self.stats.get(model)
+            if stats is None:
+                return
+            stats.latencies.append(elapsed)
+            if stats.latency_ewma is not None:
+                stats.latency_ewma += self.ALPHA * (max(elapsed, stats.latency_ewma) - stats.latency_ewma)
+
+    def percentile(self, model, q):
+        """レイテンシの q 分位点（サンプル不足なら None）"""
+        with self._lock:
+            stats = self.stats.get(model)
+            if stats is None or len(stats.latencies) < self.MIN_SAMPLES:
+                return None
+            return stats.percentile(q)
+
+    def _cooldown(self, failures):
+        return min(self.max_cooldown, self.base_cooldown * 2 ** (failures - 1))
+
+    def restore_failures(self, model, failures, last_failure_time):
+        """前回起動時の失敗（time.time() 基準の時刻）から冷却期間を復元"""
+        if model not in self.stats or not failures:
+            return
+        with self._lock:
+            stats = self.stats[model]
+            stats.consecutive_failures = failures
+            stats.cooldown_until = last_failure_time + self._cooldown(failures)
+
+    def is_available(self, model):
+        """冷却中でなく、サーキットブレーカーが閉じていれば True"""
+        if self.breakers and not self.breakers.allow(model):
+            return False
+        stats = self.stats.get(model)
+        return stats is None or time.time() >= stats.cooldown_until
+
+    def clear_cooldown(self, model):
+        """冷却期間を解除（プローブ成功時）"""
+        with self._lock:
+            stats = self.stats.get(model)
+            if stats:
+                stats.consecutive_failures = 0
+                stats.cooldown_until = 0.0
+
+    def cooldown_remaining(self, model):
+        stats = self.stats.get(model)
+        return max(0.0, stats.cooldown_until - time.time()) if stats else 0.0
+
+    def _has_quota(self, model):
+        if not self.rate_limiter:
+            return True
+        budget = self.rate_limiter.remaining(model)
+        return budget is None or (budget['minute'] > 0 and budget['daily'] > 0)
+
+    def expected_latency(self, model):
+        """成功率で割り戻した期待レイテンシ（失敗の多いモデルほど遅く見積もる）"""
+        stats = self.stats[model]
+        latency = self.PRIOR_LATENCY if stats.latency_ewma is None else stats.latency_ewma
+        return latency / max(stats.success_rate, 0.1)
+
+    def choose(self, policy, exclude=(), candidates=None):
+        """ポリシーに従ってモデルを選ぶ（候補がなければ None）
+
+        POLICY_FASTEST: 冷却中・クォータ切れを除き期待レイテンシ最小
+        POLICY_QUALITY: さらに p95 が max_latency 秒以内のものから品質順位最上位
+        """
+        with self._lock:
+            usable = [
+                model for model in (candidates or self.quality)
+                if model in self.stats and model not in exclude
+                and self.is_available(model) and self._has_quota(model)
+            ]
+            if not usable:
+                return None
+
+            if policy == POLICY_FASTEST:
+                return min(usable, key=lambda model: (self.expected_latency(model), self.quality[model]))
+
+            within_latency = [model for model in usable if self._within_latency(model)] or usable
+            return min(within_latency, key=lambda model: (self.quality[model], -self.stats[model].success_rate))
+
+    def _within_latency(self, model):
+        stats = self.stats[model]
+        if len(stats.latencies) < self.MIN_SAMPLES:
+            return True
+        return stats.p95() <= self.max_latency
+
+    def snapshot(self, model):
+        """表示用の統計値"""
+        with self._lock:
+            stats = self.stats.get(model)
+            if stats is None:
+                return None
+            return {
+                'latency_ewma': stats.latency_ewma,
+                'p95': stats.p95(),
+                'success_rate': stats.success_rate,
+                'calls': stats.calls,
+                'cooldown': self.cooldown_remaining(model),
+            }
+
+
+class HedgingPolicy:
+    """ヘッジ要求の方針
+
+    主モデルが実測 p90（percentile）を過ぎても応答しなければ secondary(model) が返すモデルへ
+    同じ要求を重ねて送り、先に成功した方を採用してもう一方をキャンセルする。
+    """
+
+    def __init__(self, router, secondary, percentile=0.9, min_delay=1.0):
+        self.router = router
+        self.secondary = secondary
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'primary_wins': 0, 'extra_calls': 0}
+
+    @classmethod
+    def from_env(cls, router, secondary):
+        """環境変数から構築（GEMINI_HEDGE 未設定時は None）"""
+        if os.environ.get('GEMINI_HEDGE', '') not in ('1', 'true', 'on'):
+            return None
+        return cls(
+            router, secondary,
+            percentile=float(os.environ.get('GEMINI_HEDGE_PERCENTILE', 0.9)),
+            min_delay=float(os.environ.get('GEMINI_HEDGE_MIN_DELAY', 1.0))
+        )
+
+    def delay(self, model):
+        """ヘッジを送るまでの待ち秒数（実測不足なら None = ヘッジしない）"""
+        threshold = self.router.percentile(model, self.percentile)
+        if threshold is None:
+            return None
+        return max(self.min_delay, threshold)
+
+    def hedge_rate(self):
+        return self.stats['hedged'] / self.stats['requests'] if self.stats['requests'] else 0.0
+
+
+class _HedgedOutput:
+    """ヘッジ中の2系統の出力を、勝者が決まった系統の分だけ on_output へ流す
+
+    重複要求を送るまでは主系統の出力をそのまま流す。重複要求を送った後は両系統とも溜めておき、
+    finish() で勝者の分だけを流す（敗者の途中出力が表示側へ混ざらないようにする）。
+    """
+
+    def __init__(self, on_output):
+        self.on_output = on_output
+        self.racing = False
+        self.started = False
+        self.buffers = {0: [], 1: []}
+
+    def sink(self, index):
+        if self.on_output is None:
+            return None
+
+        def feed(text):
+            if index == 0 and not self.racing:
+                self.started = True
+                self.on_output(text)
+            else:
+                self.buffers[index].append(text)
+        return feed
+
+    def race(self):
+        """重複要求の送信を通知（以降は勝者が決まるまで出力を溜める）"""
+        self.racing = True
+
+    def finish(self, winner):
+        """勝者の溜めていた出力を流す（finish 後に届いた出力は捨てる）"""
+        buffered = self.buffers[winner]
+        self.buffers = {0: [], 1: []}
+        self.racing = True
+        self.on_output, on_output = None, self.on_output
+        if on_output:
+            for text in buffered:
+                on_output(text)
+
+
+class _Flight:
+    """single-flight の実行中要求（共有タスクと待機者数）"""
+
+    def __init__(self, task, deadline_at=None):
+        self.task = task
+        self.deadline_at = deadline_at
+        self.waiters = 0
+
+    def covers(self, deadline_at):
+        """期限 deadline_at の要求が相乗りできるか（共有タスクの期限の方が先に来ないこと）"""
+        if self.deadline_at is None:
+            return True
+        return deadline_at is not None and deadline_at <= self.deadline_at
+
+
+class AsyncGeminiEngine:
+    """asyncio ベースのバックエンド駆動エンジン
+
+    専用スレッドのイベントループ上でバックエンド（既定は gemini CLI）を駆動する。
+    呼び出し側（Tkスレッド等）は submit() が返す concurrent.futures.Future で結果を受け取る。
+    Future.cancel() で実行中のサブプロセスは kill される。
+    """
+
+    # サーキットブレーカーの half_open 判定に使う軽量プロンプト
+    PROBE_PROMPT = "ping"
+
+    def __init__(self, backend=None, max_concurrency=8, cache=None, rate_limiter=None, ledger=None,
+                 router=None, hedging=None, breakers=None, coalesce=True):
+        self.backend = backend or GeminiCLIBackend()
+        self.max_concurrency = max_concurrency
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.ledger = ledger
+        self.router = router
+        self.hedging = hedging
+        self.breakers = breakers
+        self._probes = set()
+        # 同一 (モデル, プロンプト, timeout 等) の同時要求を1回の呼び出しにまとめる（イベントループスレッドのみで操作）
+        self.coalesce = coalesce
+        self._flights = {}
+        self.coalesce_stats = {'leaders': 0, 'coalesced': 0}
+
+        self.loop = asyncio.new_event_loop()
+        self._semaphore = None
+        self._futures = set()
+        self._futures_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run_loop, daemon=True, name="gemini-engine")
+        self._thread.start()
+        logger.info(f"非同期エンジン起動: 並列数上限={max_concurrency}")
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.loop.run_forever()
+
+    @property
+    def in_flight(self):
+        """実行中・待機中のリクエスト数"""
+        with self._futures_lock:
+            return len(self._futures)
+
+    def submit(self, prompt, model, timeout=30, next_model=None, max_attempts=4, use_cache=True,
+               on_output=None, deadline=None, hedge=False, context=None):
+        """生成リクエストを投入し Future を返す
+
+        next_model(model, result) は失敗時に呼ばれ、次に試すモデル名（なければ None）を返す。
+        イベントループスレッドから呼ばれるため、軽量かつスレッドセーフであること。
+        use_cache=False でキャッシュを参照・保存せずに必ずバックエンドを呼ぶ。
+        on_output(text) は標準出力の受信ごとにイベントループスレッドから呼ばれる。
+        deadline はフォールバックを含めたリクエスト全体の上限秒数（timeout は1回あたり）。
+        hedge=True かつ hedging 設定時は、遅い試行に副モデルへの重複要求を重ねる。
+        context (RequestContext) を渡すと、その期限で打ち切られ、context.cancel() で中断される。
+        """
+        deadline_at = time.monotonic() + deadline if deadline is not None else None
+        if context is not None and context.deadline_at is not None:
+            deadline_at = context.deadline_at if deadline_at is None else min(deadline_at, context.deadline_at)
+        future = asyncio.run_coroutine_threadsafe(
+            self.generate(prompt, model, timeout, next_model, max_attempts, use_cache, on_output,
+                          deadline_at, hedge),
+            self.loop
+        )
+        with self._futures_lock:
+            self._futures.add(future)
+        future.add_done_callback(self._forget)
+        if context is not None:
+            context.track(future)
+        return future
+
+    def _forget(self, future):
+        with self._futures_lock:
+            self._futures.discard(future)
+
+    def cancel_all(self):
+        """実行中の全リクエストをキャンセル"""
+        with self._futures_lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        return len(futures)
+
+    async def generate(self, prompt, model, timeout=30, next_model=None, max_attempts=4,
+                       use_cache=True, on_output=None, deadline_at=None, hedge=False):
+        """フォールバック付き生成（コルーチン）
+
+        同じ (モデル, プロンプト, timeout, 試行回数, ヘッジ) の要求が実行中なら新たに呼び出さず、
+        その結果を共有する（single-flight）。use_cache=False の要求は常に単独で呼び出し、
+        実行中の要求より期限が遅い要求も相乗りしない（先に期限切れになった結果を受け取らないように）。
+        共有タスクは待機者が全員キャンセルしたときだけキャンセルされる。
+        """
+        args = (prompt, model, timeout, next_model, max_attempts, use_cache, on_output, deadline_at, hedge)
+        if not self.coalesce or not use_cache:
+            return await self._generate(*args)
+
+        key = (ResponseCache.make_key(model, prompt), timeout, max_attempts, hedge)
+        flight = self._flights.get(key)
+        if flight is not None and not flight.covers(deadline_at):
+            return await self._generate(*args)
+        leader = flight is None
+        if leader:
+            flight = _Flight(asyncio.ensure_future(self._generate(*args)), deadline_at)
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._land(key, flight))
+            self.coalesce_stats['leaders'] += 1
+        else:
+            self.coalesce_stats['coalesced'] += 1
+            logger.info(f"実行中の同一要求と共有: モデル={model} (累計{self.coalesce_stats['coalesced']}件)")
+
+        flight.waiters += 1
+        try:
+            if leader or deadline_at is None:
+                result = await asyncio.shield(flight.task)
+            else:
+                # 相乗りした側は自分の期限で待つのをやめる（共有タスクは他の待機者のために続行）
+                result = await asyncio.wait_for(asyncio.shield(flight.task),
+                                                max(0.0, deadline_at - time.monotonic()))
+        except asyncio.TimeoutError:
+            flight.waiters -= 1
+            logger.warning(f"期限切れのため共有待ちを打ち切り: モデル={model}")
+            return GenerationResult(model, None, '', '期限切れ', 0.0, timed_out=True)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            if flight.waiters == 0:
+                flight.task.cancel()
+            raise
+        flight.waiters -= 1
+        if leader:
+            return result
+
+        shared = copy.copy(result)
+        shared.coalesced = True
+        if on_output and shared.ok:
+            on_output(shared.stdout)
+        return shared
+
+    def _land(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def _generate(self, prompt, model, timeout=30, next_model=None, max_attempts=4,
+                        use_cache=True, on_output=None, deadline_at=None, hedge=False):
+        """フォールバック付き生成の本体
+
+        deadline_at は time.monotonic() 基準の絶対時刻で、各試行の timeout をその残り時間で切り詰める。
+        キャッシュは (モデル, プロンプト) をキーとし、試行ごとに要求したモデルで引いて、実際に応答した
+        モデル（result.model）で保存する。レート制限による振り替えやヘッジで別モデルが応答した場合でも、
+        要求したモデルのキーに別モデルの応答が入ることはない。
+        """
+        use_cache = use_cache and self.cache is not None
+        attempts = 0
+        while True:
+            attempts += 1
+            attempt_timeout = timeout
+            if deadline_at is not None:
+                remaining = deadline_at - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f"期限切れのため打ち切り: モデル={model} (試行{attempts})")
+                    return GenerationResult(model, None, '', '期限切れ', 0.0, timed_out=True,
+                                            attempts=attempts)
+                attempt_timeout = remaining if timeout is None else min(timeout, remaining)
+
+            requested = model
+            if use_cache:
+                cached = self.cache.get(requested, prompt)
+                if cached is not None:
+                    if on_output:
+                        on_output(cached)
+                    return GenerationResult(model, 0, cached, '', 0.0, attempts=attempts, cached=True)
+
+            if self.breakers:
+                self._start_due_probes()
+            if self.breakers and not self.breakers.allow(model):
+                # 遮断中のモデルは呼び出さずに失敗扱いとし、フォールバックへ回す
+                result = GenerationResult(model, None, '', CIRCUIT_OPEN_ERROR, 0.0)
+            else:
+                admitted = await self._admit(model, deadline_at) if self.rate_limiter else model
+                if admitted is None:
+                    # 代替モデルも含めて枠がなければ呼び出さずに失敗扱いとし、フォールバックへ回す
+                    result = GenerationResult(model, None, '', RATE_LIMITED_ERROR, 0.0)
+                else:
+                    model = admitted
+                    if hedge and self.hedging:
+                        result = await self._run_hedged(prompt, model, attempt_timeout, on_output)
+                    else:
+                        result = await self._run_once(prompt, model, attempt_timeout, on_output)
+                        self._record(result)
+            result.attempts = attempts
+            if use_cache and result.ok and result.stdout.strip():
+                self.cache.put(result.model, prompt, result.stdout)
+            if result.ok or next_model is None or attempts >= max_attempts:
+                return result
+            if result.timed_out and deadline_at is not None and time.monotonic() >= deadline_at:
+                # 全体期限で打ち切られた試行はモデルの問題ではないためフォールバックしない
+                return result
+
+            fallback = next_model(model, result)
+            if not fallback:
+                return result
+            logger.warning(f"フォールバック: {model} -> {fallback} (試行{attempts})")
+            model = fallback
+
+    async def _admit(self, model, deadline_at=None):
+        """送信前にレート制限を確認（空なら代替モデルへ振り替え、短時間なら待機）"""
+        limiter = self.rate_limiter
+        while True:
+            admitted, wait = limiter.reserve(model)
+            if admitted:
+                if admitted != model:
+                    logger.info(f"レート制限による振り替え: {model} -> {admitted}")
+                return admitted
+
+            too_long = wait > limiter.max_queue_wait
+            if deadline_at is not None and time.monotonic() + wait > deadline_at:
+                too_long = True
+            if too_long:
+                limiter.stats['rejected'] += 1
+                logger.warning(f"レート制限: {model} 系統のクォータ枯渇 (待ち{wait:.0f}秒)")
+                return None
+
+            limiter.stats['queued'] += 1
+            logger.info(f"レート制限待ち: {model} {wait:.1f}秒")
+            await asyncio.sleep(wait)
+
+    async def _run_once(self, prompt, model, timeout, on_output=None):
+        """1モデルで1回実行"""
+        async with self._semaphore:
+            return await self.backend.generate(prompt, model, timeout, on_output)
+
+    def _record(self, result):
+        """実行結果を台帳・ルーター・サーキットブレーカーへ反映"""
+        if self.ledger:
+            self.ledger.record_result(result)
+        if self.router:
+            self.router.record(result)
+        if self.breakers:
+            self.breakers.record(result)
+        if self.rate_limiter and not result.ok and is_quota_error(result.stderr):
+            self.rate_limiter.record_quota_error(result.model, daily=is_daily_quota_error(result.stderr))
+
+    def _start_due_probes(self):
+        """half_open に移ったモデルへ軽量プローブをバックグラウンドで送る"""
+        for model in self.breakers.take_due_probes():
+            task = asyncio.ensure_future(self._probe(model))
+            self._probes.add(task)
+            task.add_done_callback(self._probes.discard)
+
+    async def _probe(self, model):
+        """1回だけの軽量要求でブレーカーを閉じるか判定"""
+        ok = False
+        try:
+            if self.rate_limiter and not self.rate_limiter.try_acquire(model):
+                logger.info(f"プローブ見送り（クォータなし）: {model}")
+            else:
+                result = await self._run_once(self.PROBE_PROMPT, model, self.breakers.probe_timeout)
+                if self.ledger:
+                    self.ledger.record_result(result)
+                ok = result.ok and bool(result.stdout.strip())
+        except Exception as e:
+            logger.warning(f"プローブ例外: {model} {e}")
+        self.breakers.record_probe(model, ok)
+        if ok and self.router:
+            self.router.clear_cooldown(model)
+
+    async def _run_hedged(self, prompt, model, timeout, on_output=None):
+        """主モデルが実測 p90 を超えたら副モデルへ重複要求し、先に成功した方を返す"""
+        hedging = self.hedging
+        hedging.stats['requests'] += 1
+        delay = hedging.delay(model)
+        output = _HedgedOutput(on_output)
+        start_time = time.monotonic()
+        primary = asyncio.ensure_future(self._run_once(prompt, model, timeout, output.sink(0)))
+
+        secondary_model = None
+        if delay is not None and (timeout is None or delay < timeout):
+            try:
+                done, _ = await asyncio.wait({primary}, timeout=delay)
+            except asyncio.CancelledError:
+                primary.cancel()
+                raise
+            # 既に出力を流し始めた主系統は詰まっていないので重ねない（表示済みの出力と食い違わないように）
+            if not done and not output.started:
+                secondary_model = hedging.secondary(model)
+        if secondary_model and self.rate_limiter and not self.rate_limiter.try_acquire(secondary_model):
+            secondary_model = None
+        if not secondary_model:
+            result = await primary
+            self._record(result)
+            output.finish(0)
+            return result
+
+        output.race()
+        hedging.stats['hedged'] += 1
+        hedging.stats['extra_calls'] += 1
+        remaining = None if timeout is None else max(0.0, timeout - (time.monotonic() - start_time))
+        logger.info(f"ヘッジ要求: {model} が{delay:.1f}秒以内に応答せず {secondary_model} へ重複送信")
+        secondary = asyncio.ensure_future(self._run_once(prompt, secondary_model, remaining, output.sink(1)))
+
+        tasks = {primary: (0, model), secondary: (1, secondary_model)}
+        pending = set(tasks)
+        results = {}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index, _ = tasks[task]
+                    result = task.result()
+                    self._record(result)
+                    results[index] = result
+                    if result.ok:
+                        hedging.stats['hedge_wins' if index else 'primary_wins'] += 1
+                        output.finish(index)
+                        return result
+        finally:
+            for task in pending:
+                task.cancel()
+                _, task_model = tasks[task]
+                # 打ち切った側もクォータは消費済みとみなし、経過時間をレイテンシ分布へ加える
+                if self.ledger:
+                    self.ledger.record(task_model, 'call')
+                if self.router:
+                    self.router.record_latency(task_model, time.monotonic() - start_time)
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        output.finish(0)
+        return results[0]
+
+    def shutdown(self):
+        """全リクエストをキャンセルしイベントループを停止"""
+        self.cancel_all()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=2)
+        self.backend.close()
+        if self.cache:
+            logger.info(f"応答キャッシュ統計: {self.cache.stats}")
+        if self.coalesce:
+            logger.info(f"同一要求の共有統計: {self.coalesce_stats}")
+        if self.hedging:
+            logger.info(f"ヘッジ統計: {self.hedging.stats} (ヘッジ率{self.hedging.hedge_rate():.0%})")
+        logger.info("非同期エンジン停止")
+
+
+class RequestCancelled(Exception):
+    """RequestContext がキャンセルされた、または期限を過ぎた"""
+
+
+class RequestContext:
+    """一連の生成処理（モデル選択 → プロンプト構築 → 呼び出し → 表示予約）で共有する期限とキャンセル
+
+    cancel() で登録済みの Future をすべてキャンセルし、実行中のサブプロセスを kill させる。
+    各段階では check() を呼び、キャンセル済み・期限切れなら RequestCancelled で処理を打ち切る。
+    """
+
+    def __init__(self, deadline=None, label=""):
+        self.label = label
+        self.deadline_at = time.monotonic() + deadline if deadline is not None else None
+        self._cancelled = threading.Event()
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        """cancel() 済みか（期限切れは含まない）"""
+        return self._cancelled.is_set()
+
+    @property
+    def expired(self):
+        return self.deadline_at is not None and time.monotonic() >= self.deadline_at
+
+    def remaining(self):
+        """期限までの残り秒数（期限なしは None）"""
+        if self.deadline_at is None:
+            return None
+        return max(0.0, self.deadline_at - time.monotonic())
+
+    def check(self):
+        """キャンセル済み・期限切れなら RequestCancelled を送出"""
+        if self._cancelled.is_set():
+            raise RequestCancelled(f"キャンセルされました: {self.label}")
+        if self.expired:
+            raise RequestCancelled(f"期限切れ: {self.label}")
+
+    def track(self, future):
+        """Future を登録（キャンセル済みなら即座にキャンセル）"""
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._futures.add(future)
+                future.add_done_callback(self._forget)
+                return future
+        future.cancel()
+        return future
+
+    def _forget(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def cancel(self):
+        """キャンセルし、実行中の要求をすべて中断"""
+        with self._lock:
+            self._cancelled.set()
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        if futures:
+            logger.info(f"要求をキャンセル: {self.label} ({len(futures)}件)")
+
+
+def run_load_test(engine, prompts, model, timeout=30, next_model=None):
+    """プロンプト群を一斉投入し、完了時間の分布と結果内訳を返す"""
+    start_time = time.monotonic()
+    latencies = []
+    outcomes = {'ok': 0, 'empty': 0, 'timeout': 0, 'error': 0, 'fallback': 0}
+    lock = threading.Lock()
+
+    def on_done(future):
+        elapsed = time.monotonic() - start_time
+        result = future.result()
+        with lock:
+            latencies.append(elapsed)
+            if result.attempts > 1:
+                outcomes['fallback'] += 1
+            if result.timed_out:
+                outcomes['timeout'] += 1
+            elif result.returncode != 0:
+                outcomes['error'] += 1
+            elif not result.stdout.strip():
+                outcomes['empty'] += 1
+            else:
+                outcomes['ok'] += 1
+
+    futures = []
+    for prompt in prompts:
+        future = engine.submit(prompt, model, timeout=timeout, next_model=next_model)
+        future.add_done_callback(on_done)
+        futures.append(future)
+    for future in futures:
+        future.exception()
+
+    latencies.sort()
+    total = time.monotonic() - start_time
+    return {
+        'requests': len(prompts),
+        'total_seconds': total,
+        'throughput': len(prompts) / total if total else 0.0,
+        'p50': latencies[len(latencies) // 2] if latencies else 0.0,
+        'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0,
+        'outcomes': outcomes,
+    }
+
+
+def bench_prompt_transports(sizes=(1024, 16 * 1024, 100 * 1024, 1024 * 1024, 4 * 1024 * 1024), repeats=20,
+                            command=('sh', '-c', 'cat > /dev/null')):
+    """プロンプト転送方式ごとの起動〜終了時間を計測
+
+    command はプロンプトを読み捨てるだけのコマンド（argv 方式では追加引数として無視される）。
+    戻り値: {(方式, サイズ): 平均秒数 または None（E2BIG 等で起動不可）}
+    """
+    async def measure(backend, prompt):
+        start_time = time.monotonic()
+        result = await backend.generate(prompt, 'bench', timeout=30)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr)
+        return time.monotonic() - start_time
+
+    async def run():
+        report = {}
+        for size in sizes:
+            prompt = 'あ' * (size // 3)
+            for transport in ('argv', 'stdin', 'file'):
+                backend = GeminiCLIBackend(command, transport=transport)
+                try:
+                    elapsed = [await measure(backend, prompt) for _ in range(repeats)]
+                    report[(transport, size)] = sum(elapsed) / len(elapsed)
+                except OSError:
+                    report[(transport, size)] = None
+        return report
+
+    return asyncio.run(run())
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="スタブバックエンドによるオフライン負荷試験")
+    parser.add_argument('--transport-bench', action='store_true', help="プロンプト転送方式のベンチマークを実行")
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--errors', default="429=0.1,timeout=0.02,empty=0.02")
+    parser.add_argument('--timeout', type=float, default=5.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    if args.transport_bench:
+        for (transport, size), seconds in bench_prompt_transports().items():
+            label = "起動不可（引数長超過）" if seconds is None else f"{seconds * 1000:.2f}ms"
+            print(f"{transport:>5} {size // 1024:>5}KiB: {label}")
+        raise SystemExit(0)
+    models = ["gemini-2.5-flash", "gemini-1.5-flash", "gemini-2.5-pro", "gemini-1.5-pro"]
+
+    def rotate(model, result):
+        return models[(models.index(model) + 1) % len(models)]
+
+    stub = StubBackend(latency=args.latency, jitter=args.jitter, error_rates=_parse_rates(args.errors))
+    engine = AsyncGeminiEngine(stub, max_concurrency=args.concurrency)
+    prompts = [f"あなたはペルソナ{i}（20歳、テスト）として会話してください。" for i in range(args.requests)]
+    report = run_load_test(engine, prompts, models[0], timeout=args.timeout, next_model=rotate)
+    engine.shutdown()
+
+    print(f"リクエスト数: {report['requests']}  所要時間: {report['total_seconds']:.2f}秒  "
+          f"スループット: {report['throughput']:.1f}件/秒")
+    print(f"完了時間 p50: {report['p50']:.2f}秒  p95: {report['p95']:.2f}秒")
+    print(f"結果内訳: {report['outcomes']}  スタブ統計: {stub.stats}")
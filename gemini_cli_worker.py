@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Gemini CLI 用の常駐ワーカーアダプタ
+GeminiWorkerPool の JSON Lines プロトコルを受け、要求ごとに gemini CLI を実行して結果を返す
+
+gemini CLI 自体はこのプロトコルを話さないため、GEMINI_WORKER_CMD に gemini を直接指定しても動かない。
+このアダプタ経由ではプロセス起動コストは残るが、Python 側の起動・ワーカー管理・ヘルスチェック・
+キャンセル時の入れ替えはプールの仕組みに乗る。CLI 起動コストごと削減したい場合は、
+API クライアントを常駐させて同じプロトコルで応答するワーカーを用意する。
+
+使用例:
+    GEMINI_WORKER_CMD="python gemini_cli_worker.py --timeout 120" python chatter5.py
+"""
+
+import argparse
+import json
+import shlex
+import subprocess
+import sys
+
+from gemini_backend import GeminiCLIBackend
+
+
+def run_cli(cli, model, prompt, timeout):
+    """gemini CLI を1回実行し、プロトコルのレスポンス形式（id 以外）で返す"""
+    data = prompt.encode('utf-8')
+    transport = cli.choose_transport(len(data))
+    try:
+        result = subprocess.run(
+            cli.build_command(prompt, model, transport),
+            input=None if transport == 'argv' else data,
+            stdin=subprocess.DEVNULL if transport == 'argv' else None,
+            capture_output=True,
+            timeout=timeout
+        )
+    except subprocess.TimeoutExpired:
+        # timeout(1) と同じ終了コードで返す
+        return {'returncode': 124, 'stdout': '', 'stderr': f"タイムアウト: {timeout}秒"}
+    except OSError as e:
+        return {'returncode': 127, 'stdout': '', 'stderr': str(e)}
+    return {
+        'returncode': result.returncode,
+        'stdout': result.stdout.decode('utf-8', errors='replace'),
+        'stderr': result.stderr.decode('utf-8', errors='replace')
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gemini CLI 用の常駐ワーカーアダプタ")
+    parser.add_argument('--command', default='gemini', help="gemini CLI の起動コマンド（既定: gemini）")
+    parser.add_argument('--transport', default='auto', choices=GeminiCLIBackend.TRANSPORTS,
+                        help="プロンプトの渡し方（file は標準入力と同じ扱い）")
+    parser.add_argument('--timeout', type=float, default=120.0, help="CLI 1回あたりの実行上限（秒）")
+    args = parser.parse_args()
+
+    cli = GeminiCLIBackend(shlex.split(args.command), transport=args.transport)
+    if not cli.is_installed():
+        sys.stderr.write(f"{cli.command[0]} が見つかりません\n")
+        sys.exit(127)
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        request_id = request.get('id')
+
+        if request.get('type') == 'ping':
+            response = {'returncode': 0, 'stdout': 'pong', 'stderr': ''}
+        elif request.get('type') == 'generate':
+            response = run_cli(cli, request.get('model', ''), request.get('prompt', ''), args.timeout)
+        else:
+            response = {'returncode': 1, 'stdout': '', 'stderr': f"不明な要求: {request.get('type')}"}
+
+        sys.stdout.write(json.dumps(dict(response, id=request_id), ensure_ascii=False) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+"""テスト共通設定
+
+chatter5 は import 時にカレントディレクトリへログファイルを作るため、
+リポジトリを汚さないよう一時ディレクトリへ移動してから読み込む。
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="gemini-tests-"))
+os.environ.setdefault('GEMINI_LEDGER', '0')
@@ -0,0 +1,28 @@
+"""IncrementalBatchParser"""
+
+from gem2 import IncrementalBatchParser
+
+
+def _parse(chunks, restart_at=()):
+    shown = []
+    parser = IncrementalBatchParser(shown.append)
+    for index, chunk in enumerate(chunks):
+        if index in restart_at:
+            parser.restart()
+        parser.feed(chunk)
+    parser.close()
+    return [(conv['speaker'], conv['message']) for conv in shown], parser
+
+
+def test_blocks_are_emitted_as_they_close():
+    shown, parser = _parse(["【A】\nこんにちは\n", "【B】\nやあ\n続き"])
+    assert shown == [("A", "こんにちは"), ("B", "やあ\n続き")]
+    assert parser.message_count == 2
+
+
+def test_fallback_attempt_does_not_repeat_speakers():
+    # 1回目は A を話し終えて B の途中で失敗、2回目は別モデルが最初から出力し直す
+    chunks = ["【A】\n一回目\n【B】\n途中", "【A】\n二回目\n【B】\n完成\n【C】\nどうも\n"]
+    shown, parser = _parse(chunks, restart_at=(1,))
+    assert shown == [("A", "一回目"), ("B", "完成"), ("C", "どうも")]
+    assert parser.message_count == 3
@@ -0,0 +1,89 @@
+"""CircuitBreaker / CircuitBreakers とエンジンのプローブ"""
+
+import time
+
+import pytest
+
+from gemini_backend import CIRCUIT_OPEN_ERROR, AsyncGeminiEngine, CircuitBreakers, GenerationResult, StubBackend
+
+QUOTA = "429 Too Many Requests: Quota exceeded (RESOURCE_EXHAUSTED)"
+PROMPT = "あなたは「A」（テスト）"
+
+
+def _failure(model="m", stderr="boom"):
+    return GenerationResult(model, 1, '', stderr, 0.1)
+
+
+def _wait_for(predicate, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_opens_after_threshold_and_success_resets():
+    breakers = CircuitBreakers(failure_threshold=3, reset_timeout=60)
+    breakers.record(_failure())
+    breakers.record(_failure())
+    breakers.record(GenerationResult("m", 0, "ok", "", 0.1))
+    breakers.record(_failure())
+    breakers.record(_failure())
+    assert breakers.state("m") == 'closed' and breakers.allow("m")
+    breakers.record(_failure())
+    assert breakers.state("m") == 'open' and not breakers.allow("m")
+    assert "遮断中" in breakers.describe("m")
+
+
+def test_quota_error_opens_immediately_and_cached_results_are_ignored():
+    breakers = CircuitBreakers(failure_threshold=3, reset_timeout=60)
+    cached = _failure()
+    cached.cached = True
+    breakers.record(cached)
+    assert breakers.state("m") == 'closed'
+    breakers.record(_failure(stderr=QUOTA))
+    assert breakers.state("m") == 'open'
+
+
+@pytest.mark.parametrize("probe_ok, final", [(True, 'closed'), (False, 'open')])
+def test_half_open_probe_outcome(probe_ok, final):
+    breakers = CircuitBreakers(failure_threshold=1, reset_timeout=0.05)
+    breakers.record(_failure())
+    assert breakers.take_due_probes() == []
+    time.sleep(0.06)
+    assert breakers.take_due_probes() == ["m"]
+    assert breakers.state("m") == 'half_open' and not breakers.allow("m")
+    assert breakers.take_due_probes() == []
+    breakers.record_probe("m", probe_ok)
+    assert breakers.state("m") == final
+
+
+def test_open_breaker_skips_backend_and_falls_back():
+    breakers = CircuitBreakers(failure_threshold=1, reset_timeout=60)
+    breakers.record(_failure())
+    engine = AsyncGeminiEngine(backend=StubBackend(latency=0.01), breakers=breakers)
+    try:
+        skipped = engine.submit(PROMPT, "m").result(timeout=5)
+        assert skipped.stderr == CIRCUIT_OPEN_ERROR and engine.backend.stats['calls'] == 0
+        result = engine.submit(PROMPT, "m", next_model=lambda model, result: "n").result(timeout=5)
+    finally:
+        engine.shutdown()
+    assert result.ok and result.model == "n" and result.attempts == 2
+    assert engine.backend.stats['calls'] == 1
+
+
+@pytest.mark.parametrize("error_rates, final", [({}, 'closed'), ({"429": 1.0}, 'open')])
+def test_engine_probes_due_breakers(error_rates, final):
+    breakers = CircuitBreakers(failure_threshold=1, reset_timeout=0.05, probe_timeout=2)
+    breakers.record(_failure())
+    backend = StubBackend(latency=0.01, model_error_rates={"m": error_rates})
+    engine = AsyncGeminiEngine(backend=backend, breakers=breakers)
+    try:
+        time.sleep(0.06)
+        # 別モデルへの要求をきっかけに、時期を迎えた m へプローブが送られる
+        assert engine.submit(PROMPT, "n").result(timeout=5).ok
+        assert _wait_for(lambda: breakers.state("m") != 'half_open' and backend.stats['calls'] == 2)
+    finally:
+        engine.shutdown()
+    assert breakers.state("m") == final
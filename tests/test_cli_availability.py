@@ -0,0 +1,39 @@
+"""GeminiCLIBackend.check_available"""
+
+import stat
+import sys
+
+from gemini_backend import GeminiCLIBackend
+
+
+def _script(tmp_path, body):
+    path = tmp_path / "fake-gemini"
+    path.write_text(f"#!{sys.executable}\n{body}\n")
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def test_missing_binary():
+    backend = GeminiCLIBackend(["no-such-gemini-binary"])
+    assert not backend.is_installed()
+    available, info = backend.check_available()
+    assert not available and "見つかりません" in info
+
+
+def test_version_is_reported(tmp_path):
+    backend = GeminiCLIBackend([_script(tmp_path, "print('1.2.3')")])
+    assert backend.check_available() == (True, "1.2.3")
+
+
+def test_hung_cli_times_out(tmp_path, monkeypatch):
+    backend = GeminiCLIBackend([_script(tmp_path, "import time; time.sleep(30)")])
+    monkeypatch.setattr(GeminiCLIBackend, 'VERSION_TIMEOUT', 0.3)
+    available, info = backend.check_available()
+    assert not available and "応答しません" in info
+    assert backend.is_installed()
+
+
+def test_failing_cli_reports_error(tmp_path):
+    backend = GeminiCLIBackend([_script(tmp_path, "import sys; sys.exit(3)")])
+    available, info = backend.check_available()
+    assert not available and "3" in info
@@ -0,0 +1,17 @@
+"""GeminiCLIBackend のプロンプト転送方式の選択"""
+
+from gemini_backend import GeminiCLIBackend
+
+
+def test_auto_uses_argv_then_file():
+    backend = GeminiCLIBackend(transport='auto')
+    assert backend.choose_transport(100) == 'argv'
+    assert backend.choose_transport(GeminiCLIBackend.ARGV_LIMIT) == 'argv'
+    assert backend.choose_transport(GeminiCLIBackend.ARGV_LIMIT + 1) == 'file'
+    assert backend.choose_transport(100 * 1024) == 'file'
+    assert backend.choose_transport(8 * 1024 * 1024) == 'file'
+
+
+def test_explicit_transport_is_kept():
+    assert GeminiCLIBackend(transport='stdin').choose_transport(100 * 1024) == 'stdin'
+    assert GeminiCLIBackend(transport='argv').choose_transport(100 * 1024) == 'argv'
@@ -0,0 +1,119 @@
+"""gemini_cli_worker.py（GeminiWorkerPool 経由で gemini CLI を呼ぶアダプタ）"""
+
+import asyncio
+import os
+import stat
+import sys
+
+import pytest
+
+from gemini_backend import GeminiCLIBackend, GeminiWorkerPool, WorkerPoolBackend, create_backend_from_env
+
+ADAPTER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gemini_cli_worker.py")
+
+# --model M [--prompt P] を受け、プロンプトが無ければ標準入力から読む疑似 gemini CLI
+FAKE_CLI = """
+import sys
+args = sys.argv[1:]
+model = args[args.index('--model') + 1]
+prompt = args[args.index('--prompt') + 1] if '--prompt' in args else sys.stdin.read()
+if 'sleep' in prompt:
+    import time; time.sleep(30)
+if model == 'quota':
+    sys.stderr.write('429 Too Many Requests'); sys.exit(1)
+print(f"{model}:{'argv' if '--prompt' in args else 'stdin'}:{len(prompt)}")
+"""
+
+
+@pytest.fixture
+def fake_cli(tmp_path):
+    path = tmp_path / "fake-gemini"
+    path.write_text(f"#!{sys.executable}\n{FAKE_CLI}\n")
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def _pool(*args):
+    return GeminiWorkerPool([sys.executable, ADAPTER, *args], pool_size=1, health_check_interval=0)
+
+
+def test_generate_runs_cli(fake_cli):
+    pool = _pool('--command', fake_cli)
+    try:
+        assert pool.health_check() == 1
+        result = pool.generate("こんにちは", "gemini-2.5-flash", timeout=10)
+        assert result.returncode == 0
+        assert result.stdout.strip() == "gemini-2.5-flash:argv:5"
+    finally:
+        pool.close()
+
+
+def test_large_prompt_goes_through_stdin(fake_cli):
+    pool = _pool('--command', fake_cli)
+    size = GeminiCLIBackend.ARGV_LIMIT + 1
+    try:
+        result = pool.generate("a" * size, "m", timeout=10)
+        assert result.stdout.strip() == f"m:stdin:{size}"
+    finally:
+        pool.close()
+
+
+def test_cli_error_is_passed_through(fake_cli):
+    pool = _pool('--command', fake_cli)
+    try:
+        result = pool.generate("x", "quota", timeout=10)
+        assert result.returncode == 1 and "429" in result.stderr
+    finally:
+        pool.close()
+
+
+def test_cli_timeout(fake_cli):
+    pool = _pool('--command', fake_cli, '--timeout', '0.3')
+    try:
+        result = pool.generate("sleep", "m", timeout=10)
+        assert result.returncode == 124 and "タイムアウト" in result.stderr
+    finally:
+        pool.close()
+
+
+def test_missing_cli_is_reported():
+    backend = WorkerPoolBackend(_pool('--command', 'no-such-gemini-binary'))
+    try:
+        available, info = backend.check_available()
+        assert not available and "gemini_cli_worker.py" in info
+    finally:
+        backend.close()
+
+
+def test_cli_without_protocol_is_reported(fake_cli):
+    # gemini CLI を直接ワーカーに指定した場合
+    backend = WorkerPoolBackend(GeminiWorkerPool([fake_cli], pool_size=1, health_check_interval=0))
+    try:
+        available, info = backend.check_available()
+        assert not available and "ping に応答しません" in info
+    finally:
+        backend.close()
+
+
+def test_pool_backend_generates(fake_cli):
+    backend = WorkerPoolBackend(_pool('--command', fake_cli))
+    try:
+        result = asyncio.run(backend.generate("abc", "m", timeout=10))
+        assert result.returncode == 0 and result.stdout.strip() == "m:argv:3"
+    finally:
+        backend.close()
+
+
+def test_pool_requires_worker_command(monkeypatch):
+    monkeypatch.setenv('GEMINI_BACKEND', 'pool')
+    monkeypatch.delenv('GEMINI_WORKER_CMD', raising=False)
+    with pytest.raises(ValueError, match="gemini_cli_worker.py"):
+        create_backend_from_env()
+
+
+def test_pool_settings_without_worker_command(monkeypatch):
+    monkeypatch.delenv('GEMINI_BACKEND', raising=False)
+    monkeypatch.delenv('GEMINI_WORKER_CMD', raising=False)
+    monkeypatch.setenv('GEMINI_POOL_SIZE', '4')
+    with pytest.raises(ValueError, match="GEMINI_POOL_SIZE"):
+        create_backend_from_env()
@@ -0,0 +1,47 @@
+"""AsyncGeminiEngine のキャッシュキーとレート制限時のフォールバック"""
+
+from gemini_backend import RATE_LIMITED_ERROR, AsyncGeminiEngine, QuotaRateLimiter, ResponseCache, StubBackend
+
+PROMPT = "あなたは「A」（テスト）"
+
+
+def _limiter(**minute_limits):
+    models = {model: {'minute_limit': limit, 'daily_limit': 100, 'fallback_chain': []}
+              for model, limit in minute_limits.items()}
+    models['main']['fallback_chain'] = ['spare']
+    return QuotaRateLimiter(models, max_queue_wait=0.0)
+
+
+def test_rerouted_reply_is_cached_under_the_model_that_answered():
+    limiter = _limiter(main=1, spare=5)
+    assert limiter.try_acquire('main')
+    cache = ResponseCache(directory=None)
+    engine = AsyncGeminiEngine(backend=StubBackend(latency=0.01), cache=cache, rate_limiter=limiter)
+    try:
+        first = engine.submit(PROMPT, 'main').result(timeout=5)
+        assert cache.get('main', PROMPT) is None
+        second = engine.submit(PROMPT, 'spare').result(timeout=5)
+    finally:
+        engine.shutdown()
+    assert first.ok and first.model == 'spare' and not first.cached
+    assert second.cached and second.model == 'spare' and second.stdout == first.stdout
+    assert engine.backend.stats['calls'] == 1
+
+
+def test_rate_limited_request_goes_through_fallback():
+    limiter = _limiter(main=1, spare=1, other=5)
+    assert limiter.try_acquire('main') and limiter.try_acquire('spare')
+    seen = []
+
+    def next_model(model, result):
+        seen.append((model, result.stderr))
+        return 'other'
+
+    engine = AsyncGeminiEngine(backend=StubBackend(latency=0.01), rate_limiter=limiter)
+    try:
+        result = engine.submit(PROMPT, 'main', next_model=next_model).result(timeout=5)
+    finally:
+        engine.shutdown()
+    assert seen == [('main', RATE_LIMITED_ERROR)]
+    assert result.ok and result.model == 'other' and result.attempts == 2
+    assert limiter.stats['rejected'] == 1
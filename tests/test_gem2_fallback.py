@@ -0,0 +1,58 @@
+"""gem2 のフォールバック選択（エンジンのイベントループから呼ばれる部分）"""
+
+import queue
+import threading
+from types import SimpleNamespace
+
+from gem2 import GeminiAutoModelChat, GeminiModelManager
+from gemini_backend import GenerationResult
+
+QUOTA = "429 Too Many Requests: Quota exceeded"
+
+
+def _app(manager):
+    return SimpleNamespace(model_manager=manager, output_queue=queue.Queue())
+
+
+def _select(app, model, stderr, **kwargs):
+    result = GenerationResult(model, 1, '', stderr, 0.1)
+    return GeminiAutoModelChat.select_fallback_model(app, model, result, **kwargs)
+
+
+def test_fallback_is_chosen_without_touching_the_gui():
+    manager = GeminiModelManager()
+    manager.current_model = "gemini-2.5-pro"
+    app = _app(manager)
+    caller = []
+    thread = threading.Thread(target=lambda: caller.append(_select(app, "gemini-2.5-pro", QUOTA)))
+    thread.start()
+    thread.join()
+    assert caller == ["gemini-2.5-flash"]
+    assert manager.current_model == "gemini-2.5-flash"
+    assert app.output_queue.get_nowait() == ("MODEL_FALLBACK", ("gemini-2.5-pro", "gemini-2.5-flash", 1))
+
+
+def test_no_fallback_for_other_errors_or_when_disabled():
+    manager = GeminiModelManager()
+    app = _app(manager)
+    assert _select(app, manager.current_model, "syntax error") is None
+    assert _select(app, manager.current_model, QUOTA, auto_fallback=False) is None
+    assert app.output_queue.empty()
+
+
+def test_fallback_follows_the_model_that_failed():
+    manager = GeminiModelManager()
+    manager.current_model = "gemini-2.5-pro"
+    app = _app(manager)
+    # 振り替え先の gemini-2.5-flash が失敗した場合、その次は 2.5-flash の fallback_chain から選ぶ
+    assert _select(app, "gemini-2.5-flash", QUOTA) == "gemini-1.5-flash"
+    assert manager.error_history == {"gemini-2.5-flash": 1}
+    assert app.output_queue.get_nowait()[1][0] == "gemini-2.5-flash"
+
+
+def test_fallback_skips_models_with_open_breaker():
+    manager = GeminiModelManager()
+    for _ in range(manager.breakers.failure_threshold):
+        manager.breakers.record(GenerationResult("gemini-2.5-flash", 1, '', "boom", 0.1))
+    assert manager.breakers.state("gemini-2.5-flash") == 'open'
+    assert _select(_app(manager), "gemini-2.5-pro", QUOTA) == "gemini-1.5-flash"
@@ -0,0 +1,59 @@
+"""_HedgedOutput とヘッジ要求の出力順序"""
+
+from gemini_backend import AsyncGeminiEngine, HedgingPolicy, StubBackend, _HedgedOutput
+
+
+def test_primary_streams_until_race():
+    shown = []
+    output = _HedgedOutput(shown.append)
+    primary = output.sink(0)
+    primary("a")
+    assert shown == ["a"] and output.started
+    output.finish(0)
+    primary("late")
+    assert shown == ["a"]
+
+
+def test_only_winner_output_is_shown_after_race():
+    shown = []
+    output = _HedgedOutput(shown.append)
+    primary, secondary = output.sink(0), output.sink(1)
+    output.race()
+    primary("loser-1")
+    secondary("winner-1")
+    secondary("winner-2")
+    primary("loser-2")
+    assert shown == []
+    output.finish(1)
+    assert shown == ["winner-1", "winner-2"]
+    primary("loser-3")
+    assert shown == ["winner-1", "winner-2"]
+
+
+def test_without_on_output_sinks_are_none():
+    output = _HedgedOutput(None)
+    assert output.sink(0) is None and output.sink(1) is None
+    output.finish(0)
+
+
+class _FixedPercentile:
+    def __init__(self, value):
+        self.value = value
+
+    def percentile(self, model, q):
+        return self.value
+
+
+def test_engine_shows_only_hedge_winner():
+    backend = StubBackend(latency=0.05, model_error_rates={"slow": {"timeout": 1.0}}, hang_time=2.0)
+    hedging = HedgingPolicy(_FixedPercentile(0.05), lambda model: "fast", min_delay=0.05)
+    engine = AsyncGeminiEngine(backend=backend, hedging=hedging, coalesce=False)
+    shown = []
+    try:
+        result = engine.submit("あなたは「A」（テスト）", "slow", timeout=5, hedge=True,
+                               on_output=shown.append).result(timeout=5)
+    finally:
+        engine.shutdown()
+    assert result.ok and result.model == "fast"
+    assert "".join(shown) == result.stdout
+    assert hedging.stats['hedge_wins'] == 1
@@ -0,0 +1,69 @@
+"""KeywordAutomaton / PersonaInterestMatcher"""
+
+from chatter5 import DynamicPromptGenerator, KeywordAutomaton, PersonaDefinitions, PersonaInterestMatcher
+
+
+def test_iter_matches_reports_overlapping_positions():
+    automaton = KeywordAutomaton([('he', 'he'), ('she', 'she'), ('hers', 'hers'), ('his', 'his')])
+    assert list(automaton.iter_matches('ushers')) == [(1, 4, 'she'), (2, 4, 'he'), (2, 6, 'hers')]
+
+
+def test_add_after_match_does_not_duplicate_outputs():
+    automaton = KeywordAutomaton([('b', 'B')])
+    assert list(automaton.iter_matches('ab')) == [(1, 2, 'B')]
+    automaton.add('ab', 'AB')
+    assert sorted(automaton.iter_matches('ab')) == [(0, 2, 'AB'), (1, 2, 'B')]
+    automaton.add('xb', 'XB')
+    assert sorted(automaton.iter_matches('ab')) == [(0, 2, 'AB'), (1, 2, 'B')]
+    # b / ab(+b) / xb(+b)。作り直しても出力は増えない
+    assert sum(len(outputs) for outputs in automaton._outputs) == 5
+    automaton._build()
+    assert sum(len(outputs) for outputs in automaton._outputs) == 5
+
+
+def test_matched_values_counts_each_pattern_once():
+    automaton = KeywordAutomaton([('ab', 1), ('b', 2), ('c', 3)])
+    assert sorted(automaton.matched_values('abab')) == [1, 2]
+
+
+def test_matcher_agrees_with_substring_counts():
+    generator = DynamicPromptGenerator()
+    messages = ["テクノロジーとSNSとマーケティング", "料理とアニメ", "", "sns TREND"]
+    for message in messages:
+        for name, persona in PersonaDefinitions.PERSONAS.items():
+            expected = sum(1 for topic in persona["interest_topics"] if topic.lower() in message.lower())
+            assert generator.interest_matcher.topic_matches(name, message) == expected
+
+
+def test_matcher_with_custom_personas():
+    matcher = PersonaInterestMatcher({
+        "a": {"interest_topics": ["猫", "犬"], "keywords": ["ペット"]},
+        "b": {"interest_topics": ["犬"], "keywords": []},
+    })
+    assert matcher.scan("猫と犬のペット") == {
+        "a": {'topics': 2, 'keywords': 1}, "b": {'topics': 1, 'keywords': 0}}
+    assert matcher.scan("魚") == {}
+
+
+def test_build_is_explicit_and_idempotent():
+    automaton = KeywordAutomaton([('he', 1), ('she', 2)])
+    assert automaton.build() is automaton and automaton._built
+    outputs = [list(state) for state in automaton._outputs]
+    automaton.build()
+    assert automaton._outputs == outputs
+
+
+def test_matcher_publishes_only_built_automatons():
+    import threading
+
+    personas = {"a": {"interest_topics": ["猫"], "keywords": []}}
+    matcher = PersonaInterestMatcher(personas)
+    with matcher._lock:
+        assert matcher._ensure_automaton()._built
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(matcher.scan("猫が好き"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [{"a": {'topics': 1, 'keywords': 0}}] * 8
@@ -0,0 +1,72 @@
+"""KeywordTracker"""
+
+import time
+
+import pytest
+
+from chatter5 import KeywordTracker
+
+T0 = time.time()
+
+
+def test_tokenize_prefers_dictionary_terms_and_drops_stop_words():
+    tracker = KeywordTracker()
+    tokens = tracker.tokenize("みゆきさん、ビジネス戦略とAIの話。人工知能研究開発のこと")
+    assert "ビジネス戦略" in tokens and "戦略" not in tokens
+    assert "研究" in tokens and "人工知能" in tokens and "開発" in tokens
+    assert "ai" in tokens
+    assert "みゆき" not in tokens and "こと" not in tokens
+
+
+def test_top_orders_by_weighted_count():
+    tracker = KeywordTracker(weights={'ai': 0.5})
+    tracker.add_text("テクノロジー", now=T0)
+    tracker.add_text("医療 医療", source='ai', now=T0)
+    tracker.add_text("アート", source='ai', now=T0)
+    top = tracker.top(3, now=T0)
+    assert sorted(token for token, _ in top[:2]) == ["テクノロジー", "医療"]
+    assert [weight for _, weight in top] == pytest.approx([1.0, 1.0, 0.5])
+    assert top[2][0] == "アート"
+
+
+def test_counts_decay_with_half_life():
+    tracker = KeywordTracker(half_life=10)
+    tracker.add_text("テクノロジー", now=T0)
+    tracker.add_text("アート", now=T0 + 10)
+    top = dict(tracker.top(2, now=T0 + 10))
+    assert top["テクノロジー"] == pytest.approx(0.5)
+    assert top["アート"] == pytest.approx(1.0)
+    assert tracker.top(1, now=T0 + 10)[0][0] == "アート"
+    # 基準時刻の移し替え後も減衰後の値は変わらない
+    tracker.add_text("アート", now=T0 + 10 + 1000)
+    assert dict(tracker.top(2, now=T0 + 1010))["アート"] == pytest.approx(1.0 + 2 ** -100)
+
+
+def test_space_saving_keeps_capacity_and_inherits_minimum():
+    tracker = KeywordTracker(capacity=3, half_life=1e9)
+    for token, times in (("テクノロジー", 5), ("マーケティング", 3), ("アート", 1)):
+        for _ in range(times):
+            tracker.add_text(token, now=T0)
+    tracker.add_text("データ分析", now=T0)
+    assert len(tracker) == 3
+    top = dict(tracker.top(3, now=T0))
+    assert "アート" not in top
+    # 追い出した語の値（1）を引き継いで 1 + 1
+    assert top["データ分析"] == pytest.approx(2.0)
+    assert tracker.top(1, now=T0)[0][0] == "テクノロジー"
+
+
+def test_leaders_match_full_sort():
+    tracker = KeywordTracker(capacity=50, half_life=1e9)
+    words = ["テクノロジー", "マーケティング", "アート", "医療", "健康", "科学", "研究", "トレンド"]
+    for index in range(200):
+        tracker.add_text(words[(index * index + 3 * index) % len(words)], now=T0)
+    expected = sorted(tracker._counts.items(), key=lambda item: -item[1])[:5]
+    assert [count for _, count in tracker.top(5, now=T0)] == pytest.approx([count for _, count in expected])
+
+
+def test_clear_resets():
+    tracker = KeywordTracker()
+    tracker.add_text("テクノロジー")
+    tracker.clear()
+    assert len(tracker) == 0 and tracker.top() == []
@@ -0,0 +1,95 @@
+"""AdaptiveModelRouter"""
+
+import time
+
+import pytest
+
+from gemini_backend import (POLICY_FASTEST, POLICY_QUALITY, AdaptiveModelRouter, GenerationResult,
+                            QuotaRateLimiter)
+
+QUALITY = {"pro": 0, "flash": 1, "lite": 2}
+
+
+def _ok(model, elapsed):
+    return GenerationResult(model, 0, "ok", "", elapsed)
+
+
+def _fail(model):
+    return GenerationResult(model, 1, "", "boom", 0.1)
+
+
+def test_cooldown_doubles_up_to_max_and_resets_on_success():
+    router = AdaptiveModelRouter(QUALITY, base_cooldown=10, max_cooldown=35)
+    expected = [10, 20, 35, 35]
+    for cooldown in expected:
+        router.record(_fail("pro"))
+        assert router.cooldown_remaining("pro") == pytest.approx(cooldown, abs=1)
+        assert not router.is_available("pro")
+    router.record(_ok("pro", 1.0))
+    assert router.cooldown_remaining("pro") == 0 and router.is_available("pro")
+    router.record(_fail("pro"))
+    assert router.cooldown_remaining("pro") == pytest.approx(10, abs=1)
+    router.clear_cooldown("pro")
+    assert router.is_available("pro")
+
+
+def test_restore_failures_uses_last_failure_time():
+    router = AdaptiveModelRouter(QUALITY, base_cooldown=10)
+    router.restore_failures("pro", 3, time.time() - 30)
+    assert router.cooldown_remaining("pro") == pytest.approx(10, abs=1)
+    router.restore_failures("flash", 1, time.time() - 30)
+    assert router.is_available("flash")
+
+
+def test_ewma_and_percentiles():
+    router = AdaptiveModelRouter(QUALITY)
+    for elapsed in (1.0, 2.0, 3.0, 4.0):
+        router.record(_ok("flash", elapsed))
+    # 1 → 1.3 → 1.81 → 2.467
+    assert router.snapshot("flash")['latency_ewma'] == pytest.approx(2.467)
+    assert router.percentile("flash", 0.9) is None
+    router.record(_ok("flash", 10.0))
+    assert router.percentile("flash", 0.9) == 10.0
+    assert router.snapshot("flash")['p95'] == 10.0
+    cached = _ok("flash", 100.0)
+    cached.cached = True
+    router.record(cached)
+    assert router.snapshot("flash")['calls'] == 5
+
+
+def test_fastest_policy_prefers_low_expected_latency():
+    router = AdaptiveModelRouter(QUALITY)
+    for _ in range(5):
+        router.record(_ok("pro", 4.0))
+        router.record(_ok("flash", 1.0))
+    # 未計測の lite は PRIOR_LATENCY で見積もる
+    assert router.choose(POLICY_FASTEST) == "flash"
+    # 失敗が続くと成功率で割り戻した期待レイテンシが伸びる（冷却は外して比較）
+    for _ in range(4):
+        router.record(_fail("flash"))
+    router.clear_cooldown("flash")
+    assert router.expected_latency("flash") > router.expected_latency("pro")
+    assert router.choose(POLICY_FASTEST) == "pro"
+    assert router.choose(POLICY_FASTEST, exclude=("pro", "flash")) == "lite"
+
+
+def test_quality_policy_prefers_rank_within_latency_limit():
+    router = AdaptiveModelRouter(QUALITY, max_latency=5.0)
+    assert router.choose(POLICY_QUALITY) == "pro"
+    for _ in range(5):
+        router.record(_ok("pro", 8.0))
+        router.record(_ok("flash", 2.0))
+    assert router.choose(POLICY_QUALITY) == "flash"
+    router.record(_fail("flash"))
+    assert router.choose(POLICY_QUALITY) == "lite"
+    # 条件を満たすモデルが無ければ品質順位で選ぶ
+    assert router.choose(POLICY_QUALITY, candidates=["pro"]) == "pro"
+
+
+def test_models_without_quota_are_skipped():
+    limiter = QuotaRateLimiter({model: {'minute_limit': 1, 'daily_limit': 10} for model in QUALITY})
+    router = AdaptiveModelRouter(QUALITY, rate_limiter=limiter)
+    assert limiter.try_acquire("pro")
+    assert router.choose(POLICY_QUALITY) == "flash"
+    assert limiter.try_acquire("flash") and limiter.try_acquire("lite")
+    assert router.choose(POLICY_QUALITY) is None
@@ -0,0 +1,53 @@
+"""NameMentionDetector の検出・除外規則"""
+
+import pytest
+
+from chatter5 import NameMentionDetector
+
+
+@pytest.fixture
+def detector():
+    return NameMentionDetector({'みゆきち': 'みゆき', 'りゅう': '龍之介', 'Eric': 'エリック'})
+
+
+def personas(detector, message):
+    return [mention['persona'] for mention in detector.detect(message)]
+
+
+@pytest.mark.parametrize("message, expected", [
+    # 肩書き・挨拶に続く呼びかけ
+    ("健太郎先生、どう思う？", ["健太郎"]),
+    ("花子先生に質問", ["花子"]),
+    ("正一部長はどう？", ["正一"]),
+    ("健太郎医師", ["健太郎"]),
+    ("ありがとうみゆき", ["みゆき"]),
+    ("おはようりな！", ["りな"]),
+    ("りなどう思う？", ["りな"]),
+    ("昨日花子に会った", ["花子"]),
+    ("ねえりな、", ["りな"]),
+    ("みゆきとさやかと健太郎さん", ["みゆき", "さやか", "健太郎"]),
+    ("龍之介くんとりゅうさん", ["龍之介", "龍之介"]),
+    ("みゆきちー！", ["みゆき"]),
+    ("Ericとジュリアン", ["エリック"]),
+    # 語の一部は呼びかけとみなさない
+    ("ありなしで言うと", []),
+    ("つまりなにが言いたいの", []),
+    ("夏海岸に行った", []),
+    ("アヤシイ話", []),
+    ("美香子さん", []),
+    ("Americaの話", []),
+])
+def test_detects_mentions(detector, message, expected):
+    assert personas(detector, message) == expected
+
+
+def test_reports_position_honorific_and_at(detector):
+    assert detector.detect("健太郎先生、") == [
+        {'persona': '健太郎', 'alias': '健太郎', 'start': 0, 'end': 5, 'honorific': '先生', 'at': False}]
+    mention, = detector.detect("@りなちゃん")
+    assert (mention['start'], mention['end'], mention['honorific'], mention['at']) == (0, 6, 'ちゃん', True)
+
+
+def test_filters_by_active_personas(detector):
+    assert personas(detector, "みゆきと花子") == ["みゆき", "花子"]
+    assert [m['persona'] for m in detector.detect("みゆきと花子", ["花子"])] == ["花子"]
@@ -0,0 +1,49 @@
+"""PersonaAffinityModel"""
+
+import random
+
+import pytest
+
+from chatter5 import PersonaAffinityModel
+
+PERSONAS = {
+    "a": {"interest_topics": ["猫"], "keywords": ["ペット"], "traits": [], "big5": {"extraversion": 50}},
+    "b": {"interest_topics": ["犬"], "keywords": [], "traits": [], "big5": {"extraversion": 100}},
+    "c": {"interest_topics": [], "keywords": [], "traits": ["冷静"], "big5": {"extraversion": 0}},
+}
+WEIGHTS = {"topic": 2.0, "keyword": 1.0, "trait": 0.5, "extraversion": 1.0,
+           "openness": 0.0, "agreeableness": 0.0}
+
+
+@pytest.fixture
+def model():
+    return PersonaAffinityModel({name: dict(persona) for name, persona in PERSONAS.items()}, weights=WEIGHTS)
+
+
+def test_scores_combine_terms_and_big5(model):
+    assert model.scores("猫のペットが欲しい") == pytest.approx({"a": 3.0, "b": 1.0, "c": -1.0})
+    assert model.scores("犬と猫", candidates=["a", "b", "x"]) == pytest.approx({"a": 2.0, "b": 3.0})
+
+
+def test_definition_changes_are_picked_up(model):
+    model._personas["c"] = dict(PERSONAS["c"], interest_topics=["猫"])
+    del model._personas["b"]
+    model._personas["d"] = {"interest_topics": ["魚"], "big5": {}}
+    assert model.scores("猫と魚") == pytest.approx({"a": 2.0, "c": 1.0, "d": 2.0})
+
+
+def test_probabilities_are_capped_softmax(model):
+    probabilities = model.probabilities({"a": 2.0, "b": 0.0}, expected=1.0, temperature=1.0)
+    assert sum(probabilities.values()) == pytest.approx(1.0)
+    assert probabilities["a"] > probabilities["b"]
+    assert model.probabilities({"a": 5.0, "b": 5.0}, expected=4.0) == {"a": 1.0, "b": 1.0}
+    assert model.probabilities({}, expected=2.0) == {}
+
+
+def test_select_respects_minimum_and_top_k(model):
+    rng = random.Random(0)
+    for _ in range(20):
+        chosen = model.select("猫のペット", ["a", "b", "c"], expected=0.1, minimum=2, top_k=2, rng=rng)
+        assert len(chosen) == 2 and len(set(chosen)) == 2
+    chosen = model.select("猫のペット", ["a", "b", "c"], expected=10.0, top_k=2, rng=rng)
+    assert chosen == ["a", "b"]
@@ -0,0 +1,25 @@
+"""PromptBudgeter"""
+
+from gemini_backend import PromptBudgeter, PromptSection
+
+
+def _sections(history_lines):
+    return [
+        PromptSection('persona', "人物設定\n", priority=90, trim=None),
+        PromptSection('context', "".join(f"発言{i}\n" for i in range(history_lines)), priority=10, trim='head',
+                      header="【履歴】\n"),
+        PromptSection('user_message', "こんにちは\n", priority=100, trim=None),
+    ]
+
+
+def test_report_is_returned_per_call():
+    budgeter = PromptBudgeter(default_budget=60)
+    prompt, report = budgeter.build(_sections(2), label="small")
+    assert report['trimmed'] == [] and report['before'] == report['after']
+    assert prompt.startswith("人物設定\n【履歴】\n発言0")
+
+    prompt, report = budgeter.build(_sections(50), label="large")
+    assert report['label'] == "large" and report['trimmed'] == ['context']
+    assert report['after'] <= report['budget'] < report['before']
+    assert "発言49" in prompt and "発言0\n" not in prompt
+    assert not hasattr(budgeter, 'last_report')
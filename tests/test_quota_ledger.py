@@ -0,0 +1,68 @@
+"""QuotaLedger / 日次クォータ判定"""
+
+import json
+
+from gemini_backend import GenerationResult, QuotaLedger, QuotaRateLimiter, is_daily_quota_error
+
+MINUTE_429 = "429 Too Many Requests: Quota exceeded (RESOURCE_EXHAUSTED)"
+DAILY_429 = ("429 RESOURCE_EXHAUSTED: Quota exceeded for quota metric 'Generate Content API requests per day' "
+             "quotaId: GenerateRequestsPerDayPerProjectPerModel-FreeTier")
+MODELS = {"m": {"minute_limit": 5, "daily_limit": 10, "fallback_chain": []}}
+
+
+def _result(stderr=None):
+    if stderr is None:
+        return GenerationResult("m", 0, "ok", "", 0.1)
+    return GenerationResult("m", 1, "", stderr, 0.1)
+
+
+def test_daily_quota_errors_are_distinguished():
+    assert is_daily_quota_error(DAILY_429)
+    assert not is_daily_quota_error(MINUTE_429)
+    assert not is_daily_quota_error("daily report failed")
+
+
+def test_each_call_is_one_line(tmp_path):
+    ledger = QuotaLedger(tmp_path / "ledger.jsonl")
+    ledger.record_result(_result())
+    ledger.record_result(_result(MINUTE_429))
+    ledger.record_result(_result("boom"))
+    lines = [json.loads(line) for line in (tmp_path / "ledger.jsonl").read_text().splitlines()]
+    assert [(line['event'], line.get('outcome')) for line in lines] == [
+        ('call', None), ('call', 'quota'), ('call', 'error')]
+    assert ledger.counts("m") == {'call': 3, 'error': 1, 'quota': 1, 'daily_quota': 0}
+    assert ledger.failures("m") == 2
+
+
+def test_minute_429s_do_not_exhaust_the_day(tmp_path):
+    ledger = QuotaLedger(tmp_path / "ledger.jsonl")
+    for _ in range(5):
+        ledger.record_result(_result(MINUTE_429))
+    assert not ledger.is_exhausted("m", daily_limit=10)
+    limiter = QuotaRateLimiter(MODELS)
+    limiter.restore(ledger)
+    assert limiter.remaining("m")['daily'] == 5
+
+    ledger.record_result(_result(DAILY_429))
+    assert ledger.is_exhausted("m", daily_limit=100)
+    limiter.restore(ledger)
+    assert limiter.remaining("m")['daily'] == 0
+
+
+def test_counts_survive_reload(tmp_path):
+    path = tmp_path / "ledger.jsonl"
+    ledger = QuotaLedger(path)
+    ledger.record_result(_result(DAILY_429))
+    ledger.record_result(_result())
+    reloaded = QuotaLedger(path)
+    assert reloaded.counts("m") == ledger.counts("m")
+    assert reloaded.last_error_time("m") > 0
+
+
+def test_limiter_cools_down_after_minute_429():
+    limiter = QuotaRateLimiter(MODELS)
+    limiter.record_quota_error("m")
+    assert limiter.remaining("m") == {'minute': 0, 'daily': 10}
+    assert 0 < limiter.wait_time("m") <= 60 / 5
+    limiter.record_quota_error("m", daily=True)
+    assert limiter.remaining("m")['daily'] == 0
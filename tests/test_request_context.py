@@ -0,0 +1,96 @@
+"""RequestContext によるキャンセル・期限（StubBackend / ワーカープール）"""
+
+import concurrent.futures
+import os
+import sys
+import time
+
+import pytest
+
+from gemini_backend import (AsyncGeminiEngine, GeminiWorkerPool, RequestCancelled, RequestContext, StubBackend,
+                            WorkerPoolBackend)
+
+PROMPT = "あなたは「A」（テスト）"
+WORKER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fake_gemini_worker.py")
+
+
+def _wait_for(predicate, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+
+def test_check_raises_after_cancel_or_expiry():
+    context = RequestContext(label="t")
+    context.check()
+    assert context.remaining() is None
+    context.cancel()
+    assert context.cancelled
+    with pytest.raises(RequestCancelled):
+        context.check()
+
+    expiring = RequestContext(0.01)
+    time.sleep(0.02)
+    assert expiring.expired and not expiring.cancelled and expiring.remaining() == 0.0
+    with pytest.raises(RequestCancelled):
+        expiring.check()
+
+
+def test_track_after_cancel_cancels_immediately():
+    context = RequestContext()
+    context.cancel()
+    future = concurrent.futures.Future()
+    assert context.track(future).cancelled()
+
+
+@pytest.fixture
+def stub_engine():
+    engine = AsyncGeminiEngine(backend=StubBackend(latency=2.0, hang_time=5.0))
+    yield engine
+    engine.shutdown()
+
+
+def test_cancel_aborts_stub_request(stub_engine):
+    context = RequestContext(label="t")
+    future = stub_engine.submit(PROMPT, "m", context=context)
+    time.sleep(0.1)
+    context.cancel()
+    assert future.cancelled()
+    assert _wait_for(lambda: stub_engine.in_flight == 0)
+
+
+def test_deadline_cuts_stub_request(stub_engine):
+    start = time.monotonic()
+    result = stub_engine.submit(PROMPT, "m", timeout=30, context=RequestContext(0.2)).result(timeout=5)
+    assert result.timed_out and time.monotonic() - start < 1.5
+
+
+@pytest.fixture
+def pool_engine():
+    pool = GeminiWorkerPool([sys.executable, WORKER, "--latency", "2"], pool_size=2, health_check_interval=0)
+    engine = AsyncGeminiEngine(backend=WorkerPoolBackend(pool))
+    yield engine, pool
+    engine.shutdown()
+
+
+def test_cancel_retires_busy_pool_worker(pool_engine):
+    engine, pool = pool_engine
+    context = RequestContext(label="t")
+    future = engine.submit(PROMPT, "m", context=context)
+    assert _wait_for(lambda: pool._idle.qsize() == 1)
+    context.cancel()
+    assert future.cancelled()
+    # 生成途中のワーカーは破棄され、プールは補充で元の本数に戻る
+    assert _wait_for(lambda: pool.stats['cancelled'] == 1 and pool._idle.qsize() == 2, timeout=2.0)
+
+
+def test_deadline_retires_pool_worker(pool_engine):
+    engine, pool = pool_engine
+    start = time.monotonic()
+    result = engine.submit(PROMPT, "m", timeout=30, context=RequestContext(0.3)).result(timeout=5)
+    assert result.timed_out and time.monotonic() - start < 1.5
+    assert pool.stats['timeouts'] == 1
+    assert _wait_for(lambda: pool._idle.qsize() == 2)
@@ -0,0 +1,42 @@
+"""AsyncGeminiEngine の single-flight（同一要求の共有）"""
+
+import pytest
+
+from gemini_backend import AsyncGeminiEngine, StubBackend
+
+PROMPT = "あなたは「A」（テスト）"
+
+
+@pytest.fixture
+def engine():
+    engine = AsyncGeminiEngine(backend=StubBackend(latency=0.1))
+    yield engine
+    engine.shutdown()
+
+
+def _run(engine, *requests):
+    futures = [engine.submit(PROMPT, "m", **kwargs) for kwargs in requests]
+    return [future.result(timeout=5) for future in futures]
+
+
+def test_identical_requests_share_one_call(engine):
+    results = _run(engine, {}, {})
+    assert engine.backend.stats['calls'] == 1
+    assert [result.coalesced for result in results] == [False, True]
+
+
+def test_uncached_requests_are_not_shared(engine):
+    _run(engine, {'use_cache': False}, {'use_cache': False})
+    assert engine.backend.stats['calls'] == 2
+
+
+def test_different_timeouts_are_not_shared(engine):
+    _run(engine, {'timeout': 10}, {'timeout': 20})
+    assert engine.backend.stats['calls'] == 2
+
+
+def test_later_deadline_does_not_join_earlier_one(engine):
+    _run(engine, {'deadline': 5}, {'deadline': 30}, {})
+    assert engine.backend.stats['calls'] == 3
+    _run(engine, {'deadline': 30}, {'deadline': 5})
+    assert engine.backend.stats['calls'] == 4
@@ -0,0 +1,98 @@
+"""TopicIndex"""
+
+import random
+
+from gemini_backend import TopicIndex, split_terms
+
+
+def _index(**kwargs):
+    kwargs.setdefault('path', None)
+    return TopicIndex(**kwargs)
+
+
+def test_split_terms_by_script():
+    assert split_terms("新しいAIとスマートフォンの人工知能研究開発") == [
+        "ai", "スマートフォン", "人工", "工知", "知能", "能研", "研究", "究開", "開発"]
+
+
+def test_recent_and_rare_terms_score_higher():
+    index = _index(half_life=1)
+    for _ in range(3):
+        index.add("アート")
+    index.add("デザイン")
+    top = dict(index.top(5))
+    assert top["デザイン"] > top["アート"] > 0
+    assert index.documents == 4
+
+
+def test_stop_words_are_ignored():
+    index = _index(stop_words=("テスト",))
+    assert index.add("テスト と アート") == ["アート"]
+    assert [term for term, _ in index.top()] == ["アート"]
+
+
+def test_interested_ranks_speakers_by_cooccurrence():
+    index = _index()
+    index.add("アート展に行った", speaker="a")
+    index.add("アートとデザイン", speaker="b")
+    index.add("アートは好き", speaker="b")
+    assert index.interested("アート") == ["b", "a"]
+    assert index.interested("アート", candidates=["a"]) == ["a"]
+    assert index.interested("未知") == []
+
+
+def test_pick_respects_exclude():
+    index = _index()
+    index.add("アート テクノロジー")
+    rng = random.Random(1)
+    assert {index.pick(exclude=("アート",), rng=rng) for _ in range(10)} == {"テクノロジー"}
+    assert index.pick(exclude=("アート", "テクノロジー"), rng=rng) is None
+    assert _index().pick() is None
+
+
+def test_sync_adds_only_new_messages():
+    index = _index()
+    messages = [("アート", "a", "2026-01-01T00:00:00"), ("デザイン", "b", "2026-01-01T00:01:00")]
+    assert index.sync(messages) == 2
+    messages.append(("テクノロジー", "a", "2026-01-01T00:02:00"))
+    assert index.sync(messages) == 1
+    assert index.documents == 3 and index.last_key == "2026-01-01T00:02:00"
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = tmp_path / "topics.json"
+    index = TopicIndex(path, save_every=0)
+    index.add("アート テクノロジー", speaker="a", key="k1")
+    index.add("アート", speaker="b", key="k2")
+    index.save()
+    restored = TopicIndex(path)
+    assert restored.documents == 2 and restored.last_key == "k2"
+    assert restored.top() == index.top()
+    assert restored.interested("アート") == index.interested("アート")
+
+
+def test_decay_rebase_keeps_ranking():
+    index = _index(half_life=1)
+    index.add("アート")
+    for _ in range(80):
+        index.add("テクノロジー")
+    assert index.top(1)[0][0] == "テクノロジー"
+    assert dict(index.top(2))["アート"] < 1e-20
+
+
+def test_out_of_order_keys_are_not_indexed_twice(tmp_path):
+    path = tmp_path / "topics.json"
+    messages = [("アート", "a", "2026-01-01T00:00:01"), ("デザイン", None, "2026-01-01T00:00:05"),
+                ("テクノロジー", "b", "2026-01-01T00:00:03")]
+    index = TopicIndex(path, save_every=0)
+    # 表示順（ユーザー発言の後に、それより前に生成された AI 発言）で追加
+    for text, speaker, key in messages:
+        index.add(text, speaker, key)
+    assert index.last_key == "2026-01-01T00:00:05"
+    index.save()
+    before = (index.documents, index.top(), index.interested("テクノロジー"))
+
+    restored = TopicIndex(path, save_every=0)
+    assert restored.sync(sorted(messages, key=lambda message: message[2])) == 0
+    assert (restored.documents, restored.top(), restored.interested("テクノロジー")) == before
+    assert restored._df == {"アート": 1, "デザイン": 1, "テクノロジー": 1}
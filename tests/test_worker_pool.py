@@ -0,0 +1,48 @@
+"""GeminiWorkerPool（fake_gemini_worker.py を使用）"""
+
+import os
+import sys
+
+import pytest
+
+from gemini_backend import GeminiWorkerPool
+
+WORKER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fake_gemini_worker.py")
+
+
+@pytest.fixture
+def pool():
+    pool = GeminiWorkerPool([sys.executable, WORKER], pool_size=3, health_check_interval=0)
+    yield pool
+    pool.close()
+
+
+def test_generate_through_pool(pool):
+    result = pool.generate("あなたは「A」（テスト）", "m", timeout=10)
+    assert result.returncode == 0 and "A" in result.stdout
+    assert pool.stats['requests'] == 1
+
+
+def test_health_check_replaces_dead_worker(pool):
+    victim = pool._idle.queue[0]
+    victim.process.kill()
+    victim.process.wait()
+    assert pool.health_check() == 2
+    assert pool.stats['replaced'] == 1
+    assert pool._idle.qsize() == 3
+    assert victim not in pool._idle.queue
+
+
+def test_health_check_leaves_other_workers_available(pool):
+    taken = []
+    original_ping = type(pool._idle.queue[0]).ping
+
+    def ping(worker, timeout=5):
+        # 検査中も残りのワーカーはプールに残っている
+        taken.append(pool._idle.qsize())
+        return original_ping(worker, timeout)
+
+    for worker in list(pool._idle.queue):
+        worker.ping = ping.__get__(worker)
+    assert pool.health_check() == 3
+    assert taken == [2, 2, 2]